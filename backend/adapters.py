@@ -0,0 +1,118 @@
+import json
+import os
+from dataclasses import dataclass
+from typing import Any, Optional
+
+from config import ADAPTERS_DIR
+
+# Experiments whose generations are routed to trained adapters
+ADAPTER_EXPERIMENTS = ('finetuned', 'slop')
+
+SOFT_PROMPT = 'soft_prompt'
+LORA = 'lora'
+
+
+@dataclass
+class Adapter:
+    """A trained adapter attached to a shared base model.
+
+    Soft prompts carry their virtual token embeddings and are prepended to each
+    row's input embeddings; LoRA adapters live inside the PEFT-wrapped model and
+    are selected per row by name.
+    """
+    name: str
+    kind: str
+    path: str
+    nbytes: int = 0
+    prompt_embeddings: Any = None
+
+
+def adapter_path(experiment: str, user_id: Optional[int] = None) -> Optional[str]:
+    """Directory holding the adapter for an experiment, preferring the user's own.
+
+    Layout: ADAPTERS_DIR/<experiment>/ for the experiment-wide adapter and
+    ADAPTERS_DIR/<experiment>/user-<id>/ for per-user ones, each a PEFT
+    save_pretrained() directory.
+    """
+    if experiment not in ADAPTER_EXPERIMENTS:
+        return None
+    candidates = []
+    if user_id is not None:
+        candidates.append(os.path.join(ADAPTERS_DIR, experiment, f"user-{user_id}"))
+    candidates.append(os.path.join(ADAPTERS_DIR, experiment))
+    for path in candidates:
+        if os.path.isfile(os.path.join(path, 'adapter_config.json')):
+            return path
+    return None
+
+
+def adapter_name(path: str) -> str:
+    # PEFT adapter names become module keys, which cannot contain dots
+    rel = os.path.relpath(path, ADAPTERS_DIR)
+    return rel.replace(os.sep, '__').replace('.', '_')
+
+
+def _weights_file(path: str) -> Optional[str]:
+    for filename in ('adapter_model.safetensors', 'adapter_model.bin'):
+        candidate = os.path.join(path, filename)
+        if os.path.isfile(candidate):
+            return candidate
+    return None
+
+
+def _load_state_dict(weights: str):
+    if weights.endswith('.safetensors'):
+        from safetensors.torch import load_file
+        return load_file(weights)
+    import torch
+    return torch.load(weights, map_location='cpu')
+
+
+def _is_peft_model(model) -> bool:
+    try:
+        from peft import PeftModel
+    except Exception:
+        return False
+    return isinstance(model, PeftModel)
+
+
+def load_adapter(engine, name: str, path: str) -> Adapter:
+    """Load an adapter for the engine's model without reloading the base weights."""
+    with open(os.path.join(path, 'adapter_config.json'), 'r') as f:
+        peft_type = (json.load(f).get('peft_type') or '').upper()
+    weights = _weights_file(path)
+    nbytes = os.path.getsize(weights) if weights else 0
+
+    if peft_type == 'PROMPT_TUNING':
+        if weights is None:
+            raise FileNotFoundError(f"No adapter weights in {path}")
+        state = _load_state_dict(weights)
+        embeddings = state.get('prompt_embeddings')
+        if embeddings is None:
+            raise ValueError(f"{path} has no prompt_embeddings")
+        base = engine.base_model
+        embeddings = embeddings.to(device=base.device, dtype=base.get_input_embeddings().weight.dtype)
+        print(f"[adapters] Loaded soft prompt {name} ({embeddings.shape[0]} virtual tokens)")
+        return Adapter(name, SOFT_PROMPT, path, nbytes, embeddings)
+
+    if peft_type == 'LORA':
+        from peft import PeftModel
+        with engine.model_lock:
+            if _is_peft_model(engine.model):
+                engine.model.load_adapter(path, adapter_name=name)
+            else:
+                # Wraps the shared base model in place; base rows keep running
+                # through it with the adapters disabled
+                engine.model = PeftModel.from_pretrained(engine.model, path, adapter_name=name)
+                engine.model.eval()
+        print(f"[adapters] Attached LoRA adapter {name}")
+        return Adapter(name, LORA, path, nbytes)
+
+    raise ValueError(f"Unsupported adapter type {peft_type!r} in {path}")
+
+
+def release_adapter(engine, adapter: Adapter) -> None:
+    """Detach an evicted adapter from the engine's model."""
+    if adapter.kind == LORA and _is_peft_model(engine.model):
+        with engine.model_lock:
+            engine.model.delete_adapter(adapter.name)
@@ -0,0 +1,212 @@
+"""Unix-socket broker between the AI post producer and the web workers.
+
+Under serve.py a single producer process owns the models, the AI post pools and
+the background generator. Web workers reach them over a Unix stream socket
+speaking newline-delimited JSON: each request is {"op": ..., ...params} and
+each reply is {"ok": true, "result": ...} or {"ok": false, "error": ...}.
+
+RemoteAiPostPools and RemoteLLMService stand in for AiPostPools and LLMService
+in the workers, so the rest of the code does not care which process it is in.
+Pool calls use a short timeout and degrade to "no posts" so the feed never
+waits on the producer.
+"""
+import json
+import os
+import socket
+import socketserver
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from config import AI_BROKER_SOCKET, AI_BROKER_TIMEOUT
+
+
+class BrokerError(RuntimeError):
+    pass
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                op = request.pop('op')
+                handler = self.server.handlers.get(op)
+                if handler is None:
+                    raise BrokerError(f"Unknown op {op!r}")
+                reply = {'ok': True, 'result': handler(**request)}
+            except Exception as e:
+                reply = {'ok': False, 'error': str(e)}
+            try:
+                self.wfile.write((json.dumps(reply, default=str) + '\n').encode('utf-8'))
+                self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                # The client timed out and hung up
+                return
+
+
+class BrokerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Serves handlers[op](**params) to broker clients, one thread per connection."""
+
+    daemon_threads = True
+
+    def __init__(self, path: str, handlers: Dict[str, Callable[..., Any]]):
+        if os.path.exists(path):
+            os.remove(path)
+        self.handlers = handlers
+        super().__init__(path, _Handler)
+
+    def serve_in_background(self) -> threading.Thread:
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+class BrokerClient:
+    """Calls broker ops over one persistent connection per thread."""
+
+    def __init__(self, path: str = AI_BROKER_SOCKET, timeout: float = AI_BROKER_TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connect(self, timeout: Optional[float]):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        sock.connect(self.path)
+        self._local.sock = sock
+        self._local.file = sock.makefile('rb')
+        return sock
+
+    def _close(self) -> None:
+        sock = getattr(self._local, 'sock', None)
+        if sock is not None:
+            try:
+                self._local.file.close()
+                sock.close()
+            except OSError:
+                pass
+        self._local.sock = None
+
+    def call(self, op: str, timeout: Optional[float] = -1, **params) -> Any:
+        """Run op in the producer and return its result. timeout=None waits indefinitely."""
+        timeout = self.timeout if timeout == -1 else timeout
+        payload = (json.dumps({'op': op, **params}) + '\n').encode('utf-8')
+        for attempt in (1, 2):
+            try:
+                sock = getattr(self._local, 'sock', None) or self._connect(timeout)
+                sock.settimeout(timeout)
+                sock.sendall(payload)
+                line = self._local.file.readline()
+                if not line:
+                    raise ConnectionError('broker closed the connection')
+                break
+            except (OSError, ConnectionError) as e:
+                self._close()
+                # A stale connection fails on first use; retry once on a fresh one
+                if attempt == 2 or isinstance(e, socket.timeout):
+                    raise BrokerError(f"{op} failed: {e}")
+        reply = json.loads(line)
+        if not reply.get('ok'):
+            raise BrokerError(reply.get('error') or f"{op} failed")
+        return reply.get('result')
+
+
+PoolKey = Tuple[str, str]
+
+
+class RemoteAiPostPools:
+    """AiPostPools interface for web workers, backed by the producer's pools."""
+
+    def __init__(self, client: BrokerClient, default_key: PoolKey):
+        self.client = client
+        self.default_key = default_key
+
+    def get(self, key: PoolKey, limit: int) -> List[dict]:
+        try:
+            return self.client.call('pool_get', key=list(key), limit=limit)
+        except BrokerError as e:
+            print(f"[broker] {e}")
+            return []
+
+    def prime(self, key: PoolKey, amount: int = 1) -> None:
+        try:
+            self.client.call('pool_prime', key=list(key), amount=amount)
+        except BrokerError as e:
+            print(f"[broker] {e}")
+
+    def size(self, key: PoolKey) -> int:
+        try:
+            return self.client.call('pool_size', key=list(key))
+        except BrokerError:
+            return 0
+
+    def total_size(self) -> int:
+        try:
+            return self.client.call('pool_size')
+        except BrokerError:
+            return 0
+
+    def metrics(self) -> Dict[str, dict]:
+        return self.client.call('pool_metrics')
+
+
+class RemoteLLMService:
+    """The parts of LLMService the web tier calls, run by the producer's service.
+
+    Generation waits for the producer (no timeout); models are never loaded in
+    the worker itself.
+    """
+
+    def __init__(self, client: BrokerClient, default_experiment: str = 'base'):
+        self.client = client
+        self.default_experiment = default_experiment
+
+    def _generate(self, op: str, **params) -> Any:
+        try:
+            return self.client.call(op, timeout=None, **params)
+        except BrokerError as e:
+            return {"error": str(e)}
+
+    def exp_submit_text(self, max_length=None, num_return_sequences=None, temperature=None,
+                        experiment: Optional[str] = None, prompt_source: Optional[str] = None,
+                        user_id: Optional[int] = None) -> Future:
+        params = {k: v for k, v in dict(max_length=max_length, num_return_sequences=num_return_sequences,
+                                        temperature=temperature, prompt_source=prompt_source,
+                                        user_id=user_id).items() if v is not None}
+        future = Future()
+        future.set_result(self._generate('llm_submit_text', experiment=experiment or self.default_experiment, **params))
+        return future
+
+    def exp_generate_text(self, *args, **kwargs):
+        return self.exp_submit_text(*args, **kwargs).result()
+
+    def exp_generate_batch(self, count: int, **kwargs):
+        results = self._generate('llm_generate_batch', count=count, experiment=self.default_experiment, **kwargs)
+        return results if isinstance(results, list) else [results]
+
+    def generate_text(self, prompt: str, **kwargs):
+        return self._generate('llm_generate_text', prompt=prompt, **kwargs)
+
+    @property
+    def max_concurrency(self) -> int:
+        return 1
+
+    def generation_metrics(self) -> dict:
+        try:
+            return self.client.call('llm_metrics')
+        except BrokerError as e:
+            return {'error': str(e)}
+
+
+_client: Optional[BrokerClient] = None
+_client_lock = threading.Lock()
+
+
+def get_broker_client() -> BrokerClient:
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = BrokerClient()
+    return _client
@@ -0,0 +1,221 @@
+"""Streaming export of the ai_generated_posts archive.
+
+Rows are read in keyset pages on (generated_at, id), each page in its own short
+session, so the cost of a page does not grow with its position in the archive
+and no transaction is held open while the client reads. Pages are encoded as
+CSV, NDJSON or Parquet chunks as they arrive, keeping memory bounded by the
+page size.
+
+pyarrow is only needed for Parquet and is imported when that format is used.
+"""
+import csv
+import io
+import json
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from sqlalchemy import and_, or_, select
+
+from db import db_session
+from db.models import AiGeneratedPost
+
+EXPORT_COLUMNS = ['id', 'title', 'self_text', 'subreddit', 'model_name', 'prompt', 'generated_at']
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+Cursor = Tuple[datetime, int]
+
+
+def parse_timestamp(value: Optional[str]) -> Optional[datetime]:
+    if not value:
+        return None
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    # generated_at is naive UTC; convert offsets rather than dropping them
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def encode_cursor(cursor: Cursor) -> str:
+    return f"{cursor[0].isoformat()}|{cursor[1]}"
+
+
+def decode_cursor(value: Optional[str]) -> Optional[Cursor]:
+    """Parse a "<generated_at>|<id>" cursor as returned in next_cursor."""
+    if not value:
+        return None
+    at, _, post_id = value.rpartition('|')
+    if not at:
+        raise ValueError(f"Invalid cursor {value!r}")
+    return parse_timestamp(at), int(post_id)
+
+
+def row_dict(r) -> Dict[str, Any]:
+    return {
+        'id': r.id,
+        'title': r.title,
+        'self_text': r.self_text,
+        'subreddit': r.subreddit,
+        'model_name': r.model_name,
+        'prompt': r.prompt,
+        'generated_at': r.generated_at.isoformat(),
+    }
+
+
+def fetch_page(
+    limit: int,
+    after: Optional[Cursor] = None,
+    newest_first: bool = False,
+    model_name: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    offset: int = 0,
+) -> List[Dict[str, Any]]:
+    """One keyset page of archived posts ordered by (generated_at, id).
+
+    after is the (generated_at, id) of the last row of the previous page; the
+    query seeks past it on ix_ai_generated_posts_generated_at_id instead of
+    skipping rows with OFFSET. offset is kept for old callers and is ignored
+    when after is given.
+    """
+    at, pk = AiGeneratedPost.generated_at, AiGeneratedPost.id
+    q = select(AiGeneratedPost)
+    if model_name:
+        q = q.where(AiGeneratedPost.model_name == model_name)
+    if since is not None:
+        q = q.where(at >= since)
+    if until is not None:
+        q = q.where(at < until)
+    if after is not None:
+        if newest_first:
+            q = q.where(or_(at < after[0], and_(at == after[0], pk < after[1])))
+        else:
+            q = q.where(or_(at > after[0], and_(at == after[0], pk > after[1])))
+    elif offset:
+        q = q.offset(offset)
+    order = (at.desc(), pk.desc()) if newest_first else (at.asc(), pk.asc())
+    with db_session() as session:
+        rows = session.execute(q.order_by(*order).limit(limit)).scalars().all()
+        return [row_dict(r) for r in rows]
+
+
+def iter_pages(page_size: int = 1000, **filters) -> Iterator[List[Dict[str, Any]]]:
+    """Yield every matching archived post, oldest first, one keyset page at a time."""
+    after = filters.pop('after', None)
+    while True:
+        page = fetch_page(page_size, after=after, **filters)
+        if not page:
+            return
+        yield page
+        if len(page) < page_size:
+            return
+        last = page[-1]
+        after = (datetime.fromisoformat(last['generated_at']), last['id'])
+
+
+def _csv_chunks(pages: Iterator[List[Dict[str, Any]]]) -> Iterator[str]:
+    output = io.StringIO()
+    writer = csv.DictWriter(output, fieldnames=EXPORT_COLUMNS)
+    writer.writeheader()
+    for page in pages:
+        writer.writerows(page)
+        yield output.getvalue()
+        output.seek(0)
+        output.truncate(0)
+    tail = output.getvalue()
+    if tail:
+        yield tail
+
+
+def _ndjson_chunks(pages: Iterator[List[Dict[str, Any]]]) -> Iterator[str]:
+    for page in pages:
+        yield ''.join(json.dumps(row, ensure_ascii=False) + '\n' for row in page)
+
+
+class _ChunkSink:
+    """Write-only file object that hands written bytes back in chunks.
+
+    ParquetWriter records column chunk offsets from tell(), so the position
+    keeps counting even though drained bytes are discarded.
+    """
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def writable(self) -> bool:
+        return True
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _require_pyarrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except Exception as e:
+        raise RuntimeError(f"pyarrow is required for Parquet export: {e}")
+    return pa, pq
+
+
+def _parquet_chunks(pa, pq, pages: Iterator[List[Dict[str, Any]]]) -> Iterator[bytes]:
+    schema = pa.schema([
+        ('id', pa.int64()),
+        ('title', pa.string()),
+        ('self_text', pa.string()),
+        ('subreddit', pa.string()),
+        ('model_name', pa.string()),
+        ('prompt', pa.string()),
+        ('generated_at', pa.timestamp('us')),
+    ])
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression='zstd')
+    # Each page becomes one row group
+    for page in pages:
+        columns = {name: [row[name] for row in page] for name in EXPORT_COLUMNS}
+        columns['generated_at'] = [datetime.fromisoformat(v) for v in columns['generated_at']]
+        writer.write_table(pa.Table.from_pydict(columns, schema=schema))
+        chunk = sink.drain()
+        if chunk:
+            yield chunk
+    writer.close()
+    yield sink.drain()
+
+
+def export_chunks(fmt: str, page_size: int = 1000, **filters) -> Iterator[Any]:
+    """Encoded chunks of the filtered archive in fmt ('csv', 'ndjson' or 'parquet').
+
+    Raises ValueError/RuntimeError up front, before anything has been streamed.
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unsupported export format {fmt!r}")
+    # Check the optional dependency before the response starts
+    parquet_deps = _require_pyarrow() if fmt == 'parquet' else None
+    pages = iter_pages(page_size, **filters)
+    if fmt == 'csv':
+        return _csv_chunks(pages)
+    if fmt == 'ndjson':
+        return _ndjson_chunks(pages)
+    return _parquet_chunks(*parquet_deps, pages)
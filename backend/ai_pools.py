@@ -0,0 +1,151 @@
+import math
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+PoolKey = Tuple[str, str]
+
+# Feed source -> generation prompt source
+FEED_PROMPT_SOURCES = {
+    'posts': 'base',
+    'humorposts': 'base-humor',
+}
+
+
+def prompt_source_for(feed_source: Optional[str]) -> str:
+    return FEED_PROMPT_SOURCES.get(feed_source or 'posts', 'base')
+
+
+def queue_key(key: PoolKey) -> str:
+    """The "<experiment>/<prompt source>" a post was generated for, as stored in ai_generated_posts.queue_key."""
+    return f"{key[0]}/{key[1]}"
+
+
+def pool_key(value: str) -> PoolKey:
+    experiment, _, source = value.partition('/')
+    return (experiment, source)
+
+
+class AiPostPools:
+    """Pre-generated AI posts, one bounded pool per (experiment, prompt_source).
+
+    Each get() records demand for its pool as an exponentially decayed pull
+    rate. The background generator asks plan_refills() which pools to top up
+    next: pools are ranked by demand times missing depth, so the experiments
+    users are actually reading get filled first. The default pool always keeps
+    a small demand floor so posts are ready before the first request.
+    """
+
+    def __init__(self, target_depth: int, default_key: PoolKey, half_life: float = 60.0):
+        self.target_depth = max(1, int(target_depth))
+        self.default_key = default_key
+        self.half_life = half_life
+        self._pools: Dict[PoolKey, deque] = {}
+        self._demand: Dict[PoolKey, float] = {}
+        self._demand_at: Dict[PoolKey, float] = {}
+        self._pulled: Dict[PoolKey, int] = {}
+        self._lock = threading.Lock()
+
+    def _pool(self, key: PoolKey) -> deque:
+        pool = self._pools.get(key)
+        if pool is None:
+            pool = self._pools[key] = deque()
+        return pool
+
+    def _decayed(self, key: PoolKey, now: float) -> float:
+        rate = self._demand.get(key, 0.0)
+        elapsed = now - self._demand_at.get(key, now)
+        return rate * math.pow(0.5, elapsed / self.half_life)
+
+    def _record_demand(self, key: PoolKey, amount: int) -> None:
+        now = time.monotonic()
+        self._demand[key] = self._decayed(key, now) + amount
+        self._demand_at[key] = now
+
+    def prime(self, key: PoolKey, amount: int = 1) -> None:
+        """Record demand for a pool without pulling from it."""
+        with self._lock:
+            self._record_demand(key, amount)
+
+    def get(self, key: PoolKey, limit: int) -> List[dict]:
+        """Pop up to limit posts from a pool and record the demand."""
+        with self._lock:
+            self._record_demand(key, limit)
+            pool = self._pool(key)
+            posts = []
+            while pool and len(posts) < limit:
+                posts.append(pool.popleft())
+            self._pulled[key] = self._pulled.get(key, 0) + len(posts)
+            return posts
+
+    def put(self, key: PoolKey, post: dict) -> bool:
+        """Add a post to a pool. Returns False if the pool is already at depth."""
+        with self._lock:
+            pool = self._pool(key)
+            if len(pool) >= self.target_depth:
+                return False
+            pool.append(post)
+            return True
+
+    def size(self, key: PoolKey) -> int:
+        with self._lock:
+            return len(self._pools.get(key, ()))
+
+    def total_size(self) -> int:
+        with self._lock:
+            return sum(len(p) for p in self._pools.values())
+
+    def plan_refills(self, slots: int, pending: Dict[PoolKey, int]) -> List[PoolKey]:
+        """Choose up to slots pool keys to generate for next, highest demand first.
+
+        pending counts generations already in flight per pool, so a pool is never
+        planned beyond its target depth.
+        """
+        if slots <= 0:
+            return []
+        now = time.monotonic()
+        with self._lock:
+            sizes = {key: len(pool) for key, pool in self._pools.items()}
+            demand = {key: self._decayed(key, now) for key in self._demand}
+        return self._plan(slots, pending, sizes, demand)
+
+    def _plan(self, slots: int, pending: Dict[PoolKey, int], sizes: Dict[PoolKey, int],
+              demand: Dict[PoolKey, float]) -> List[PoolKey]:
+        """Spread slots over pools given their current sizes and decayed demand."""
+        deficit = {}
+        weight = {}
+        for key in set(sizes) | set(demand) | {self.default_key}:
+            missing = self.target_depth - sizes.get(key, 0) - pending.get(key, 0)
+            if missing <= 0:
+                continue
+            rate = demand.get(key, 0.0)
+            if key == self.default_key:
+                rate = max(rate, 1.0)
+            if rate < 0.01:
+                continue
+            deficit[key] = missing
+            weight[key] = rate
+        plan: List[PoolKey] = []
+        while len(plan) < slots and deficit:
+            # Priority of a pool's next post: demand scaled by how empty it is
+            key = max(deficit, key=lambda k: weight[k] * deficit[k] / self.target_depth)
+            plan.append(key)
+            deficit[key] -= 1
+            if deficit[key] <= 0:
+                del deficit[key]
+        return plan
+
+    def metrics(self) -> Dict[str, dict]:
+        now = time.monotonic()
+        with self._lock:
+            keys = set(self._pools) | set(self._demand)
+            return {
+                f"{exp}/{src}": {
+                    'size': len(self._pools.get((exp, src), ())),
+                    'target_depth': self.target_depth,
+                    'demand_per_half_life': round(self._decayed((exp, src), now), 3),
+                    'pulled': self._pulled.get((exp, src), 0),
+                }
+                for exp, src in sorted(keys)
+            }
@@ -0,0 +1,158 @@
+"""AI post pools kept in the database, shared by every process.
+
+With AI_QUEUE_BACKEND=db, queuing a generated post marks its ai_generated_posts
+row queue_status='ready' under a queue_key of "<experiment>/<prompt source>".
+get() claims up to limit of the oldest ready rows in a single
+UPDATE ... WHERE id IN (SELECT ... FOR UPDATE SKIP LOCKED), so concurrent
+workers never hand out the same post and never wait on each other's row locks.
+Queued posts survive restarts, and any process can serve posts another one
+generated.
+
+Demand is kept in ai_queue_demand as the same decayed pull rate AiPostPools
+keeps in memory, so whichever process generates plans refills from the pulls
+of every worker.
+"""
+from typing import Dict, List, Tuple
+
+from sqlalchemy import func, select, update
+from sqlalchemy.dialects.postgresql import insert
+
+from ai_pools import AiPostPools, PoolKey, pool_key, queue_key
+from db import db_session
+from db.models import AiGeneratedPost, AiQueueDemand
+from sampling import archived_post_dict
+
+READY = 'ready'
+CLAIMED = 'claimed'
+
+
+def _utcnow():
+    # Database time, so every process ages queues and demand by the same clock
+    return func.timezone('utc', func.now())
+
+
+def _age_seconds(column):
+    return func.extract('epoch', _utcnow() - column)
+
+
+class DbAiPostPools(AiPostPools):
+    """AiPostPools interface over the ai_generated_posts queue columns."""
+
+    def _decayed_demand(self):
+        return AiQueueDemand.demand * func.power(0.5, _age_seconds(AiQueueDemand.updated_at) / self.half_life)
+
+    def _add_demand(self, session, key: PoolKey, amount: int, pulled: int = 0) -> None:
+        stmt = insert(AiQueueDemand).values(
+            queue_key=queue_key(key), demand=amount, pulled=pulled, updated_at=_utcnow(),
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['queue_key'],
+            set_={
+                'demand': self._decayed_demand() + stmt.excluded.demand,
+                'pulled': AiQueueDemand.pulled + stmt.excluded.pulled,
+                'updated_at': stmt.excluded.updated_at,
+            },
+        )
+        session.execute(stmt)
+
+    def _ready_query(self):
+        return select(AiGeneratedPost.id).where(AiGeneratedPost.queue_status == READY)
+
+    def prime(self, key: PoolKey, amount: int = 1) -> None:
+        with db_session() as session:
+            self._add_demand(session, key, amount)
+
+    def get(self, key: PoolKey, limit: int) -> List[dict]:
+        """Claim up to limit of the oldest ready posts of a pool in one statement."""
+        claimable = (
+            self._ready_query()
+            .where(AiGeneratedPost.queue_key == queue_key(key))
+            .order_by(AiGeneratedPost.id)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        )
+        with db_session() as session:
+            rows = session.execute(
+                update(AiGeneratedPost)
+                .where(AiGeneratedPost.id.in_(claimable))
+                .values(queue_status=CLAIMED)
+                .returning(AiGeneratedPost.id, AiGeneratedPost.title, AiGeneratedPost.self_text, AiGeneratedPost.subreddit)
+                .execution_options(synchronize_session=False)
+            ).all()
+            # Demand last: the shared demand row stays locked only until the commit
+            self._add_demand(session, key, limit, pulled=len(rows))
+        return [archived_post_dict(r) for r in sorted(rows, key=lambda r: r.id)]
+
+    def put(self, key: PoolKey, post: dict) -> bool:
+        """Mark an archived post ready in a pool. Returns False if the pool is at depth.
+
+        Raises ValueError for a post that is not archived (no ai-<id> post_id),
+        since the queue lives on the archive rows.
+        """
+        post_id = post.get('post_id') or ''
+        if not post_id.startswith('ai-'):
+            raise ValueError(f"post_id {post_id or None!r} is not an archived AI post")
+        depth = (
+            select(func.count())
+            .select_from(AiGeneratedPost)
+            .where(AiGeneratedPost.queue_status == READY, AiGeneratedPost.queue_key == queue_key(key))
+            .scalar_subquery()
+        )
+        with db_session() as session:
+            result = session.execute(
+                update(AiGeneratedPost)
+                .where(AiGeneratedPost.id == int(post_id[len('ai-'):]), depth < self.target_depth)
+                .values(queue_key=queue_key(key), queue_status=READY, queued_at=_utcnow())
+                .execution_options(synchronize_session=False)
+            )
+        return result.rowcount == 1
+
+    def _ready_by_key(self, session) -> Dict[PoolKey, Tuple[int, float]]:
+        """(size, age in seconds of the oldest ready post) per pool."""
+        rows = session.execute(
+            select(AiGeneratedPost.queue_key, func.count(), _age_seconds(func.min(AiGeneratedPost.queued_at)))
+            .where(AiGeneratedPost.queue_status == READY)
+            .group_by(AiGeneratedPost.queue_key)
+        ).all()
+        return {pool_key(k): (n, float(age or 0.0)) for k, n, age in rows}
+
+    def _demand_by_key(self, session) -> Dict[PoolKey, Tuple[float, int]]:
+        rows = session.execute(select(AiQueueDemand.queue_key, self._decayed_demand(), AiQueueDemand.pulled)).all()
+        return {pool_key(k): (float(d), p) for k, d, p in rows}
+
+    def size(self, key: PoolKey) -> int:
+        with db_session() as session:
+            return session.execute(
+                select(func.count())
+                .select_from(AiGeneratedPost)
+                .where(AiGeneratedPost.queue_status == READY, AiGeneratedPost.queue_key == queue_key(key))
+            ).scalar_one()
+
+    def total_size(self) -> int:
+        with db_session() as session:
+            return session.execute(
+                select(func.count()).select_from(AiGeneratedPost).where(AiGeneratedPost.queue_status == READY)
+            ).scalar_one()
+
+    def plan_refills(self, slots: int, pending: Dict[PoolKey, int]) -> List[PoolKey]:
+        if slots <= 0:
+            return []
+        with db_session() as session:
+            sizes = {key: n for key, (n, _age) in self._ready_by_key(session).items()}
+            demand = {key: d for key, (d, _pulled) in self._demand_by_key(session).items()}
+        return self._plan(slots, pending, sizes, demand)
+
+    def metrics(self) -> Dict[str, dict]:
+        with db_session() as session:
+            ready = self._ready_by_key(session)
+            demand = self._demand_by_key(session)
+        return {
+            f"{exp}/{src}": {
+                'size': ready.get((exp, src), (0, 0.0))[0],
+                'target_depth': self.target_depth,
+                'demand_per_half_life': round(demand.get((exp, src), (0.0, 0))[0], 3),
+                'pulled': demand.get((exp, src), (0.0, 0))[1],
+                'oldest_ready_seconds': round(ready.get((exp, src), (0, 0.0))[1], 1),
+            }
+            for exp, src in sorted(set(ready) | set(demand))
+        }
@@ -0,0 +1,174 @@
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, Optional
+
+# Rough chars-per-token ratio used to charge prompts against the token budget
+CHARS_PER_TOKEN = 4
+# Output tokens charged per request up front (the Responses API reports actual usage afterwards)
+EXPECTED_OUTPUT_TOKENS = 512
+
+
+class TokenBucket:
+    """Thread-safe token bucket refilled continuously at per_minute tokens per minute."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = max(1.0, float(per_minute))
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount: float = 1.0) -> float:
+        """Block until amount tokens are available. Returns seconds spent waiting."""
+        amount = min(float(amount), self.capacity)
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return waited
+                delay = (amount - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def charge(self, amount: float) -> None:
+        """Debit tokens without waiting (e.g. usage reported above the estimate)."""
+        with self._lock:
+            self._refill()
+            self.tokens -= amount
+
+
+def _status_code(error: Exception) -> Optional[int]:
+    status = getattr(error, 'status_code', None)
+    if status is None:
+        status = getattr(getattr(error, 'response', None), 'status_code', None)
+    return status
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    try:
+        value = headers.get('retry-after')
+        return float(value) if value is not None else None
+    except Exception:
+        return None
+
+
+def _is_retryable(error: Exception) -> bool:
+    status = _status_code(error)
+    if status is not None:
+        return status == 429 or status >= 500
+    # Connection errors and timeouts carry no status code
+    return type(error).__name__ in ('APIConnectionError', 'APITimeoutError')
+
+
+def response_text(response) -> str:
+    """Extract output text from a Responses API result."""
+    # Prefer the helper property when available
+    text = getattr(response, "output_text", None)
+    if not text:
+        # Fallback to structured parsing
+        try:
+            text = response.output[0].content[0].text
+        except Exception:
+            text = str(response)
+    return text
+
+
+class ConcurrentApiGenerator:
+    """Keeps up to max_in_flight OpenAI generations running on a thread pool.
+
+    Every attempt, retries included, first takes one unit from the requests-per-minute
+    bucket and an estimate of its tokens from the tokens-per-minute bucket. 429 and 5xx
+    responses are retried with exponential backoff and jitter, honoring
+    Retry-After when the server sends it. Futures resolve to the same
+    {"generated_text": ...} / {"error": ...} dicts LLMService returns.
+    """
+
+    def __init__(self, client, model_name: str, max_in_flight: int = 8, requests_per_minute: float = 500,
+                 tokens_per_minute: float = 200000, max_retries: int = 5, backoff_base: float = 1.0):
+        self.client = client
+        self.model_name = model_name
+        self.max_in_flight = max(1, int(max_in_flight))
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self._requests = TokenBucket(requests_per_minute)
+        self._tokens = TokenBucket(tokens_per_minute)
+        self._pool = ThreadPoolExecutor(max_workers=self.max_in_flight, thread_name_prefix='openai')
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'submitted': 0,
+            'completed': 0,
+            'errors': 0,
+            'retries': 0,
+            'rate_limited': 0,
+            'in_flight': 0,
+            'latency_seconds': 0.0,
+            'throttle_seconds': 0.0,
+        }
+        self._started = time.monotonic()
+
+    def _bump(self, **deltas) -> None:
+        with self._stats_lock:
+            for key, value in deltas.items():
+                self._stats[key] += value
+
+    def submit(self, prompt: str, **request_kwargs) -> Future:
+        self._bump(submitted=1)
+        return self._pool.submit(self._call, prompt, request_kwargs)
+
+    def _call(self, prompt: str, request_kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        estimate = len(prompt) / CHARS_PER_TOKEN + EXPECTED_OUTPUT_TOKENS
+        self._bump(in_flight=1)
+        started = time.monotonic()
+        try:
+            for attempt in range(self.max_retries + 1):
+                throttled = self._requests.acquire(1) + self._tokens.acquire(estimate)
+                self._bump(throttle_seconds=throttled)
+                try:
+                    response = self.client.responses.create(
+                        model=self.model_name,
+                        input=prompt,
+                        **request_kwargs,
+                    )
+                    usage = getattr(getattr(response, 'usage', None), 'total_tokens', None)
+                    if usage and usage > estimate:
+                        self._tokens.charge(usage - estimate)
+                    text = response_text(response)
+                    self._bump(completed=1, latency_seconds=time.monotonic() - started)
+                    return {"generated_text": text}
+                except Exception as e:
+                    if attempt >= self.max_retries or not _is_retryable(e):
+                        raise
+                    if _status_code(e) == 429:
+                        self._bump(rate_limited=1)
+                    delay = _retry_after(e)
+                    if delay is None:
+                        delay = self.backoff_base * (2 ** attempt) * (0.5 + random.random())
+                    self._bump(retries=1)
+                    print(f"[api] Retrying after {type(e).__name__} in {delay:.1f}s (attempt {attempt + 1})")
+                    time.sleep(delay)
+        except Exception as e:
+            self._bump(errors=1)
+            return {"error": f"OpenAI generation failed: {str(e)}"}
+        finally:
+            self._bump(in_flight=-1)
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['max_in_flight'] = self.max_in_flight
+        stats['avg_latency_seconds'] = (
+            stats['latency_seconds'] / stats['completed'] if stats['completed'] else 0.0
+        )
+        elapsed = max(time.monotonic() - self._started, 1e-9)
+        stats['completions_per_minute'] = stats['completed'] / elapsed * 60
+        return stats
@@ -1,10 +1,14 @@
 import datetime
 import hashlib
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
 from functools import wraps
-from typing import Optional
+from typing import Dict, Optional, Tuple
 import jwt
 from flask import Blueprint, request, jsonify, g
-from config import SECRET_KEY, DEV_AUTH_NO_PASSWORD
+from config import SECRET_KEY, DEV_AUTH_NO_PASSWORD, AUTH_TOKEN_CACHE_SIZE, AUTH_USER_CACHE_TTL
 from db import db_session
 from db.models import User
 from sqlalchemy.exc import IntegrityError
@@ -78,6 +82,113 @@ def login():
     return jsonify({'token': token, 'user': {'id': user.id, 'username': user.username}})
 
 
+# Clock skew allowed when checking exp, for decoding and for cached tokens alike
+TOKEN_LEEWAY = 60
+
+
+@dataclass(frozen=True)
+class UserContext:
+    """The parts of a User row that require_auth copies into g."""
+    user_id: int
+    current_experiment: Optional[str]
+    aware_of_experiment: bool
+
+
+class AuthContextCache:
+    """Memoizes decoded tokens and user contexts so most requests skip JWT and DB work.
+
+    Tokens map to (user_id, exp) in a bounded LRU and are dropped once expired.
+    User contexts are kept for ttl seconds; set_experiment invalidates the
+    user's entry, and the TTL bounds staleness in other worker processes.
+    """
+
+    def __init__(self, max_tokens: int = AUTH_TOKEN_CACHE_SIZE, ttl: float = AUTH_USER_CACHE_TTL):
+        self.max_tokens = max(0, max_tokens)
+        self.ttl = ttl
+        self._tokens: 'OrderedDict[str, Tuple[int, float]]' = OrderedDict()
+        self._users: Dict[int, Tuple[UserContext, float]] = {}
+        self._lock = threading.Lock()
+        self._stats = {'token_hits': 0, 'token_misses': 0, 'user_hits': 0, 'user_misses': 0, 'invalidations': 0}
+
+    def token(self, token: str) -> Optional[int]:
+        """Cached user id for a still-valid token, or None."""
+        with self._lock:
+            entry = self._tokens.get(token)
+            if entry is not None:
+                user_id, exp = entry
+                if time.time() <= exp + TOKEN_LEEWAY:
+                    self._tokens.move_to_end(token)
+                    self._stats['token_hits'] += 1
+                    return user_id
+                del self._tokens[token]
+            self._stats['token_misses'] += 1
+            return None
+
+    def put_token(self, token: str, user_id: int, exp: Optional[float]) -> None:
+        if self.max_tokens <= 0 or exp is None:
+            return
+        with self._lock:
+            self._tokens[token] = (user_id, float(exp))
+            self._tokens.move_to_end(token)
+            while len(self._tokens) > self.max_tokens:
+                self._tokens.popitem(last=False)
+
+    def user(self, user_id: int) -> Optional[UserContext]:
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is not None and time.monotonic() - entry[1] < self.ttl:
+                self._stats['user_hits'] += 1
+                return entry[0]
+            self._stats['user_misses'] += 1
+            return None
+
+    def put_user(self, context: UserContext) -> None:
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._users[context.user_id] = (context, time.monotonic())
+            # Prune expired contexts once the table outgrows the token bound
+            if len(self._users) > max(self.max_tokens, 1):
+                now = time.monotonic()
+                self._users = {k: v for k, v in self._users.items() if now - v[1] < self.ttl}
+
+    def invalidate_user(self, user_id: int) -> None:
+        with self._lock:
+            if self._users.pop(user_id, None) is not None:
+                self._stats['invalidations'] += 1
+
+    def metrics(self) -> Dict[str, float]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['tokens'] = len(self._tokens)
+            stats['users'] = len(self._users)
+        for kind in ('token', 'user'):
+            lookups = stats[f'{kind}_hits'] + stats[f'{kind}_misses']
+            stats[f'{kind}_hit_ratio'] = stats[f'{kind}_hits'] / lookups if lookups else 0.0
+        return stats
+
+
+auth_cache = AuthContextCache()
+
+
+def invalidate_user_context(user_id: int) -> None:
+    """Drop a user's cached context after their experiment settings change."""
+    auth_cache.invalidate_user(user_id)
+
+
+def _load_user_context(user_id: int) -> Optional[UserContext]:
+    context = auth_cache.user(user_id)
+    if context is not None:
+        return context
+    with db_session() as session:
+        user = session.get(User, user_id)
+        if not user:
+            return None
+        context = UserContext(user.id, user.current_experiment, user.aware_of_experiment)
+    auth_cache.put_user(context)
+    return context
+
+
 def require_auth(fn):
     @wraps(fn)
     def wrapper(*args, **kwargs):
@@ -85,28 +196,34 @@ def require_auth(fn):
         if not header or not header.startswith('Bearer '):
             return jsonify({'error': 'missing bearer token'}), 401
         token = header.split(' ', 1)[1]
-        try:
-            # Allow small clock skew and skip iat validation; still verify signature/exp
-            payload = jwt.decode(
-                token,
-                SECRET_KEY,
-                algorithms=['HS256'],
-                leeway=60,
-                options={
-                    'verify_iat': False,
-                }
-            )
-            user_id = payload.get('sub')
-        except Exception as e:
-            return jsonify({'error': 'invalid token', 'message': str(e)}), 401
-        with db_session() as session:
-            user = session.get(User, user_id)
-            if not user:
-                return jsonify({'error': 'user not found'}), 401
-            g.current_user_id = user.id
-            g.current_experiment = user.current_experiment
-            g.current_user_aware = user.aware_of_experiment
+        user_id = auth_cache.token(token)
+        if user_id is None:
+            try:
+                # Allow small clock skew and skip iat validation; still verify signature/exp
+                payload = jwt.decode(
+                    token,
+                    SECRET_KEY,
+                    algorithms=['HS256'],
+                    leeway=TOKEN_LEEWAY,
+                    options={
+                        'verify_iat': False,
+                    }
+                )
+                user_id = payload.get('sub')
+            except Exception as e:
+                return jsonify({'error': 'invalid token', 'message': str(e)}), 401
+            auth_cache.put_token(token, user_id, payload.get('exp'))
+        context = _load_user_context(user_id)
+        if context is None:
+            return jsonify({'error': 'user not found'}), 401
+        g.current_user_id = context.user_id
+        g.current_experiment = context.current_experiment
+        g.current_user_aware = context.aware_of_experiment
         return fn(*args, **kwargs)
     return wrapper
 
 
+@auth.route('/metrics', methods=['GET'])
+@require_auth
+def auth_metrics():
+    return jsonify(auth_cache.metrics())
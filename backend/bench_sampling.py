@@ -0,0 +1,56 @@
+"""Benchmark the bitmap feed sampler against the SQL anti-join sampler.
+
+In-memory draws run on a synthetic corpus of BENCH_POSTS ids with BENCH_SERVED
+ids already served to the benchmark user. Both samplers are then timed end to
+end against DATABASE_URL for user BENCH_SQL_USER (default 1; served marks are
+not written). Set BENCH_SQL=false to run only the in-memory draws.
+
+    BENCH_POSTS=1000000 BENCH_SERVED=100000 python bench_sampling.py
+"""
+import os
+import random
+import time
+from sampling import BitmapSampler, SqlSampler
+
+BENCH_POSTS = int(os.getenv("BENCH_POSTS", "1000000"))
+BENCH_SERVED = int(os.getenv("BENCH_SERVED", "100000"))
+BENCH_LIMIT = int(os.getenv("BENCH_LIMIT", "10"))
+BENCH_ITERATIONS = int(os.getenv("BENCH_ITERATIONS", "1000"))
+BENCH_SQL = os.getenv("BENCH_SQL", "true").lower() in ("1", "true", "yes")
+BENCH_SQL_USER = int(os.getenv("BENCH_SQL_USER", "1"))
+
+
+def _report(label: str, elapsed: float, iterations: int):
+    print(f"{label}: {elapsed / iterations * 1e6:,.1f} us/call over {iterations:,} calls")
+
+
+def bench_bitmap_draws():
+    user_id = 1
+    started = time.perf_counter()
+    sampler = BitmapSampler()
+    served = ((user_id, pid) for pid in random.sample(range(1, BENCH_POSTS + 1), BENCH_SERVED))
+    sampler.load(range(1, BENCH_POSTS + 1), served)
+    print(f"Built permutation of {BENCH_POSTS:,} posts with {BENCH_SERVED:,} served "
+          f"in {time.perf_counter() - started:.2f}s")
+
+    started = time.perf_counter()
+    for _ in range(BENCH_ITERATIONS):
+        sampler.draw_ids(user_id, BENCH_LIMIT)
+    _report("bitmap draw_ids", time.perf_counter() - started, BENCH_ITERATIONS)
+
+
+def bench_end_to_end(user_id: int):
+    iterations = max(1, BENCH_ITERATIONS // 10)
+    for sampler in (SqlSampler(), BitmapSampler()):
+        if hasattr(sampler, 'rebuild'):
+            sampler.rebuild()
+        started = time.perf_counter()
+        for _ in range(iterations):
+            sampler.sample(user_id, BENCH_LIMIT, mark_served=False)
+        _report(f"{sampler.name} sample", time.perf_counter() - started, iterations)
+
+
+if __name__ == '__main__':
+    bench_bitmap_draws()
+    if BENCH_SQL:
+        bench_end_to_end(BENCH_SQL_USER)
@@ -1,7 +1,14 @@
+import argparse
 import csv
-import sys
+import json
 import os
+import re
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
+from post_store import DEFAULT_STORE_DIR, csv_to_store
 # Increase CSV field size limit to handle very large self_text fields
 try:
     csv.field_size_limit(sys.maxsize)
@@ -16,7 +23,14 @@ BANNED_TAGS = ["[deleted]", "[removed]", "Megapost"]
 
 WHITELIST_SUBREDDITS = set(["ModernWarefareII", "teenagers", "relationship_advice", "NoStupidQuestions", "ModernWarefareII", "buildapc", "tipofmytongue", "pcmasterrace", "legaladvice", "shittyjobsforrobots", "AskDocs", "LoveIsBlindOnNetflix", "lovemanga", "BlazingDiscount", "BlazeDiscount", "Fantasy_Football", "Overwatch", "NoFilterNews", "AmItheAsshole", "ApplyingToCollege", "ADHD", "SteamDeck", "Vent", "personalfinance", "Warthunder", "HomeImprovement", "RimWorld", "EldenRing", "BreakUps", "GooglePixel", "brasil", "gaming", "newworldgame", "dadjokes", "ask", "Minecraft", "autism", "wow", "MechanicAdvice", "careerguidance", "OnePiece", "DestinyTheGame", "deadbydaylight", "sysadmin", "learnprogramming", "Teachers", "MarvelSnap", "TwoSentenceHorror", "PcBuild", "excel", "leagueoflegends", "Christianity", "antiwork", "VeteransBenefits", "pregnant", "2007scape", "csMajors", "learnpython", "FortNiteBR", "Cooking", "fo76", "BeyondTheFog", "Parenting", "skyrimmods", "cyberpunkgame", "UnsentLetters", "HeadphoneAdvice", "LegalAdviceUK", "airsoft", "adhdwomen", "beyondthebump", "dogs", "AskUK", "Crushes", "Wallstreeetsilver", "DnD", "ShadowBan", "every15min", "lonely", "apexlegends", "Drizzy", "Philippines", "modernwarefare2", "fut", "india", "hearthstone", "GothamKnights", "LSAT", "nba", "UKPersonalFinance", "GodofWar", "Bayonetta", "shrooms", "anime", "lawschooladmissions", "conspiracy", "Jokes", "CreditCards", "USCIS", "cats", "NBA2k", "borrow", "3dprinting", "Music", "OCD", "DreamlightValleuy", "KGBTR", "bipolar", "real_China_irl", "manga", "nursing", "NHLHUT", "Technoblade", "HomeNetworking", "Bannerlord", "socialskills", "travel", "walmart", "Destiny", "relationships", "Terraria", "HouseOfTheDragon", "MarvelStrikeForce", "Earnin", "TheFreshAndFit", "AutismInWomen", "skyrim", "DMAcademy", "NoMansSkyTheGame", "golf", "puppy101", "Warhammer40k", "Entrepreneur", "army", "Warframe", "lgbt", "SkincareAddiction", "selfimprovment", "funkopop", "copypasta", "avatartrading", "IVF", "Dreams", "CatAdvice", "UCSD", "GamingLaptops", "horror", "namenerds", "Aquariums", "feedthebeast", "Catholicism", "bloxfruits", "overwatch2", "cscareerquestions", "premed", "ffxiv", "FanFiction", "sales", "vce", "linuxquestions", "exmormon", "trees", "fantasyfootballadvice", "EDH", "Persona5", "venting", "RocketLeague", "toddlers", "dubai", "SGExams", "OverwatchUniversity", "playstation", "confessions", "wallstreetbets", "ireland", "movies", "duolingo", "cryptostreetbets", "runescape", "starbucks", "TwoXChromosomes", "covidlonghaulers", "askdentists", "Nepal", "CasualConersation", "socialanxiety", "mumbai", "fountainpens", "cocaine", "weddingplanning", "smallbusiness", "delhi", "Denmark", "dancingwiththestars", "residentevil", "VALORANT", "NewTubers", "CryptoCurrency", "elderscrollsonline", "WeightLossAdvice", "StardewVally", "doordash_drivers", "homeassistant", "harrypotter", "destiny2", "40kLore", "YoungRoyals", "leaves", "ucla", "StarWars", "splatoon", "germany", "Superstonk", "pokemongo", "GroundedGame", "totalwar", "jobs", "TheHandmaidsTale", "AmazonFC", "projectzomboid", "dating", "ExNoContact", "mac", "AusFinance", "simracing", "canthandlemoney", "MacOs", "ottawa", "homelab", "ClashRoyale", "h3h3productions", "mexico", "iphone", "islam", "EscapefromTarkov", "emetophobia", "gradadmissions", "pokemon", "Healthygamergg", "RandomThoughts", "USPS", "childfree", "China_irl", "gamedev", "tressless", "RealEstate", "UIUC", "OCPoetry", "wildrift", "college", "Accounting", "exjw", "foxholegame", "hvacadvice", "birthcontrol", "Fallout", "ios", "PSLF", "ukvisa", "youtube", "unrealengine", "AppleWatch", "mbti", "Roleplay", "bleach", "spirituality", "Stellaris", "dndnext", "worldbuilding", "LSD", "Mustardtopia", "starcitizen", "NewParents", "learnmath", "6thForm", "TheDragonPrince", "migraine", "Plumbing", "ARK", "classicwow", "DarkAndDarker", "UberEATS", "Divorce", "mountandblade", "Scholar", "Sephora", "poker", "newzealand", "Cornell", "doordash", "Testosterone", "hoi4", "Chucky", "uberdrivers", "Scams", "Diablo_2_Resurrected", "GilmoreGirls", "AirForce", "ITCareerQuestions", "blender", "gtaonline", "CallOfDutyMobile", "self", "footballmanagergames", "ontario", "thewalkingdead", "Yugioh101", "espresso", "bjj", "berkeley", "Hpfanfiction", "OnePiecePowerScaling", "tf2", "magicTCG", "melbourne", "dayz", "EnglishLearning", "progzonlymusic", "medical", "greece", "asoiaf", "osureport", "nvidia", "reddeadredemption", "Twitch", "MouseReview", "TowerOfFantasy", "Insurance", "IBO", "lexapro", "hometheater", "Epilepsy", "explainlikeimfive", "Nanny", "writing", "thinkpad", "WouldYouRather", "webdev", "Target", "crochet"])
 
+# Single pass over all text fields instead of one substring scan per keyword
+BANNED_RE = re.compile('|'.join(re.escape(k) for k in BANNED_KEYWORDS), re.IGNORECASE)
+
+PROGRESS_EVERY = 100000
+
+
 def is_valid_post(post):
+    # Cheapest check first: most rows are from subreddits we never keep
     if post.get('subreddit') not in WHITELIST_SUBREDDITS:
         return False
     
@@ -26,21 +40,64 @@ def is_valid_post(post):
             post.get('over_18') != 'true'):
         return False
     
-    # Check for banned keywords in all text fields
-    for value in post.values():
-        if isinstance(value, str):
-            text = value.lower()
-            if any(keyword in text for keyword in BANNED_KEYWORDS):
-                return False
+    # Check for banned keywords in all text fields (NUL never appears in a keyword,
+    # so joining cannot create a match across fields)
+    text = '\0'.join(value for value in post.values() if isinstance(value, str))
+    if BANNED_RE.search(text):
+        return False
     
     return True
 
-def process_csv_files():
-    archive_dir = Path('data/archive')
-    output_file = './data/posts.csv'
+
+def _checkpoint_path(shard_dir: Path, csv_file: Path) -> Path:
+    return shard_dir / f"{csv_file.stem}.done.json"
+
+
+def process_file(csv_file: Path, shard_dir: Path, fieldnames):
+    """Filter one archive CSV into its own headerless shard and record a checkpoint."""
+    shard_path = shard_dir / f"{csv_file.stem}.csv"
+    total_posts = 0
+    filtered_posts = 0
+    started = time.perf_counter()
+    with open(csv_file, 'r', encoding='utf-8', newline='') as infile, \
+            open(shard_path, 'w', encoding='utf-8', newline='') as outfile:
+        reader = csv.DictReader(infile)
+        writer = csv.DictWriter(outfile, fieldnames=fieldnames, extrasaction='ignore')
+        for post in reader:
+            total_posts += 1
+            if is_valid_post(post):
+                writer.writerow(post)
+                filtered_posts += 1
+            if total_posts % PROGRESS_EVERY == 0:
+                rate = total_posts / max(time.perf_counter() - started, 1e-9)
+                print(f"[{csv_file.name}] processed {total_posts:,}, kept {filtered_posts:,} ({rate:,.0f} rows/sec)",
+                      flush=True)
+
+    elapsed = time.perf_counter() - started
+    result = {'file': csv_file.name, 'total': total_posts, 'kept': filtered_posts, 'seconds': elapsed}
+    with open(_checkpoint_path(shard_dir, csv_file), 'w', encoding='utf-8') as f:
+        json.dump(result, f)
+    return result
+
+
+def merge_shards(csv_files, shard_dir: Path, output_file: str, fieldnames):
+    with open(output_file, 'w', encoding='utf-8', newline='') as outfile:
+        csv.DictWriter(outfile, fieldnames=fieldnames).writeheader()
+        for csv_file in csv_files:
+            with open(shard_dir / f"{csv_file.stem}.csv", 'r', encoding='utf-8', newline='') as shard:
+                shutil.copyfileobj(shard, outfile)
+
+
+def process_csv_files(archive_dir='data/archive', output_file='./data/posts.csv', workers=None, max_files=None,
+                      parquet_dir=None, parquet_append=False):
+    archive_dir = Path(archive_dir)
+    shard_dir = archive_dir / 'shards'
+    shard_dir.mkdir(exist_ok=True)
     
     # Get all CSV files in the archive directory
     csv_files = sorted(archive_dir.glob('*.csv'))
+    if max_files is not None:
+        csv_files = csv_files[:max_files]
     
     if not csv_files:
         print("No CSV files found in archive directory")
@@ -51,35 +108,59 @@ def process_csv_files():
         reader = csv.DictReader(f)
         fieldnames = reader.fieldnames
     
-    # Process all files
-    total_posts = 0
-    filtered_posts = 0
-    
-    with open(output_file, 'w', encoding='utf-8', newline='') as outfile:
-        writer = csv.DictWriter(outfile, fieldnames=fieldnames)
-        writer.writeheader()
-        
-        for csv_file in csv_files[:1]: #! limit to 1 file 
-            print(f"Processing {csv_file.name}...")
-            
-            with open(csv_file, 'r', encoding='utf-8') as infile:
-                reader = csv.DictReader(infile)
-                
-                for post in reader:
-                    total_posts += 1
-                    if is_valid_post(post):
-                        writer.writerow(post)
-                        filtered_posts += 1
-                    
-                    # Print progress every 100,000 posts
-                    if total_posts % 100000 == 0:
-                        print(f"Processed {total_posts:,} posts, kept {filtered_posts:,} posts")
-    
+    results = []
+    pending = []
+    for csv_file in csv_files:
+        checkpoint = _checkpoint_path(shard_dir, csv_file)
+        if checkpoint.exists():
+            with open(checkpoint, 'r', encoding='utf-8') as f:
+                results.append(json.load(f))
+            print(f"Skipping {csv_file.name} (checkpoint found)")
+        else:
+            pending.append(csv_file)
+
+    # Shard the remaining files across a process pool
+    started = time.perf_counter()
+    processed_now = 0
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        futures = {pool.submit(process_file, f, shard_dir, fieldnames): f for f in pending}
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            processed_now += result['total']
+            rate = processed_now / max(time.perf_counter() - started, 1e-9)
+            print(f"Finished {result['file']}: kept {result['kept']:,} of {result['total']:,} "
+                  f"({len(results)}/{len(csv_files)} files, {rate:,.0f} rows/sec overall)")
+
+    merge_shards(csv_files, shard_dir, output_file, fieldnames)
+    if parquet_dir:
+        csv_to_store(output_file, parquet_dir, append=parquet_append)
+
+    total_posts = sum(r['total'] for r in results)
+    filtered_posts = sum(r['kept'] for r in results)
     print(f"\nProcessing complete!")
     print(f"Total posts processed: {total_posts:,}")
     print(f"Posts kept after filtering: {filtered_posts:,}")
     print(f"Posts filtered out: {total_posts - filtered_posts:,}")
     print(f"Output saved to: {output_file}")
+    if parquet_dir:
+        print(f"Columnar store saved to: {parquet_dir}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Filter the Reddit archive CSVs into data/posts.csv')
+    parser.add_argument('--archive-dir', type=str, default='data/archive', help='Directory of archive CSVs')
+    parser.add_argument('--output', type=str, default='./data/posts.csv', help='Merged output CSV')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes (default: CPU count)')
+    parser.add_argument('--max-files', type=int, default=None, help='Only process the first N archive files')
+    parser.add_argument('--parquet', nargs='?', const=DEFAULT_STORE_DIR, default=None,
+                        help='Also write the filtered posts to the columnar post store (optional directory)')
+    parser.add_argument('--parquet-append', action='store_true',
+                        help='Add to the existing columnar store instead of replacing it')
+    return parser.parse_args()
+
 
 if __name__ == '__main__':
-    process_csv_files() 
\ No newline at end of file
+    cli_args = parse_args()
+    process_csv_files(cli_args.archive_dir, cli_args.output, cli_args.workers, cli_args.max_files,
+                      cli_args.parquet, cli_args.parquet_append)
@@ -10,6 +10,9 @@ from dotenv import load_dotenv
 from sqlalchemy import create_engine, text
 from sqlalchemy.engine import Engine
 
+# Allow importing backend modules (e.g. post_store) when run as ./data/sampleposts.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(
@@ -42,6 +45,16 @@ def parse_args() -> argparse.Namespace:
             "Pass multiple times or comma-separated (exact match)."
         ),
     )
+    parser.add_argument(
+        "--store",
+        nargs="?",
+        const="",
+        default=None,
+        help=(
+            "Sample posts from the columnar post store instead of the database "
+            "(optional store directory; requires --table posts)."
+        ),
+    )
     return parser.parse_args()
 
 
@@ -124,14 +137,23 @@ def main() -> None:
         print("--limit must be > 0", file=sys.stderr)
         sys.exit(2)
 
-    engine = get_engine()
-    table = validate_table_name(engine, args.table)
     # Normalize subreddit inputs (support repeated flags and comma-separated values)
     subs: list[str] = []
     for item in (args.subreddit or []):
         subs.extend([s.strip() for s in item.split(',') if s.strip()])
     subs = list(dict.fromkeys(subs))  # de-duplicate, preserve order
 
+    if args.store is not None:
+        if args.table != "posts":
+            print("--store only holds posts; use --table posts", file=sys.stderr)
+            sys.exit(2)
+        from post_store import DEFAULT_STORE_DIR, sample_posts
+        rows = sample_posts(args.limit, args.store or DEFAULT_STORE_DIR, subreddits=subs or None)
+        dump_rows_as_json(rows, args.out)
+        return
+
+    engine = get_engine()
+    table = validate_table_name(engine, args.table)
     rows = fetch_sample(engine, table, args.limit, subreddits=subs or None)
     dump_rows_as_json(rows, args.out)
 
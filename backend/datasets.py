@@ -1,12 +1,14 @@
 import os
 import json
+import threading
 from datetime import datetime
-from typing import Dict, List
+from typing import Dict, List, Optional
 
 from flask import Blueprint, jsonify, request, send_from_directory
 from sqlalchemy.sql import text
 
 from db import db_session
+from fs_cache import response_cache
 
 
 datasets = Blueprint('datasets', __name__)
@@ -38,6 +40,14 @@ def _categories_file_path() -> str:
     return os.path.join(_datasets_dir(), "_categories.json")
 
 
+def _counts_file_path() -> str:
+    return os.path.join(_datasets_dir(), "_counts.json")
+
+
+# In-process lock to serialize read-modify-write cycles on the counts sidecar
+_COUNTS_LOCK = threading.Lock()
+
+
 def _read_categories() -> List[str]:
     path = _categories_file_path()
     if not os.path.exists(path):
@@ -74,6 +84,58 @@ def _write_category_items(category: str, items: List[Dict]) -> None:
     path = _category_file_path(category)
     with open(path, 'w', encoding='utf-8') as f:
         json.dump(items, f, ensure_ascii=False, indent=2)
+    with _COUNTS_LOCK:
+        counts = _read_counts()
+        counts[category] = {'count': len(items), 'version': _file_version(path)}
+        _write_counts(counts)
+
+
+def _file_version(path: str) -> Optional[List[int]]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+def _read_counts() -> Dict[str, Dict]:
+    """The _counts.json sidecar: {category: {count, version}} where version is the file's [mtime_ns, size]."""
+    try:
+        with open(_counts_file_path(), 'r', encoding='utf-8') as f:
+            data = json.load(f)
+            if isinstance(data, dict):
+                return data
+    except Exception:
+        pass
+    return {}
+
+
+def _write_counts(counts: Dict[str, Dict]) -> None:
+    path = _counts_file_path()
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(counts, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def _category_counts(categories: List[str]) -> Dict[str, int]:
+    """Item counts from the sidecar; only files changed outside this module are parsed again."""
+    result: Dict[str, int] = {}
+    with _COUNTS_LOCK:
+        counts = _read_counts()
+        changed = False
+        for cat in categories:
+            version = _file_version(_category_file_path(cat))
+            entry = counts.get(cat)
+            if isinstance(entry, dict) and entry.get('version') == version:
+                result[cat] = int(entry.get('count') or 0)
+                continue
+            result[cat] = len(_read_category_items(cat))
+            counts[cat] = {'count': result[cat], 'version': version}
+            changed = True
+        if changed:
+            _write_counts(counts)
+    return result
 
 
 @datasets.route('/ui')
@@ -174,13 +236,15 @@ def annotate():
 
 @datasets.route('/stats')
 def stats():
-    counts: Dict[str, int] = {}
-    cats = _read_categories()
-    for cat in cats:
-        items = _read_category_items(cat)
-        counts[cat] = len(items)
-    target = 500
-    return jsonify({'counts': counts, 'target': target, 'categories': cats})
+    def watched() -> List[str]:
+        return [_categories_file_path()] + [_category_file_path(cat) for cat in _read_categories()]
+
+    def build() -> Dict:
+        cats = _read_categories()
+        target = 500
+        return {'counts': _category_counts(cats), 'target': target, 'categories': cats}
+
+    return response_cache.response(('datasets_stats', _datasets_dir()), watched, build)
 
 
 @datasets.route('/categories', methods=['GET', 'POST', 'DELETE'])
@@ -1,5 +1,5 @@
 from datetime import datetime
-from sqlalchemy import Column, Integer, BigInteger, String, Boolean, DateTime, ForeignKey, Text, UniqueConstraint, Float
+from sqlalchemy import Column, Integer, BigInteger, String, Boolean, DateTime, ForeignKey, Text, UniqueConstraint, Float, Index, text
 from sqlalchemy.orm import declarative_base, relationship
 
 Base = declarative_base()
@@ -28,6 +28,8 @@ class Post(Base):
     link_flair_text = Column(String(128), nullable=True)
     is_ai = Column(Boolean, default=False, nullable=False)
     random_key = Column(BigInteger, index=True, nullable=False)
+    # Signed 64-bit md5 prefix of title (post_identity.title_hash) for legacy title lookups
+    title_hash = Column(BigInteger, index=True, nullable=True)
 
     interactions = relationship("Interaction", back_populates="post", cascade="all, delete-orphan")
     served = relationship("ServedPost", back_populates="post", cascade="all, delete-orphan")
@@ -47,6 +49,8 @@ class Interaction(Base):
     post = relationship("Post", back_populates="interactions")
 
     __table_args__ = (
+        # Rebuilt as NULLS NOT DISTINCT by db.seed.ensure_interactions_nulls_not_distinct
+        # so interaction_writer's ON CONFLICT skips repeats
         UniqueConstraint('user_id', 'post_id', 'humor_id', 'ai_id', 'action', name='uq_user_target_action'),
     )
 
@@ -78,6 +82,43 @@ class AiGeneratedPost(Base):
     model_name = Column(String(128), nullable=True)
     prompt = Column(Text, nullable=True)
     generated_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    # Dedup fingerprints (see dedup.py): normalized-text SHA-1 and 64-bit SimHash
+    content_hash = Column(String(40), index=True, nullable=True)
+    simhash = Column(BigInteger, nullable=True)
+    # Pool the post was generated for, "<experiment>/<prompt source>" (NULL for older rows)
+    queue_key = Column(String(256), nullable=True)
+    # Shared ready-to-serve queue (AI_QUEUE_BACKEND=db, see ai_queue.py): 'ready' or 'claimed'
+    queue_status = Column(String(16), nullable=True)
+    queued_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        # Keyset pagination for listing and export (see ai_export.py)
+        Index('ix_ai_generated_posts_generated_at_id', 'generated_at', 'id'),
+        # Archive reads restricted to one pool's posts (feed top-up)
+        Index('ix_ai_generated_posts_queue_key_id', 'queue_key', 'id'),
+        # Oldest ready posts of a queue, without scanning the archive
+        Index('ix_ai_generated_posts_ready', 'queue_key', 'id', postgresql_where=text("queue_status = 'ready'")),
+    )
+
+
+class AiQueueDemand(Base):
+    """Decayed pull rate of each shared AI post queue (see ai_queue.py)."""
+    __tablename__ = 'ai_queue_demand'
+    queue_key = Column(String(256), primary_key=True)
+    demand = Column(Float, default=0.0, nullable=False)
+    pulled = Column(BigInteger, default=0, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
+
+
+class SeedProgress(Base):
+    """How far the initial load of a table from its source files got (see db/seed.py)."""
+    __tablename__ = 'seed_progress'
+    name = Column(String(64), primary_key=True)
+    source = Column(String(16), nullable=False)
+    # Source rows consumed so far, advanced in the same transaction as each loaded chunk
+    rows_done = Column(BigInteger, default=0, nullable=False)
+    completed = Column(Boolean, default=False, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
 
 
 class Experiment(Base):
@@ -1,17 +1,24 @@
 import csv
+import itertools
 import os
 import random
+import time
+from datetime import datetime
 from pathlib import Path
-from sqlalchemy import select, text
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy import select, text, update
 from config import DATABASE_URL
 from db import engine, db_session
-from db.models import Base, Post, ServedPost, Experiment, HumorPost
+from db.models import Base, Post, ServedPost, Experiment, HumorPost, SeedProgress
+from sampling import get_humor_pool, get_post_sampler
+from post_identity import title_hash
+from post_store import DEFAULT_STORE_DIR, STORE_COLUMNS, iter_posts, store_exists
 
 
 def init_db():
     Base.metadata.create_all(bind=engine)
     ensure_interactions_schema()
+    ensure_ai_posts_schema()
+    ensure_posts_schema()
 
 
 def is_valid_row(row):
@@ -38,117 +45,234 @@ def is_valid_row(row):
 #     return None
 
 
-def load_posts_from_csv(limit: int | None = None, batch_size: int = 1000) -> int:
+BASE_COLUMNS = ['title', 'self_text', 'subreddit', 'over_18', 'link_flair_text', 'is_ai', 'random_key']
+POST_COLUMNS = BASE_COLUMNS + ['title_hash']
+HUMOR_COLUMNS = BASE_COLUMNS + ['image_url', 'score']
+
+
+def _chunks(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _copy_chunk(conn, table, columns, chunk) -> int:
+    """COPY a chunk into a temp staging table, then move it over with ON CONFLICT DO NOTHING."""
+    cols = ', '.join(columns)
+    conn.execute(text(
+        f"CREATE TEMP TABLE _seed_stage ON COMMIT DROP AS SELECT {cols} FROM {table.name} WITH NO DATA"
+    ))
+    cursor = conn.connection.driver_connection.cursor()
+    with cursor.copy(f"COPY _seed_stage ({cols}) FROM STDIN") as copy:
+        for row in chunk:
+            copy.write_row([row[c] for c in columns])
+    result = conn.execute(text(
+        f"INSERT INTO {table.name} ({cols}) SELECT {cols} FROM _seed_stage ON CONFLICT DO NOTHING"
+    ))
+    return result.rowcount
+
+
+def _insert_chunk(conn, table, columns, chunk) -> int:
+    """Multi-row INSERT for drivers without COPY support."""
+    dialect = engine.dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        stmt = dialect_insert(table).on_conflict_do_nothing()
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        stmt = dialect_insert(table).on_conflict_do_nothing()
+    else:
+        stmt = table.insert()
+    result = conn.execute(stmt, chunk)
+    return result.rowcount if result.rowcount is not None and result.rowcount >= 0 else len(chunk)
+
+
+def bulk_insert(table, rows, columns, chunk_size: int = 5000, label: str = 'rows',
+                marker: str | None = None) -> int:
+    """Stream row dicts into a table in chunks, one transaction per chunk.
+
+    Uses COPY FROM STDIN on PostgreSQL via psycopg, multi-row INSERTs elsewhere.
+    Rows that hit a unique constraint are skipped. Prints rows/sec progress.
+    With marker, each chunk's transaction also advances that seed_progress row
+    by the rows it consumed, so the marker always matches what was committed.
+    """
+    use_copy = engine.dialect.name == 'postgresql' and engine.dialect.driver == 'psycopg'
+    write_chunk = _copy_chunk if use_copy else _insert_chunk
+    inserted = 0
+    started = time.perf_counter()
+    for chunk in _chunks(rows, chunk_size):
+        with engine.begin() as conn:
+            inserted += write_chunk(conn, table, columns, chunk)
+            if marker:
+                conn.execute(
+                    update(SeedProgress)
+                    .where(SeedProgress.name == marker)
+                    .values(rows_done=SeedProgress.rows_done + len(chunk), updated_at=datetime.utcnow())
+                )
+        elapsed = max(time.perf_counter() - started, 1e-9)
+        print(f"Inserted {inserted} {label} ({inserted / elapsed:,.0f} rows/sec)")
+    return inserted
+
+
+def seed_resume_point(name: str, existing: int):
+    """(source, rows already loaded) for an unfinished seed of name, or None once it is done.
+
+    A table that has rows but no seed_progress entry was seeded before progress
+    was recorded, in a single transaction, and counts as done.
+    """
+    with db_session() as session:
+        progress = session.get(SeedProgress, name)
+        if progress is None:
+            return None if existing else (None, 0)
+        if progress.completed:
+            return None
+        return progress.source, progress.rows_done
+
+
+def _start_seed(name: str, source: str) -> None:
+    with db_session() as session:
+        if session.get(SeedProgress, name) is None:
+            session.add(SeedProgress(name=name, source=source, rows_done=0, completed=False,
+                                     updated_at=datetime.utcnow()))
+
+
+def _finish_seed(name: str) -> None:
+    with db_session() as session:
+        session.execute(
+            update(SeedProgress)
+            .where(SeedProgress.name == name)
+            .values(completed=True, updated_at=datetime.utcnow())
+        )
+
+
+def _load_seed(table, rows, columns, batch_size: int, label: str,
+               marker: str | None, source: str, skip: int) -> int:
+    """bulk_insert rows after the first skip, recording progress under marker if given."""
+    if marker:
+        _start_seed(marker, source)
+    inserted = bulk_insert(table, itertools.islice(rows, skip, None), columns,
+                           chunk_size=batch_size, label=label, marker=marker)
+    if marker:
+        _finish_seed(marker)
+    return inserted
+
+
+def _post_rows(raw_rows, limit: int | None = None):
+    emitted = 0
+    for row in raw_rows:
+        if limit is not None and emitted >= limit:
+            break
+        if not is_valid_row(row):
+            continue
+        emitted += 1
+        title = (row.get('title') or '')[:10000]
+        yield {
+            'title': title,
+            'self_text': (row.get('self_text') or '')[:100000],
+            'subreddit': row.get('subreddit'),
+            'over_18': str(row.get('over_18', 'false')).lower() == 'true',
+            'link_flair_text': row.get('link_flair_text'),
+            'is_ai': False,
+            'random_key': random.getrandbits(63),
+            'title_hash': title_hash(title),
+        }
+
+
+def _iter_post_rows(csv_path, limit: int | None = None):
+    with open(csv_path, 'r', encoding='utf-8', newline='') as f:
+        yield from _post_rows(csv.DictReader(f), limit)
+
+
+def load_posts_from_csv(limit: int | None = None, batch_size: int = 5000,
+                        marker: str | None = None, skip: int = 0) -> int:
+    """Seed posts from posts.csv, skipping the first skip valid rows."""
     csv_path = './data/posts.csv' #_find_posts_csv()
-    if not csv_path:
+    if not os.path.exists(csv_path):
         print("No posts.csv found. Skipping seed.")
         return 0
 
     print(f"Seeding posts from {csv_path}")
-    inserted = 0
-    with open(csv_path, 'r', encoding='utf-8', newline='') as f:
-        reader = csv.DictReader(f)
-        batch: list[Post] = []
-        with db_session() as session:
-            for row in reader:
-                if limit is not None and inserted >= limit:
-                    break
-                if not is_valid_row(row):
-                    continue
-                try:
-                    post = Post(
-                        title=row.get('title', '')[:10000],
-                        self_text=row.get('self_text', '')[:100000],
-                        subreddit=row.get('subreddit'),
-                        over_18=str(row.get('over_18', 'false')).lower() == 'true',
-                        link_flair_text=row.get('link_flair_text'),
-                        is_ai=False,
-                        random_key=random.getrandbits(63),
-                    )
-                    session.add(post)
-                    session.flush()  # catch duplicates early (unique post_id)
-                    inserted += 1
-                except IntegrityError:
-                    session.rollback()
-                    # Duplicate post_id (or other constraint) — skip
-                    continue
-
-                if inserted % batch_size == 0:
-                    print(f"Inserted {inserted} posts...")
-
+    inserted = _load_seed(Post.__table__, _iter_post_rows(csv_path, limit), POST_COLUMNS,
+                          batch_size, 'posts', marker, 'csv', skip)
     print(f"Finished seeding. Inserted {inserted} posts.")
     return inserted
 
 
-def seed_humor_posts_if_empty():
-    """Load humor posts from CSVs into humorposts table if empty."""
-    base_dir = Path(__file__).resolve().parent.parent / 'data'
-    text_csv = base_dir / 'humor_text_posts.csv'
-    image_csv = base_dir / 'humor_image_posts.csv'
-
-    with db_session() as session:
-        existing = session.query(HumorPost).count()
-        if existing > 0:
-            print(f"DB has {existing} humor posts; skipping humor seed")
-            return 0
+def load_posts_from_store(limit: int | None = None, batch_size: int = 5000,
+                          subreddits: list[str] | None = None,
+                          marker: str | None = None, skip: int = 0) -> int:
+    """Seed posts from the columnar post store, optionally only some subreddits."""
+    print(f"Seeding posts from {DEFAULT_STORE_DIR}")
+    raw_rows = iter_posts(DEFAULT_STORE_DIR, subreddits=subreddits, columns=STORE_COLUMNS)
+    inserted = _load_seed(Post.__table__, _post_rows(raw_rows, limit), POST_COLUMNS,
+                          batch_size, 'posts', marker, 'store', skip)
+    print(f"Finished seeding. Inserted {inserted} posts.")
+    return inserted
 
-    inserted = 0
 
+def _iter_humor_rows(csv_path, with_images: bool):
     def parse_score(value):
         try:
             return int(value)
         except Exception:
             return None
 
-    def insert_text_rows(session):
-        nonlocal inserted
-        if text_csv.exists():
-            with open(text_csv, 'r', encoding='utf-8', newline='') as f:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    title = (row.get('title') or '').strip()[:10000]
-                    subreddit = (row.get('subreddit') or None)
-                    hp = HumorPost(
-                        title=title,
-                        self_text=(row.get('text') or '').strip()[:100000],
-                        subreddit=subreddit,
-                        over_18=False,
-                        link_flair_text=None,
-                        is_ai=False,
-                        random_key=random.getrandbits(63),
-                        image_url=None,
-                        score=parse_score(row.get('score')),
-                    )
-                    session.add(hp)
-                    inserted += 1
-
-    def insert_image_rows(session):
-        nonlocal inserted
-        if image_csv.exists():
-            with open(image_csv, 'r', encoding='utf-8', newline='') as f:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    title = (row.get('title') or '').strip()[:10000]
-                    subreddit = (row.get('subreddit') or None)
-                    image_url = (row.get('image_url') or None)
-                    hp = HumorPost(
-                        title=title,
-                        self_text=(row.get('text') or '').strip()[:100000],
-                        subreddit=subreddit,
-                        over_18=False,
-                        link_flair_text=None,
-                        is_ai=False,
-                        random_key=random.getrandbits(63),
-                        image_url=image_url,
-                        score=parse_score(row.get('score')),
-                    )
-                    session.add(hp)
-                    inserted += 1
+    if not csv_path.exists():
+        return
+    with open(csv_path, 'r', encoding='utf-8', newline='') as f:
+        reader = csv.DictReader(f)
+        for row in reader:
+            yield {
+                'title': (row.get('title') or '').strip()[:10000],
+                'self_text': (row.get('text') or '').strip()[:100000],
+                'subreddit': (row.get('subreddit') or None),
+                'over_18': False,
+                'link_flair_text': None,
+                'is_ai': False,
+                'random_key': random.getrandbits(63),
+                'image_url': (row.get('image_url') or None) if with_images else None,
+                'score': parse_score(row.get('score')),
+            }
+
+
+def seed_humor_posts_if_empty(batch_size: int = 5000):
+    """Load humor posts from CSVs into humorposts table, resuming an interrupted load.
+
+    Progress is kept in seed_progress under 'humorposts'; a resumed load skips
+    the CSV rows that marker says were already committed.
+    """
+    base_dir = Path(__file__).resolve().parent.parent / 'data'
+    text_csv = base_dir / 'humor_text_posts.csv'
+    image_csv = base_dir / 'humor_image_posts.csv'
 
     with db_session() as session:
-        insert_text_rows(session)
-        insert_image_rows(session)
-
+        existing = session.query(HumorPost).count()
+    resume = seed_resume_point('humorposts', existing)
+    if resume is None:
+        print(f"DB has {existing} humor posts; skipping humor seed")
+        return 0
+    if not text_csv.exists() and not image_csv.exists():
+        print("No humor CSVs found. Skipping humor seed.")
+        return 0
+    skip = resume[1]
+    if skip:
+        print(f"Resuming humor seed after {skip} rows")
+
+    rows = itertools.chain(
+        _iter_humor_rows(text_csv, with_images=False),
+        _iter_humor_rows(image_csv, with_images=True),
+    )
+    inserted = _load_seed(HumorPost.__table__, rows, HUMOR_COLUMNS,
+                          batch_size, 'humor posts', 'humorposts', 'csv', skip)
+
+    if inserted:
+        # New rows change the eligible humor candidates
+        get_humor_pool().invalidate()
     print(f"Finished seeding humorposts. Inserted {inserted} rows.")
     return inserted
 
@@ -185,22 +309,106 @@ def ensure_interactions_schema():
                 pass
     except Exception as e:
         print(f"ensure_interactions_schema: {e}")
+    ensure_interactions_nulls_not_distinct()
 
 
+def ensure_interactions_nulls_not_distinct():
+    """Make uq_user_target_action treat NULL ids as equal (Postgres 15+).
+
+    Every interaction leaves two of post_id/humor_id/ai_id NULL, so with the
+    default NULLS DISTINCT the constraint never matches and ON CONFLICT cannot
+    skip repeats. Existing duplicate rows are left alone: the constraint is only
+    rebuilt when there are none.
+    """
+    try:
+        with engine.begin() as conn:
+            nulls_not_distinct = conn.execute(text(
+                "SELECT indnullsnotdistinct FROM pg_index WHERE indexrelid = 'uq_user_target_action'::regclass"
+            )).scalar()
+            if nulls_not_distinct:
+                return
+            duplicates = conn.execute(text(
+                "SELECT count(*) FROM (SELECT 1 FROM interactions "
+                "GROUP BY user_id, post_id, humor_id, ai_id, action HAVING count(*) > 1) d"
+            )).scalar()
+            if duplicates:
+                print(f"ensure_interactions_nulls_not_distinct: {duplicates} duplicated interactions; "
+                      "keeping NULLS DISTINCT until they are removed")
+                return
+            conn.execute(text("ALTER TABLE interactions DROP CONSTRAINT uq_user_target_action"))
+            conn.execute(text(
+                "ALTER TABLE interactions ADD CONSTRAINT uq_user_target_action "
+                "UNIQUE NULLS NOT DISTINCT (user_id, post_id, humor_id, ai_id, action)"
+            ))
+            print("Rebuilt uq_user_target_action with NULLS NOT DISTINCT")
+    except Exception as e:
+        print(f"ensure_interactions_nulls_not_distinct: {e}")
+
+
+def ensure_ai_posts_schema():
+    """Ensure ai_generated_posts has the dedup fingerprint and queue columns and their indexes."""
+    try:
+        with engine.begin() as conn:
+            conn.execute(text("ALTER TABLE ai_generated_posts ADD COLUMN IF NOT EXISTS content_hash VARCHAR(40)"))
+            conn.execute(text("ALTER TABLE ai_generated_posts ADD COLUMN IF NOT EXISTS simhash BIGINT"))
+            conn.execute(text("ALTER TABLE ai_generated_posts ADD COLUMN IF NOT EXISTS queue_key VARCHAR(256)"))
+            conn.execute(text("ALTER TABLE ai_generated_posts ADD COLUMN IF NOT EXISTS queue_status VARCHAR(16)"))
+            conn.execute(text("ALTER TABLE ai_generated_posts ADD COLUMN IF NOT EXISTS queued_at TIMESTAMP"))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS ix_ai_generated_posts_content_hash ON ai_generated_posts (content_hash)"))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS ix_ai_generated_posts_generated_at_id ON ai_generated_posts (generated_at, id)"))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS ix_ai_generated_posts_queue_key_id ON ai_generated_posts (queue_key, id)"))
+            conn.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_ai_generated_posts_ready ON ai_generated_posts (queue_key, id) "
+                "WHERE queue_status = 'ready'"
+            ))
+    except Exception as e:
+        print(f"ensure_ai_posts_schema: {e}")
+
+
+def ensure_posts_schema():
+    """Ensure posts has an indexed title_hash and fill it in for older rows."""
+    try:
+        with engine.begin() as conn:
+            conn.execute(text("ALTER TABLE posts ADD COLUMN IF NOT EXISTS title_hash BIGINT"))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS ix_posts_title_hash ON posts (title_hash)"))
+            # Same value as post_identity.title_hash: first 8 bytes of md5(title) as a signed bigint
+            result = conn.execute(text(
+                "UPDATE posts SET title_hash = ('x' || substr(md5(title), 1, 16))::bit(64)::bigint "
+                "WHERE title_hash IS NULL"
+            ))
+            if result.rowcount:
+                print(f"Backfilled title_hash for {result.rowcount} posts")
+    except Exception as e:
+        print(f"ensure_posts_schema: {e}")
+
 
 def seed_if_empty():
     init_db()
     with db_session() as session:
         count = session.query(Post).count()
-        if count == 0:
-            # Attempt to seed from CSV
-            try:
-                added = load_posts_from_csv()
-                print(f"Seeded {added} posts from CSV.")
-            except Exception as e:
-                print(f"Automatic CSV seed failed: {e}")
-        else:
-            print(f"DB has {count} posts; skipping seed")
+    resume = seed_resume_point('posts', count)
+    if resume is None:
+        print(f"DB has {count} posts; skipping seed")
+    else:
+        # Attempt to seed from the columnar store, falling back to CSV; a resumed
+        # seed keeps the source it started from so the skipped rows line up
+        source, skip = resume
+        if source is None:
+            source = 'store' if store_exists() else 'csv'
+        if skip:
+            print(f"Resuming post seed from {source} after {skip} rows")
+        try:
+            if source == 'store':
+                added = load_posts_from_store(marker='posts', skip=skip)
+            else:
+                added = load_posts_from_csv(marker='posts', skip=skip)
+            print(f"Seeded {added} posts.")
+            sampler = get_post_sampler()
+            if added and hasattr(sampler, 'invalidate'):
+                # New rows are not in an already built permutation
+                sampler.invalidate()
+        except Exception as e:
+            print(f"Automatic seed failed: {e}")
 
     seed_humor_posts_if_empty()
 
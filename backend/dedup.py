@@ -0,0 +1,181 @@
+import hashlib
+import re
+import threading
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import select, update
+
+from config import DEDUP_SIMHASH_THRESHOLD
+from db import db_session
+from db.models import AiGeneratedPost
+
+SPECIAL_TOKEN_RE = re.compile(r'<\s*/?\s*[a-z_|]+\s*>', re.IGNORECASE)
+WORD_RE = re.compile(r'[a-z0-9]+')
+SHINGLE_SIZE = 3
+MASK64 = (1 << 64) - 1
+# Largest threshold banded lookup supports: threshold + 1 bands of at least 4 bits
+MAX_SIMHASH_THRESHOLD = 15
+
+
+def _words(text: str) -> List[str]:
+    return WORD_RE.findall(SPECIAL_TOKEN_RE.sub(' ', text or '').lower())
+
+
+def post_text(title: str, self_text: str) -> str:
+    return f"{title or ''}\n{self_text or ''}"
+
+
+def content_hash(title: str, self_text: str) -> str:
+    """Hash of the normalized post text (case, punctuation and whitespace ignored)."""
+    normalized = ' '.join(_words(title)) + '\n' + ' '.join(_words(self_text))
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+
+
+def simhash(title: str, self_text: str) -> int:
+    """64-bit SimHash over word shingles, as a signed int so it fits a BIGINT column."""
+    words = _words(post_text(title, self_text))
+    if len(words) >= SHINGLE_SIZE:
+        shingles = [' '.join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)]
+    else:
+        shingles = [' '.join(words)]
+    votes = [0] * 64
+    for shingle in shingles:
+        h = int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'big')
+        for bit in range(64):
+            votes[bit] += 1 if (h >> bit) & 1 else -1
+    value = 0
+    for bit in range(64):
+        if votes[bit] > 0:
+            value |= 1 << bit
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def hamming(a: int, b: int) -> int:
+    return bin((a ^ b) & MASK64).count('1')
+
+
+@dataclass
+class DedupResult:
+    duplicate: bool
+    kind: Optional[str]  # 'exact' or 'near' when duplicate
+    match_id: Optional[int]
+    content_hash: str
+    simhash: int
+
+
+class DedupIndex:
+    """Exact and near-duplicate index over generated posts.
+
+    Exact duplicates share a content hash. Near duplicates have SimHashes within
+    threshold bits of each other, found through banded LSH: the 64 bits are
+    split into threshold + 1 bands, so by pigeonhole any two hashes within the
+    threshold agree exactly on at least one band and land in a shared bucket.
+    A negative threshold disables near-duplicate detection. The index is loaded
+    from ai_generated_posts on first use, backfilling missing fingerprints.
+    """
+
+    def __init__(self, threshold: int = DEDUP_SIMHASH_THRESHOLD):
+        if threshold > MAX_SIMHASH_THRESHOLD:
+            # Fewer bands than threshold + 1 would lose the pigeonhole guarantee
+            raise ValueError(f"SimHash threshold {threshold} is above the supported {MAX_SIMHASH_THRESHOLD}")
+        self.threshold = threshold
+        self.bands = max(threshold + 1, 1)
+        self._band_bits = 64 // self.bands
+        self._hashes: Dict[str, Optional[int]] = {}
+        self._buckets: List[Dict[int, List[Tuple[int, Optional[int]]]]] = [defaultdict(list) for _ in range(self.bands)]
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._stats = {'checked': 0, 'unique': 0, 'exact_duplicates': 0, 'near_duplicates': 0}
+
+    def _band_keys(self, value: int) -> List[int]:
+        unsigned = value & MASK64
+        mask = (1 << self._band_bits) - 1
+        return [(unsigned >> (band * self._band_bits)) & mask for band in range(self.bands)]
+
+    def _add(self, post_id: Optional[int], digest: str, sim: int) -> None:
+        self._hashes.setdefault(digest, post_id)
+        if self.threshold >= 0:
+            for band, key in enumerate(self._band_keys(sim)):
+                self._buckets[band][key].append((sim, post_id))
+
+    def _near(self, sim: int) -> Optional[Tuple[int, Optional[int]]]:
+        if self.threshold < 0:
+            return None
+        for band, key in enumerate(self._band_keys(sim)):
+            for other, post_id in self._buckets[band].get(key, ()):
+                if hamming(sim, other) <= self.threshold:
+                    return other, post_id
+        return None
+
+    def load(self) -> None:
+        """Index every archived post, filling in fingerprints for rows written before they existed."""
+        with self._lock:
+            if self._loaded:
+                return
+            backfill = []
+            with db_session() as session:
+                rows = session.execute(select(
+                    AiGeneratedPost.id, AiGeneratedPost.title, AiGeneratedPost.self_text,
+                    AiGeneratedPost.content_hash, AiGeneratedPost.simhash,
+                )).all()
+                for post_id, title, self_text, digest, sim in rows:
+                    if digest is None or sim is None:
+                        digest, sim = content_hash(title, self_text), simhash(title, self_text)
+                        backfill.append({'id': post_id, 'content_hash': digest, 'simhash': sim})
+                    self._add(post_id, digest, sim)
+                if backfill:
+                    session.execute(update(AiGeneratedPost), backfill)
+            self._loaded = True
+            print(f"[dedup] Indexed {len(rows)} archived AI posts ({len(backfill)} backfilled)")
+
+    def check(self, title: str, self_text: str) -> DedupResult:
+        """Check a post and, if it is new, reserve its fingerprint so a concurrent copy is caught."""
+        if not self._loaded:
+            try:
+                self.load()
+            except Exception as e:
+                print(f"[dedup] Failed to load index: {e}")
+                self._loaded = True
+        digest, sim = content_hash(title, self_text), simhash(title, self_text)
+        with self._lock:
+            self._stats['checked'] += 1
+            if digest in self._hashes:
+                self._stats['exact_duplicates'] += 1
+                return DedupResult(True, 'exact', self._hashes[digest], digest, sim)
+            near = self._near(sim)
+            if near is not None:
+                self._stats['near_duplicates'] += 1
+                return DedupResult(True, 'near', near[1], digest, sim)
+            self._stats['unique'] += 1
+            self._add(None, digest, sim)
+        return DedupResult(False, None, None, digest, sim)
+
+    def assign(self, result: DedupResult, post_id: int) -> None:
+        """Record the archive id of a post reserved by check()."""
+        with self._lock:
+            if self._hashes.get(result.content_hash) is None:
+                self._hashes[result.content_hash] = post_id
+
+    def metrics(self) -> Dict[str, float]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['indexed'] = len(self._hashes)
+        duplicates = stats['exact_duplicates'] + stats['near_duplicates']
+        stats['threshold_bits'] = self.threshold
+        stats['dupe_rate'] = duplicates / stats['checked'] if stats['checked'] else 0.0
+        return stats
+
+
+_index: Optional[DedupIndex] = None
+_index_lock = threading.Lock()
+
+
+def get_dedup_index() -> DedupIndex:
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = DedupIndex()
+    return _index
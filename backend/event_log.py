@@ -0,0 +1,390 @@
+"""Write-behind pipeline for interaction events.
+
+With INTERACTION_WRITE_BEHIND on, click handlers call append(): the event gets
+a sequence number, is written as one JSON line to the current segment file of
+INTERACTION_LOG_DIR and is pushed onto an in-memory buffer. A syncer thread
+fsyncs the segment every INTERACTION_LOG_SYNC_MS (group commit), and a flusher
+thread drains the buffer every INTERACTION_FLUSH_INTERVAL seconds through
+interaction_writer.write_events, one INSERT per batch, then counts the new rows
+in the experiment stats.
+
+A batch that fails while the DB is reachable is bisected; events that fail on
+their own are appended to dead_letter.log instead of blocking the log.
+
+After each successful flush the last flushed sequence number is checkpointed
+and fully flushed segments are deleted. On startup, events after the checkpoint
+are replayed from the segments. Replay is safe to repeat: interactions that
+were already written come back as duplicates and are not counted again.
+
+Only one process can own the log directory (an flock on it); others write
+synchronously.
+"""
+import atexit
+import json
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from config import (
+    INTERACTION_LOG_DIR,
+    INTERACTION_FLUSH_INTERVAL,
+    INTERACTION_FLUSH_MAX_BATCH,
+    INTERACTION_BUFFER_SIZE,
+    INTERACTION_LOG_SYNC_MS,
+)
+
+SEGMENT_MAX_BYTES = 16 * 1024 * 1024
+CHECKPOINT_FILE = 'checkpoint'
+# Events that failed on their own while the DB was reachable, one JSON record per line
+DEAD_LETTER_FILE = 'dead_letter.log'
+LOCK_FILE = 'lock'
+
+# Post payload fields needed to resolve the target later (see post_identity.parse_ref)
+EVENT_POST_FIELDS = (
+    'post_id', 'humor_id', 'id', 'is_ai', 'title', 'self_text', 'subreddit', 'over_18', 'link_flair_text',
+)
+
+
+def _segment_name(first_seq: int) -> str:
+    return f"events-{first_seq:016d}.log"
+
+
+def _segment_first_seq(filename: str) -> Optional[int]:
+    if not (filename.startswith('events-') and filename.endswith('.log')):
+        return None
+    try:
+        return int(filename[len('events-'):-len('.log')])
+    except ValueError:
+        return None
+
+
+class InteractionEventLog:
+    """Durable append-only log plus buffer of interaction events awaiting the DB."""
+
+    def __init__(self, log_dir: str = INTERACTION_LOG_DIR, buffer_size: int = INTERACTION_BUFFER_SIZE,
+                 flush_interval: float = INTERACTION_FLUSH_INTERVAL, max_batch: int = INTERACTION_FLUSH_MAX_BATCH,
+                 sync_ms: float = INTERACTION_LOG_SYNC_MS):
+        self.log_dir = log_dir
+        self.buffer_size = max(1, buffer_size)
+        self.flush_interval = flush_interval
+        self.max_batch = max(1, max_batch)
+        self.sync_interval = sync_ms / 1000.0
+        self._buffer: deque = deque()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._fd: Optional[int] = None
+        self._segment_path: Optional[str] = None
+        self._segment_bytes = 0
+        self._dirty = False
+        # Closed segments still holding unflushed events: (path, last seq)
+        self._closed: List[Tuple[str, int]] = []
+        self._next_seq = 1
+        self._checkpoint = 0
+        self._lock_fd: Optional[int] = None
+        self._started = False
+        self._stats = {'appended': 0, 'flushed': 0, 'flushes': 0, 'replayed': 0, 'failed_flushes': 0, 'overflow': 0,
+                       'dead_lettered': 0}
+
+    # Startup and replay
+
+    def start(self) -> bool:
+        """Take ownership of the log directory, replay leftovers and start the threads.
+
+        Returns False if another process owns the directory.
+        """
+        os.makedirs(self.log_dir, exist_ok=True)
+        import fcntl
+        lock_fd = os.open(os.path.join(self.log_dir, LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(lock_fd)
+            print(f"[events] {self.log_dir} is owned by another process; writing interactions synchronously")
+            return False
+        self._lock_fd = lock_fd
+        self._checkpoint = self._read_checkpoint()
+        self._replay()
+        self._open_segment()
+        threading.Thread(target=self._flush_loop, daemon=True).start()
+        threading.Thread(target=self._sync_loop, daemon=True).start()
+        atexit.register(self.close)
+        self._started = True
+        return True
+
+    def _read_checkpoint(self) -> int:
+        try:
+            with open(os.path.join(self.log_dir, CHECKPOINT_FILE), 'r') as f:
+                return int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def _write_checkpoint(self, seq: int) -> None:
+        path = os.path.join(self.log_dir, CHECKPOINT_FILE)
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(str(seq))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        self._checkpoint = seq
+
+    def _segments(self) -> List[Tuple[int, str]]:
+        segments = []
+        for filename in os.listdir(self.log_dir):
+            first = _segment_first_seq(filename)
+            if first is not None:
+                segments.append((first, os.path.join(self.log_dir, filename)))
+        return sorted(segments)
+
+    def _replay(self) -> None:
+        """Load events after the checkpoint from old segments into the buffer."""
+        last_seq = self._checkpoint
+        for _first, path in self._segments():
+            segment_last = None
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        event = json.loads(line)
+                        seq = int(event['seq'])
+                    except (ValueError, KeyError, TypeError):
+                        # A torn final line from a crash mid-write
+                        continue
+                    segment_last = seq if segment_last is None else max(segment_last, seq)
+                    last_seq = max(last_seq, seq)
+                    if seq > self._checkpoint:
+                        self._buffer.append(event)
+                        self._stats['replayed'] += 1
+            if segment_last is None or segment_last <= self._checkpoint:
+                os.remove(path)
+            else:
+                self._closed.append((path, segment_last))
+        self._next_seq = last_seq + 1
+        if self._stats['replayed']:
+            print(f"[events] Replaying {self._stats['replayed']} interaction events from {self.log_dir}")
+
+    # Appending
+
+    def _open_segment(self) -> None:
+        self._segment_path = os.path.join(self.log_dir, _segment_name(self._next_seq))
+        self._fd = os.open(self._segment_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self._segment_bytes = 0
+
+    def _rotate(self) -> None:
+        """Close the current segment once it is large; called with _lock held."""
+        if self._segment_bytes < SEGMENT_MAX_BYTES:
+            return
+        os.fsync(self._fd)
+        os.close(self._fd)
+        self._closed.append((self._segment_path, self._next_seq - 1))
+        self._open_segment()
+
+    def append(self, user_id: int, experiment: Optional[str], aware: Optional[bool],
+               entries: Sequence[Tuple[Any, Any]]) -> bool:
+        """Log (post, action) entries for a user and queue them for the flusher.
+
+        Returns False, logging nothing, when the buffer is full or the log is
+        not running; the caller should then write synchronously.
+        """
+        if not self._started:
+            return False
+        now = time.time()
+        with self._lock:
+            if len(self._buffer) + len(entries) > self.buffer_size:
+                self._stats['overflow'] += len(entries)
+                return False
+            events = []
+            lines = []
+            for post, action in entries:
+                if isinstance(post, dict):
+                    post = {k: post[k] for k in EVENT_POST_FIELDS if k in post}
+                event = {
+                    'seq': self._next_seq,
+                    'ts': now,
+                    'user_id': user_id,
+                    'experiment': experiment,
+                    'aware': aware,
+                    'action': action,
+                    'post': post,
+                }
+                self._next_seq += 1
+                events.append(event)
+                lines.append(json.dumps(event, ensure_ascii=False, separators=(',', ':')))
+            data = ('\n'.join(lines) + '\n').encode('utf-8')
+            os.write(self._fd, data)
+            self._segment_bytes += len(data)
+            self._dirty = True
+            self._buffer.extend(events)
+            self._stats['appended'] += len(events)
+            self._rotate()
+        if len(self._buffer) >= self.max_batch:
+            self._wake.set()
+        return True
+
+    def _sync_loop(self) -> None:
+        while True:
+            time.sleep(self.sync_interval)
+            try:
+                with self._lock:
+                    if self._dirty and self._fd is not None:
+                        os.fsync(self._fd)
+                        self._dirty = False
+            except Exception as e:
+                print(f"[events] fsync failed: {e}")
+
+    # Flushing
+
+    def flush(self) -> int:
+        """Write buffered events to the DB in batches. Returns the number flushed.
+
+        A failed batch is put back while the DB is unreachable. If the DB is up,
+        the batch is bisected to find the events that cannot be written, and
+        those go to the dead-letter file so they do not block everything behind
+        them.
+        """
+        flushed_before = self._stats['flushed']
+        with self._flush_lock:
+            while True:
+                with self._lock:
+                    batch = [self._buffer.popleft() for _ in range(min(self.max_batch, len(self._buffer)))]
+                if not batch:
+                    break
+                error = self._write(batch)
+                if error is not None:
+                    print(f"[events] Flush of {len(batch)} events failed: {error}")
+                    self._stats['failed_flushes'] += 1
+                    remaining = self._isolate(batch, error) if self._db_alive() else batch
+                    if remaining:
+                        # Put the unwritten events back in order; the next flush retries them
+                        with self._lock:
+                            self._buffer.extendleft(reversed(remaining))
+                        break
+                self._stats['flushes'] += 1
+                self._checkpoint_after(batch[-1]['seq'])
+        return self._stats['flushed'] - flushed_before
+
+    def _write(self, batch: List[Dict[str, Any]]) -> Optional[str]:
+        """Write and count a batch. Returns the error message if it failed."""
+        from interaction_writer import write_events
+        try:
+            outcomes = write_events([(e['user_id'], e['post'], e['action']) for e in batch])
+        except Exception as e:
+            return str(e)
+        self._count(batch, outcomes)
+        self._stats['flushed'] += len(batch)
+        return None
+
+    def _isolate(self, batch: List[Dict[str, Any]], error: str) -> List[Dict[str, Any]]:
+        """Write what can be written of a failed batch, dead-lettering events that fail alone.
+
+        Returns the events left unhandled because the DB went away meanwhile.
+        """
+        if len(batch) == 1:
+            if not self._db_alive():
+                return batch
+            self._dead_letter(batch[0], error)
+            return []
+        mid = len(batch) // 2
+        first, second = batch[:mid], batch[mid:]
+        half_error = self._write(first)
+        if half_error is not None:
+            remaining = self._isolate(first, half_error)
+            if remaining:
+                return remaining + second
+        half_error = self._write(second)
+        if half_error is not None:
+            return self._isolate(second, half_error)
+        return []
+
+    @staticmethod
+    def _db_alive() -> bool:
+        from sqlalchemy import text
+        from db import db_session
+        try:
+            with db_session() as session:
+                session.execute(text("SELECT 1"))
+            return True
+        except Exception:
+            return False
+
+    def _dead_letter(self, event: Dict[str, Any], error: str) -> None:
+        record = {'failed_at': time.time(), 'error': error, 'event': event}
+        with open(os.path.join(self.log_dir, DEAD_LETTER_FILE), 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self._stats['dead_lettered'] += 1
+        print(f"[events] Moved event seq={event.get('seq')} to {DEAD_LETTER_FILE}: {error}")
+
+    @staticmethod
+    def _count(batch: List[Dict[str, Any]], outcomes) -> None:
+        from stats import count_interactions
+        by_context: Dict[Tuple, list] = {}
+        for event, outcome in zip(batch, outcomes):
+            key = (event['user_id'], event.get('experiment') or 'base', event.get('aware'))
+            by_context.setdefault(key, []).append(outcome)
+        for (user_id, experiment, aware), user_outcomes in by_context.items():
+            count_interactions(user_outcomes, user_id=user_id, experiment=experiment, aware=aware)
+
+    def _checkpoint_after(self, seq: int) -> None:
+        try:
+            self._write_checkpoint(seq)
+        except OSError as e:
+            print(f"[events] Failed to write checkpoint: {e}")
+            return
+        with self._lock:
+            done = [path for path, last in self._closed if last <= seq]
+            self._closed = [(path, last) for path, last in self._closed if last > seq]
+        for path in done:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _flush_loop(self) -> None:
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"[events] Error in flusher: {e}")
+
+    def close(self) -> None:
+        try:
+            self.flush()
+        finally:
+            with self._lock:
+                if self._fd is not None:
+                    os.fsync(self._fd)
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['buffered'] = len(self._buffer)
+            stats['next_seq'] = self._next_seq
+            stats['checkpoint'] = self._checkpoint
+            stats['segments'] = len(self._closed) + (1 if self._fd is not None else 0)
+        return stats
+
+
+_event_log: Optional[InteractionEventLog] = None
+_event_log_lock = threading.Lock()
+
+
+def get_event_log() -> Optional[InteractionEventLog]:
+    """The process's running event log, started on first use, or None if it cannot run."""
+    global _event_log
+    if _event_log is None:
+        with _event_log_lock:
+            if _event_log is None:
+                log = InteractionEventLog()
+                try:
+                    started = log.start()
+                except Exception as e:
+                    print(f"[events] Failed to start interaction log: {e}")
+                    started = False
+                _event_log = log if started else False
+    return _event_log or None
@@ -1,10 +1,10 @@
 import random
 from flask import Blueprint, jsonify, request, g
-from auth import require_auth
+from auth import require_auth, invalidate_user_context
 from db import db_session
 from db.models import User
 from config import AVAILABLE_EXPERIMENTS
-from generate import set_background_experiment
+from generate import prime_ai_pool
 
 experiments = Blueprint('experiments', __name__)
 
@@ -40,13 +40,16 @@ def set_experiment():
             return jsonify({'error': 'user not found'}), 404
         user.current_experiment = chosen
         user.aware_of_experiment = aware
+    # Later requests must see the new experiment, not the cached context
+    invalidate_user_context(g.current_user_id)
 
     # update request context for remainder of this request
     g.current_experiment = chosen
+    g.current_user_aware = aware
 
-    # Also update background generator's experiment so future AI posts match
+    # Start filling this experiment's AI post pool; other users' pools are unaffected
     try:
-        set_background_experiment(chosen)
+        prime_ai_pool(chosen, data.get('source'))
     except Exception:
         pass
     # response hides choice if not aware
@@ -61,15 +64,9 @@ def set_source_for_background():
     src = data.get('source')  # 'posts' or 'humorposts'
     if src not in ('posts', 'humorposts'):
         return jsonify({'error': 'invalid source'}), 400
-    # Update the prompt source used by background generator
+    # AI posts are pooled per (experiment, source), so just start filling this user's pool
     try:
-        from generate import llm_service
-        llm_service.prompt_source = 'base-humor' if src == 'humorposts' else 'base'
-        print(f"Background prompt source updated to: {llm_service.prompt_source} (requested source: {src})")
-        # ensure it re-initializes next call if needed
-        llm_service._initialized_experiment = None
+        prime_ai_pool(source=src)
         return jsonify({'ok': True})
     except Exception as e:
         return jsonify({'error': 'failed to set source', 'message': str(e)}), 500
-
-
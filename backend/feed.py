@@ -1,84 +1,20 @@
-import random
 from typing import List
 from flask import Blueprint, jsonify, request, g
-from sqlalchemy import and_, select, func
 from auth import require_auth
-from config import BATCH_SIZE, AI_POSTS_RATIO
-from db import db_session
-from db.models import Post, ServedPost, HumorPost
-from generate import get_ai_posts
-from stats import increment_ai_post_count, increment_real_post_count
+from config import BATCH_SIZE
+from db.models import Post
+from feed_composer import get_feed_composer
+from post_identity import post_ref
+from sampling import get_post_sampler, get_humor_pool
+from stats import increment_served_counts
 
 feed = Blueprint('feed', __name__)
 
 
 def sample_random_posts_excluding_served(user_id: int, limit: int, source: str) -> List[Post]:
-    # Two-phase sampling using random_key windows to avoid ORDER BY RANDOM() cost
-    # 1) try to pick a random window and fetch LIMIT rows not served
-    # 2) if insufficient, fall back to a few retries; finally fallback to ORDER BY RANDOM for small remainder
-    results: List[Post] = []
-    attempts = 5
-    with db_session() as session:
-        for _ in range(attempts):
-            # Pick a random center and clamp window within signed BIGINT range
-            center = random.getrandbits(63)  # [0, 2^63-1]
-            half_span = 1 << 59  # keep total span at 2^60
-            min_bigint = 0
-            max_bigint = (1 << 63) - 1
-            a = center - half_span if center >= half_span else min_bigint
-            b = center + half_span if center <= (max_bigint - half_span) else max_bigint
-            if source == 'humorposts':
-                q = (
-                    session.query(HumorPost)
-                    .filter(HumorPost.image_url.isnot(None))
-                    .filter(~HumorPost.image_url.like('%external-preview.redd.it%'))
-                    .order_by(func.random())
-                    .limit(limit - len(results))
-                )
-            else:
-                q = (
-                    session.query(Post)
-                    .outerjoin(ServedPost, and_(ServedPost.user_id == user_id, ServedPost.post_id == Post.id))
-                    .filter(
-                        Post.random_key.between(a, b),
-                        ServedPost.id.is_(None),
-                    )
-                    .limit(limit - len(results))
-                )
-            chunk = q.all()
-            results.extend(chunk)
-            if len(results) >= limit:
-                break
-
-        if len(results) < limit:
-            # Fallback: simple random order for the remainder
-            remainder = limit - len(results)
-            if source == 'humorposts':
-                q = (
-                    session.query(HumorPost)
-                    .filter(HumorPost.image_url.isnot(None))
-                    .filter(~HumorPost.image_url.like('%external-preview.redd.it%'))
-                    .order_by(func.random())
-                    .limit(remainder * 2)
-                )
-            else:
-                q = (
-                    session.query(Post)
-                    .outerjoin(ServedPost, and_(ServedPost.user_id == user_id, ServedPost.post_id == Post.id))
-                    .filter(ServedPost.id.is_(None))
-                    .order_by(Post.random_key)
-                    .limit(remainder * 10)
-                )
-            pool = q.all()
-            random.shuffle(pool)
-            results.extend(pool[:remainder])
-
-        # Mark served only for posts (reverting humor marking)
-        if source != 'humorposts':
-            for p in results:
-                session.add(ServedPost(user_id=user_id, post_id=p.id))
-
-    return results
+    if source == 'humorposts':
+        return get_humor_pool().sample(user_id, limit)
+    return get_post_sampler().sample(user_id, limit)
 
 
 @feed.route('/feed')
@@ -91,10 +27,13 @@ def get_feed():
         source = 'posts'
     posts = sample_random_posts_excluding_served(user_id, limit, source)
 
-    # Map to response schema
+    # Map to response schema; post_id lets interactions resolve the row by primary key
+    kind = 'humor' if source == 'humorposts' else 'post'
+
     def to_dict(p):
         return {
             'id': p.id,
+            'post_id': post_ref(kind, p.id),
             'title': p.title,
             'self_text': p.self_text,
             'subreddit': p.subreddit,
@@ -105,36 +44,36 @@ def get_feed():
         }
     resp_posts = [to_dict(p) for p in posts]
     # If source is humor, include humor_id to enable interactions
-    if request.args.get('source') == 'humorposts':
+    if source == 'humorposts':
         for i, p in enumerate(posts):
             resp_posts[i]['humor_id'] = p.id
 
-    # Interleave AI posts up to the requested ratio
-    desired_ai = max(0, min(len(posts), int(round(len(posts) * AI_POSTS_RATIO))))
-    print(f"Desired AI posts: {desired_ai}")
-    num_ai_posts = 0
-    ai_posts = get_ai_posts(desired_ai)
-    for ai in ai_posts:
-        idx = random.randint(0, len(resp_posts))
-        resp_posts.insert(idx, ai)
-        num_ai_posts += 1
-    print(f"Actual AI posts: {num_ai_posts}")
+    # AI posts at seeded slots, topped up from the archive when the pools run short
+    composition = get_feed_composer().compose(user_id, resp_posts, source)
+    print(f"AI posts: {composition.ai_count}/{composition.desired_ai} "
+          f"({composition.from_archive} from archive), ratio {composition.ai_ratio:.2f}")
 
-    # Update served counters: real posts and AI posts served
-    for _ in range(len(posts)):
-        increment_real_post_count()
-    for _ in range(len(ai_posts)):
-        increment_ai_post_count()
+    # Update served counters: real posts and AI posts served, in one write
+    increment_served_counts(real_amount=len(posts), ai_amount=composition.ai_count)
 
     return jsonify({
-        'posts': resp_posts,
-        'count': len(resp_posts),
+        'posts': composition.posts,
+        'count': len(composition.posts),
         'batchIndex': 0,
         'skippedInvalidPosts': 0,
         'totalProcessedRows': 0,
         'endOfFile': False,
         'batchSize': limit,
-        'aiPostsCount': len(ai_posts),
+        'aiPostsCount': composition.ai_count,
+        'aiPostsDesired': composition.desired_ai,
+        'aiPostsFromArchive': composition.from_archive,
+        'aiRatio': round(composition.ai_ratio, 4),
     })
 
 
+@feed.route('/feed/metrics')
+@require_auth
+def feed_metrics():
+    return jsonify(get_feed_composer().metrics())
+
+
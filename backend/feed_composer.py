@@ -0,0 +1,132 @@
+"""Assembly of a feed response from real posts and AI posts.
+
+AI posts are placed in one pass at seeded slot positions: the response is cut
+into as many equal strata as there are AI posts and each AI post lands at an
+offset within its own stratum. Positions are spread through the whole feed,
+vary between responses, and are reproducible from the seed.
+
+The target number of AI posts is round(real posts * AI_POSTS_RATIO). The
+pools are asked first; whatever they cannot cover is topped up from the
+archive (the caller's ArchiveSampler cursor over the (queue_key, id) index),
+so the ratio users see does not depend on how fast the generator keeps up.
+The top-up only takes posts generated for the same experiment and prompt
+source as the pool; if the archive has too few, the response is short rather
+than mixing in another experiment's generations; an empty scope is remembered
+for ARCHIVE_EMPTY_TTL, so it costs no queries. Every response records the
+ratio it achieved.
+"""
+import random
+import threading
+from dataclasses import dataclass
+from typing import Any, Dict, List, Sequence
+
+from config import args, AI_POSTS_RATIO, FEED_ARCHIVE_TOPUP
+from ai_pools import queue_key
+from generate import get_ai_posts, pool_key_for
+from sampling import get_archive_sampler
+
+
+def desired_ai_count(real_count: int, ratio: float = AI_POSTS_RATIO) -> int:
+    return max(0, min(real_count, int(round(real_count * ratio))))
+
+
+def ai_slots(total: int, count: int, rng: random.Random) -> List[int]:
+    """count ascending positions in range(total), one per equal stratum."""
+    return [rng.randrange(i * total // count, (i + 1) * total // count) for i in range(count)]
+
+
+def interleave(real: Sequence[dict], ai: Sequence[dict], rng: random.Random) -> List[dict]:
+    total = len(real) + len(ai)
+    slots = set(ai_slots(total, len(ai), rng)) if ai else set()
+    real_iter, ai_iter = iter(real), iter(ai)
+    return [next(ai_iter) if pos in slots else next(real_iter) for pos in range(total)]
+
+
+@dataclass
+class Composition:
+    posts: List[dict]
+    real_count: int
+    desired_ai: int
+    from_pool: int
+    from_archive: int
+
+    @property
+    def ai_count(self) -> int:
+        return self.from_pool + self.from_archive
+
+    @property
+    def ai_ratio(self) -> float:
+        """Achieved AI posts per real post, comparable with AI_POSTS_RATIO."""
+        return self.ai_count / self.real_count if self.real_count else 0.0
+
+
+class FeedComposer:
+    """Builds feed responses and keeps totals of the AI ratio they achieved."""
+
+    def __init__(self, ratio: float = AI_POSTS_RATIO, archive_topup: bool = FEED_ARCHIVE_TOPUP):
+        self.ratio = ratio
+        # In archive mode the pools already are the archive
+        self.archive_topup = archive_topup and not args.archive
+        self._lock = threading.Lock()
+        self._stats = {
+            'responses': 0, 'real_posts': 0, 'ai_desired': 0, 'ai_from_pool': 0,
+            'ai_from_archive': 0, 'short_responses': 0,
+        }
+
+    def _pool_posts(self, count: int, source: str) -> List[dict]:
+        if count <= 0:
+            return []
+        try:
+            return get_ai_posts(count, source=source)
+        except Exception as e:
+            print(f"[feed] AI pool unavailable: {e}")
+            return []
+
+    def _archive_posts(self, user_id: int, count: int, source: str, exclude: set) -> List[dict]:
+        if count <= 0 or not self.archive_topup:
+            return []
+        try:
+            posts = get_archive_sampler().sample(user_id, count, queue_key=queue_key(pool_key_for(None, source)))
+        except Exception as e:
+            print(f"[feed] Archive top-up failed: {e}")
+            return []
+        # The pools hand out archived rows too; never show one twice in a response
+        return [p for p in posts if p.get('post_id') not in exclude]
+
+    def compose(self, user_id: int, real_posts: List[dict], source: str) -> Composition:
+        desired = desired_ai_count(len(real_posts), self.ratio)
+        pooled = self._pool_posts(desired, source)[:desired]
+        topup = self._archive_posts(user_id, desired - len(pooled), source, {p.get('post_id') for p in pooled})
+        seed = f"{user_id}:{real_posts[0].get('post_id') if real_posts else ''}"
+        composition = Composition(
+            posts=interleave(real_posts, pooled + topup, random.Random(seed)),
+            real_count=len(real_posts),
+            desired_ai=desired,
+            from_pool=len(pooled),
+            from_archive=len(topup),
+        )
+        with self._lock:
+            self._stats['responses'] += 1
+            self._stats['real_posts'] += len(real_posts)
+            self._stats['ai_desired'] += desired
+            self._stats['ai_from_pool'] += len(pooled)
+            self._stats['ai_from_archive'] += len(topup)
+            if composition.ai_count < desired:
+                self._stats['short_responses'] += 1
+        return composition
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+        served_ai = stats['ai_from_pool'] + stats['ai_from_archive']
+        stats['target_ratio'] = self.ratio
+        stats['achieved_ratio'] = round(served_ai / stats['real_posts'], 4) if stats['real_posts'] else 0.0
+        stats['ai_fill_rate'] = round(served_ai / stats['ai_desired'], 4) if stats['ai_desired'] else 1.0
+        return stats
+
+
+_composer = FeedComposer()
+
+
+def get_feed_composer() -> FeedComposer:
+    return _composer
@@ -0,0 +1,87 @@
+"""Cached JSON responses for endpoints computed from files on disk.
+
+Each entry remembers the paths its payload was built from and their stat()
+versions. A request re-stats those paths (no listing, no parsing) and reuses
+the serialized body while nothing changed. For a directory tree it is enough
+to watch the directories themselves: creating, deleting or renaming an entry
+bumps its parent's mtime.
+
+Responses carry an ETag of the body and Cache-Control: no-cache, so polling
+clients revalidate with If-None-Match and get a 304 while nothing changed.
+"""
+import hashlib
+import os
+import threading
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+from flask import current_app, request
+
+Version = Optional[Tuple[int, int, int]]
+
+
+def path_version(path: str) -> Version:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+def tree_dirs(root: str) -> List[str]:
+    """root and every directory below it."""
+    dirs = [root]
+    for dirpath, dirnames, _filenames in os.walk(root):
+        dirs.extend(os.path.join(dirpath, d) for d in dirnames)
+    return dirs
+
+
+@dataclass
+class _Entry:
+    paths: List[str]
+    versions: List[Version]
+    body: bytes
+    etag: str
+
+
+class FileResponseCache:
+    """Serialized JSON payloads keyed by name, valid while their watched paths are unchanged."""
+
+    def __init__(self):
+        self._entries: Dict[Hashable, _Entry] = {}
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'builds': 0}
+
+    def get(self, key: Hashable, watched: Callable[[], List[str]], build: Callable[[], Any]) -> Tuple[bytes, str]:
+        """Return (body, etag) for key, calling build() only if a watched path changed."""
+        entry = self._entries.get(key)
+        if entry is not None and [path_version(p) for p in entry.paths] == entry.versions:
+            with self._lock:
+                self._stats['hits'] += 1
+            return entry.body, entry.etag
+        paths = watched()
+        # Versions are taken before building, so a change made mid-build forces another build
+        versions = [path_version(p) for p in paths]
+        body = f"{current_app.json.dumps(build())}\n".encode('utf-8')
+        entry = _Entry(paths, versions, body, hashlib.sha1(body).hexdigest())
+        with self._lock:
+            self._entries[key] = entry
+            self._stats['builds'] += 1
+        return entry.body, entry.etag
+
+    def response(self, key: Hashable, watched: Callable[[], List[str]], build: Callable[[], Any]):
+        """A JSON response for key that answers If-None-Match with 304 Not Modified."""
+        body, etag = self.get(key, watched, build)
+        resp = current_app.response_class(body, mimetype='application/json')
+        resp.set_etag(etag)
+        resp.headers['Cache-Control'] = 'no-cache'
+        return resp.make_conditional(request)
+
+    def metrics(self) -> Dict[str, int]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+        return stats
+
+
+response_cache = FileResponseCache()
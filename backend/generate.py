@@ -1,20 +1,35 @@
 import threading
 import time
-from queue import Queue, Empty, Full
-from flask import Blueprint, jsonify, request, Response
+from concurrent.futures import wait, FIRST_COMPLETED
+from flask import Blueprint, jsonify, request, Response, g, stream_with_context
 from llm import get_llm_service
+from ai_pools import AiPostPools, prompt_source_for, queue_key
+from post_format import parse_post, PostValidationError
+from dedup import get_dedup_index
+from sampling import get_archive_sampler
+from ai_export import (
+    EXPORT_COLUMNS,
+    EXPORT_FORMATS,
+    decode_cursor,
+    encode_cursor,
+    export_chunks,
+    fetch_page,
+    parse_timestamp,
+)
 from config import (
     args,
     GENERATE_BATCH_SIZE,
     AI_POSTS_QUEUE_SIZE,
-    GENERATION_INTERVAL
+    AI_QUEUE_BACKEND,
+    GENERATION_INTERVAL,
+    AI_BROKER_ROLE,
 )
 from db import db_session
 from db.models import AiGeneratedPost
 from auth import require_auth
-from sqlalchemy import desc
 import csv
 import io
+from datetime import datetime
 
 # Create a Blueprint for generation routes
 generate = Blueprint('generate', __name__)
@@ -24,169 +39,191 @@ generate = Blueprint('generate', __name__)
 llm_service = get_llm_service(args.model, args.experiment or 'base')
 print("LLM service initialized")
 
-# Queue to store AI generated posts
-ai_posts_queue = Queue(maxsize=AI_POSTS_QUEUE_SIZE)
+# Pre-generated AI posts, one pool per (experiment, prompt source), each up to AI_POSTS_QUEUE_SIZE deep.
+# With AI_QUEUE_BACKEND=db the pools live in ai_generated_posts and every process claims from them
+# directly; otherwise serve.py web workers read the producer process's pools through the broker.
+if AI_QUEUE_BACKEND == 'db':
+    from ai_queue import DbAiPostPools
+    ai_post_pools = DbAiPostPools(
+        AI_POSTS_QUEUE_SIZE,
+        default_key=(args.experiment or 'base', args.source or 'base'),
+    )
+elif AI_QUEUE_BACKEND != 'memory':
+    raise ValueError(f"Invalid AI queue backend: {AI_QUEUE_BACKEND}")
+elif AI_BROKER_ROLE == 'worker':
+    from ai_broker import RemoteAiPostPools, get_broker_client
+    ai_post_pools = RemoteAiPostPools(
+        get_broker_client(),
+        default_key=(args.experiment or 'base', args.source or 'base'),
+    )
+else:
+    ai_post_pools = AiPostPools(
+        AI_POSTS_QUEUE_SIZE,
+        default_key=(args.experiment or 'base', args.source or 'base'),
+    )
 
 def parse_ai_post(generated_text):
-    """Parse the generated text into a post format."""
+    """Parse the generated text into a post format, or None if it is not a valid post."""
     try:
-        title_start = generated_text.find('title: ') + 7
-        title_end = generated_text.find('\nself_text:')
-        self_text_start = title_end + 11
-        subreddit_start = generated_text.find('\nsubreddit: ') + 11
-        
-        title = generated_text[title_start:title_end].strip()
-        self_text = generated_text[self_text_start:subreddit_start-11].strip()
-        subreddit = generated_text[subreddit_start:].strip()
-        
-        # Remove 'r/' prefix if present
-        if subreddit.startswith('r/'):
-            subreddit = subreddit[2:]
-        
-        return {
-            "title": title,
-            "self_text": self_text,
-            "subreddit": subreddit,
-            # post_id will be assigned from archive id (ai-<id>) when enqueuing
+        return parse_post(generated_text)
+    except PostValidationError as e:
+        print(f"Error parsing AI post: {e}")
+        return None
+
+def _enqueue_generated(result, key):
+    """Persist one validated generation to the archive and add it to the pool for key.
+
+    result comes from LLMService.exp_submit_post: {"post": ...} or {"error": ...}.
+    """
+    if "error" in result:
+        print(f"[bg] Generation error: {result.get('error')}")
+        return
+    fields = result["post"]
+    # Drop exact and near duplicates of anything already archived or queued
+    dedup = get_dedup_index().check(fields.get("title", ""), fields.get("self_text", ""))
+    if dedup.duplicate:
+        print(f"[bg] Skipping {dedup.kind} duplicate of ai-{dedup.match_id}: {fields.get('title', '')[:60]!r}")
+        return
+    # Persist to archive table and use its id as external post_id
+    new_id = None
+    try:
+        with db_session() as session:
+            row = AiGeneratedPost(
+                title=fields.get("title", ""),
+                self_text=fields.get("self_text", ""),
+                subreddit=fields.get("subreddit"),
+                model_name=f"{args.model}",
+                prompt=None,
+                # Provenance: the feed's archive top-up only serves posts from the reader's own pool
+                queue_key=queue_key(key),
+                content_hash=dedup.content_hash,
+                simhash=dedup.simhash,
+            )
+            session.add(row)
+            session.flush()
+            new_id = row.id
+        get_dedup_index().assign(dedup, new_id)
+    except Exception as e:
+        print(f"Failed to persist AI post: {e}")
+
+    # Enqueue for serving with stable external id
+    try:
+        post = {
+            "title": fields.get("title", ""),
+            "self_text": fields.get("self_text", ""),
+            "subreddit": fields.get("subreddit"),
+            "post_id": f"ai-{new_id}" if new_id is not None else None,
             "over_18": "false",
             "link_flair_text": "AI",
-            "is_ai": True
+            "is_ai": True,
         }
+        if ai_post_pools.put(key, post):
+            print(f"[bg] Enqueued AI post id={post['post_id']} into {key}. Pool size: {ai_post_pools.size(key)}")
+        else:
+            print(f"[bg] Pool {key} full while enqueuing generated post")
     except Exception as e:
-        print(f"Error parsing AI post: {e}")
-        return None
+        print(f"[bg] Failed to enqueue generated post: {e}")
+
+# Longest pause between rounds while every generation keeps failing
+GENERATION_MAX_BACKOFF = 300.0
+
+
+def _next_backoff(backoff: float) -> float:
+    return min(max(backoff * 2, GENERATION_INTERVAL, 1.0), GENERATION_MAX_BACKOFF)
+
 
 def background_generation():
-    """Background task to continuously generate posts."""
+    """Background task to keep the AI post pools filled, most-demanded pools first.
+
+    While rounds produce nothing but errors (no model, no API client, unknown
+    experiment), the loop sleeps GENERATION_INTERVAL doubled after each failed
+    round, up to GENERATION_MAX_BACKOFF, and resets on the first success.
+    """
+    in_flight = {}
+    backoff = 0.0
     while True:
         try:
-            if not ai_posts_queue.full():
-                print(f"[bg] Queue has space. Current size: {ai_posts_queue.qsize()}")
-                if args.archive:
-                    # Pull recent archived AI posts to buffer the queue
-                    try:
-                        with db_session() as session:
-                            rows = (
-                                session.query(AiGeneratedPost)
-                                .order_by(desc(AiGeneratedPost.generated_at))
-                                .limit(GENERATE_BATCH_SIZE)
-                                .all()
-                            )
-                        for r in rows:
-                            post = {
-                                "title": r.title,
-                                "self_text": r.self_text,
-                                "subreddit": r.subreddit,
-                                "post_id": f"ai-{r.id}",
-                                "over_18": "false",
-                                "link_flair_text": "AI",
-                                "is_ai": True,
-                            }
-                            try:
-                                ai_posts_queue.put_nowait(post)
-                                print(f"[bg] Enqueued archived AI post id=ai-{r.id}. Queue size: {ai_posts_queue.qsize()}")
-                            except Full:
-                                print("[bg] Queue full while enqueuing archived posts")
-                                break
-                    except Exception as e:
-                        print(f"Failed to fetch archived AI posts: {e}")
-                else:
-                    result = llm_service.exp_generate_text()
-                    if "error" in result:
-                        print(f"[bg] Generation error: {result.get('error')}")
-                    else:
-                        txt = result.get("generated_text", "")
-                        print(f"[bg] Generated text length: {len(txt)}")
-                        fields = parse_ai_post(txt)
-                        if not fields:
-                            print("[bg] Parse failed; skipping enqueue")
-                        else:
-                            # Persist to archive table and use its id as external post_id
-                            new_id = None
-                            try:
-                                with db_session() as session:
-                                    row = AiGeneratedPost(
-                                        title=fields.get("title", ""),
-                                        self_text=fields.get("self_text", ""),
-                                        subreddit=fields.get("subreddit"),
-                                        model_name=f"{args.model}",
-                                        prompt=None,
-                                    )
-                                    session.add(row)
-                                    session.flush()
-                                    new_id = row.id
-                            except Exception as e:
-                                print(f"Failed to persist AI post: {e}")
-
-                            # Enqueue for serving with stable external id
-                            try:
-                                post = {
-                                    "title": fields.get("title", ""),
-                                    "self_text": fields.get("self_text", ""),
-                                    "subreddit": fields.get("subreddit"),
-                                    "post_id": f"ai-{new_id}" if new_id is not None else None,
-                                    "over_18": "false",
-                                    "link_flair_text": "AI",
-                                    "is_ai": True,
-                                }
-                                ai_posts_queue.put_nowait(post)
-                                print(f"[bg] Enqueued AI post id={post['post_id']}. Queue size: {ai_posts_queue.qsize()}")
-                            except Full:
-                                print("[bg] Queue full while enqueuing generated post")
-            time.sleep(GENERATION_INTERVAL)
+            # Keep up to the backend's concurrency in flight and add each post to its
+            # pool as soon as its generation finishes
+            pending = {}
+            for key in in_flight.values():
+                pending[key] = pending.get(key, 0) + 1
+            slots = max(GENERATE_BATCH_SIZE, llm_service.max_concurrency) - len(in_flight)
+            for key in ai_post_pools.plan_refills(slots, pending):
+                experiment, prompt_source = key
+                future = llm_service.exp_submit_post(experiment=experiment, prompt_source=prompt_source)
+                in_flight[future] = key
+            if in_flight:
+                done, _ = wait(list(in_flight), timeout=GENERATION_INTERVAL, return_when=FIRST_COMPLETED)
+                results = [(future.result(), in_flight.pop(future)) for future in done]
+                for result, key in results:
+                    _enqueue_generated(result, key)
+                if results and all("error" in result for result, _key in results):
+                    backoff = _next_backoff(backoff)
+                    print(f"[bg] All generations failed; retrying in {backoff:.0f}s")
+                    time.sleep(backoff)
+                elif results:
+                    backoff = 0.0
+            else:
+                time.sleep(GENERATION_INTERVAL)
         except Exception as e:
             print(f"Error in background generation: {e}")
-            time.sleep(GENERATION_INTERVAL)
+            backoff = _next_backoff(backoff)
+            time.sleep(backoff)
 
 def start_background_generation():
-    """Start the background generation thread."""
+    """Start the background generation thread.
+
+    In --archive mode nothing is generated: get_ai_posts streams the archive directly.
+    """
+    if args.archive:
+        print("Archive mode: serving AI posts from the archive; no background generation")
+        return None
+    if AI_BROKER_ROLE == 'worker':
+        print("Web worker: AI posts are generated by the producer process")
+        return None
     generation_thread = threading.Thread(target=background_generation, daemon=True)
     generation_thread.start()
     return generation_thread
 
 
-def set_background_experiment(experiment: str):
-    """Update the default experiment used by the background generator."""
-    try:
-        new_exp = experiment or 'base'
-        llm_service._default_experiment = new_exp
-        # Force re-initialization under the new experiment on next generation call
-        llm_service._initialized_experiment = None
-        print(f"Background experiment set to: {new_exp}")
-    except Exception as e:
-        print(f"Failed to set background experiment: {e}")
+def pool_key_for(experiment: str | None, source: str | None):
+    """Pool for an experiment and feed source ('posts' or 'humorposts'), defaulting to the request's."""
+    if experiment is None:
+        experiment = getattr(g, 'current_experiment', None) if g else None
+    return (experiment or ai_post_pools.default_key[0], prompt_source_for(source))
+
+
+def prime_ai_pool(experiment: str | None = None, source: str | None = None):
+    """Record a little demand so a pool starts filling before its first feed pull."""
+    key = pool_key_for(experiment, source)
+    ai_post_pools.prime(key)
+    print(f"[pools] Primed AI post pool {key}")
+
 
-def get_ai_posts(max_count: int | None = None):
-    """Get up to max_count AI posts from the background generation queue.
+def get_ai_posts(max_count: int | None = None, experiment: str | None = None, source: str | None = None):
+    """Get up to max_count AI posts from the pool for experiment/source, or with
+    --archive from the caller's cursor over the archive.
 
-    Falls back to GENERATE_BATCH_SIZE if max_count is not provided.
+    The experiment defaults to g.current_experiment and source to 'posts'; falls
+    back to GENERATE_BATCH_SIZE if max_count is not provided.
     """
     limit = max_count if isinstance(max_count, int) and max_count > 0 else GENERATE_BATCH_SIZE
-    ai_posts = []
-    try:
-        print(f"[get_ai_posts] Queue starting size: {ai_posts_queue.qsize()}, requested: {limit}")
-    except Exception:
-        pass
-    while not ai_posts_queue.empty() and len(ai_posts) < limit:
-        try:
-            ai_post = ai_posts_queue.get_nowait()
-            ai_posts.append(ai_post)
-        except Empty:
-            break
-    try:
-        print(f"[get_ai_posts] Returning {len(ai_posts)} posts; queue now size: {ai_posts_queue.qsize()}")
-    except Exception:
-        pass
+    if args.archive:
+        # Each user streams through the whole archive without repeats
+        ai_posts = get_archive_sampler().sample(g.current_user_id, limit)
+        print(f"[get_ai_posts] Returning {len(ai_posts)}/{limit} archived posts")
+        return ai_posts
+    key = pool_key_for(experiment, source)
+    ai_posts = ai_post_pools.get(key, limit)
+    print(f"[get_ai_posts] Returning {len(ai_posts)}/{limit} posts from {key}; pool now size: {ai_post_pools.size(key)}")
     return ai_posts
 
 def generate_batch():
     """Generate a batch of AI posts (for testing)."""
-    results = []
-    for _ in range(GENERATE_BATCH_SIZE):
-        result = llm_service.exp_generate_text()
-        if "error" in result:
-            return None
-        results.append(result)
+    results = llm_service.exp_generate_batch(GENERATE_BATCH_SIZE)
+    if any("error" in result for result in results):
+        return None
     return results
 
 ###########
@@ -204,10 +241,20 @@ def generate_base():
     except Exception as e:
         return jsonify({'error': 'Text generation failed', 'message': str(e)}), 500
 
+def _generate_with_adapter(experiment: str):
+    """Generate one post for the current user through the experiment's adapter."""
+    try:
+        result = llm_service.exp_submit_text(experiment=experiment, user_id=g.current_user_id).result()
+        if "error" in result:
+            return jsonify(result), 500
+        return jsonify(result)
+    except Exception as e:
+        return jsonify({'error': 'Text generation failed', 'message': str(e)}), 500
+
 @generate.route('/slop')
+@require_auth
 def generate_slop():
-    # TODO: Implement slop generation
-    return jsonify({'error': 'Not implemented yet'}), 501
+    return _generate_with_adapter('slop')
 
 @generate.route('/summarize')
 @require_auth
@@ -221,44 +268,86 @@ def generate_summarize():
         return jsonify({'error': 'Text generation failed', 'message': str(e)}), 500
 
 @generate.route('/finetuned')
+@require_auth
 def generate_finetuned():
-    # TODO: Implement finetuned generation
-    return jsonify({'error': 'Not implemented yet'}), 501 
+    return _generate_with_adapter('finetuned')
+
+
+def producer_metrics():
+    """Metrics of the process that generates: pools, dedup and the LLM backends."""
+    return {
+        'queue_size': ai_post_pools.total_size(),
+        'pools': ai_post_pools.metrics(),
+        'dedup': get_dedup_index().metrics(),
+        **llm_service.generation_metrics(),
+    }
+
+
+def producer_handlers():
+    """Broker ops the producer process serves to web workers (see ai_broker.py)."""
+    def submit_text(experiment=None, **kwargs):
+        return llm_service.exp_submit_text(experiment=experiment, **kwargs).result()
+
+    def generate_batch(count, experiment=None, **kwargs):
+        futures = [llm_service.exp_submit_text(experiment=experiment, **kwargs) for _ in range(count)]
+        return [f.result() for f in futures]
+
+    return {
+        'pool_get': lambda key, limit: ai_post_pools.get(tuple(key), limit),
+        'pool_prime': lambda key, amount=1: ai_post_pools.prime(tuple(key), amount),
+        'pool_size': lambda key=None: ai_post_pools.size(tuple(key)) if key else ai_post_pools.total_size(),
+        'pool_metrics': ai_post_pools.metrics,
+        'llm_submit_text': submit_text,
+        'llm_generate_batch': generate_batch,
+        'llm_generate_text': lambda prompt, **kwargs: llm_service.generate_text(prompt, **kwargs),
+        'llm_metrics': producer_metrics,
+    }
+
+
+@generate.route('/metrics')
+@require_auth
+def generation_metrics():
+    try:
+        metrics = producer_metrics() if AI_BROKER_ROLE != 'worker' else llm_service.generation_metrics()
+    except Exception as e:
+        return jsonify({'error': 'Failed to read generation metrics', 'message': str(e)}), 502
+    return jsonify({
+        **metrics,
+        'archive': get_archive_sampler().metrics(),
+    })
 
 
 @generate.route('/ai_posts', methods=['GET'])
 @require_auth
 def list_ai_posts():
+    """Newest archived AI posts, one keyset page at a time.
+
+    Pass the returned next_cursor as ?cursor= to read the following page.
+    ?offset= is deprecated but still honoured when no cursor is given.
+    """
     try:
-        limit = int(request.args.get('limit') or 50)
+        limit = min(int(request.args.get('limit') or 50), 500)
         offset = int(request.args.get('offset') or 0)
         fmt = (request.args.get('format') or 'json').lower()
+        cursor = decode_cursor(request.args.get('cursor'))
+        if offset < 0:
+            raise ValueError("offset must not be negative")
 
-        with db_session() as session:
-            q = (
-                session.query(AiGeneratedPost)
-                .order_by(desc(AiGeneratedPost.generated_at))
-                .offset(offset)
-                .limit(min(limit, 500))
-            )
-            rows = q.all()
-
-        data = [
-            {
-                'id': r.id,
-                'title': r.title,
-                'self_text': r.self_text,
-                'subreddit': r.subreddit,
-                'model_name': r.model_name,
-                'prompt': r.prompt,
-                'generated_at': r.generated_at.isoformat(),
-            }
-            for r in rows
-        ]
+        data = fetch_page(
+            limit,
+            after=cursor,
+            newest_first=True,
+            model_name=request.args.get('model_name'),
+            offset=offset,
+        )
+        next_cursor = None
+        if len(data) == limit:
+            last = data[-1]
+            next_cursor = encode_cursor((datetime.fromisoformat(last['generated_at']), last['id']))
 
         if fmt == 'csv':
             output = io.StringIO()
-            writer = csv.DictWriter(output, fieldnames=list(data[0].keys()) if data else ['id','title','self_text','subreddit','model_name','prompt','generated_at'])
+            writer = csv.DictWriter(output, fieldnames=EXPORT_COLUMNS)
             writer.writeheader()
             for row in data:
                 writer.writerow(row)
@@ -267,6 +356,38 @@ def list_ai_posts():
                 'Content-Disposition': 'attachment; filename="ai_posts.csv"'
             })
 
-        return jsonify({'items': data, 'count': len(data), 'offset': offset, 'limit': limit})
+        body = {'items': data, 'count': len(data), 'limit': limit, 'next_cursor': next_cursor}
+        if 'offset' in request.args and cursor is None:
+            # Deprecated offset paging: existing clients read it back
+            body['offset'] = offset
+        return jsonify(body)
+    except ValueError as e:
+        return jsonify({'error': 'Invalid parameters', 'message': str(e)}), 400
     except Exception as e:
-        return jsonify({'error': 'Failed to list AI posts', 'message': str(e)}), 500
\ No newline at end of file
+        return jsonify({'error': 'Failed to list AI posts', 'message': str(e)}), 500
+
+
+@generate.route('/ai_posts/export', methods=['GET'])
+@require_auth
+def export_ai_posts():
+    """Stream the whole (filtered) archive, oldest first, as CSV, NDJSON or Parquet.
+
+    Query params: format (csv|ndjson|parquet), model_name, since and until
+    (ISO timestamps, until exclusive), page_size.
+    """
+    fmt = (request.args.get('format') or 'csv').lower()
+    try:
+        filters = {
+            'model_name': request.args.get('model_name'),
+            'since': parse_timestamp(request.args.get('since')),
+            'until': parse_timestamp(request.args.get('until')),
+        }
+        page_size = max(1, min(int(request.args.get('page_size') or 1000), 10000))
+        chunks = export_chunks(fmt, page_size=page_size, **filters)
+    except ValueError as e:
+        return jsonify({'error': 'Invalid parameters', 'message': str(e)}), 400
+    except RuntimeError as e:
+        return jsonify({'error': 'Export format unavailable', 'message': str(e)}), 501
+    return Response(stream_with_context(chunks), mimetype=EXPORT_FORMATS[fmt], headers={
+        'Content-Disposition': f'attachment; filename="ai_posts.{fmt}"'
+    })
\ No newline at end of file
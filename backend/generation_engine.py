@@ -0,0 +1,487 @@
+import contextlib
+import copy
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from post_format import TITLE_PREFILL, PostFormatLogitsProcessor
+
+
+def _common_prefix_len(a: List[int], b: List[int]) -> int:
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
+
+
+def _kv_bytes_per_token(model) -> int:
+    cfg = getattr(model.config, 'text_config', model.config)
+    layers = getattr(cfg, 'num_hidden_layers', 0)
+    heads = getattr(cfg, 'num_key_value_heads', None) or getattr(cfg, 'num_attention_heads', 0)
+    head_dim = getattr(cfg, 'head_dim', None) or (cfg.hidden_size // cfg.num_attention_heads)
+    itemsize = getattr(getattr(model, 'dtype', None), 'itemsize', 2)
+    # One key and one value vector per layer and KV head
+    return 2 * layers * heads * head_dim * itemsize
+
+
+class PrefixCache:
+    """LRU cache of past key/values for prompt prefixes, keyed by prompt template.
+
+    The first prompt seen for a key only records its token ids. The next prompt with
+    that key is compared against them. Their longest common token prefix is run
+    through the model once, and the past key/values are kept. Later prompts that start
+    with the cached prefix skip prefill for those tokens. Entries are evicted least
+    recently used first once their estimated KV size exceeds max_bytes. Keys embed a
+    hash of the template text, so a template edit starts a fresh entry and
+    drops the stale one.
+    """
+
+    def __init__(self, model, max_bytes: int, min_tokens: int = 32):
+        self.model = model
+        self.max_bytes = max_bytes
+        self.min_tokens = min_tokens
+        self._per_token_bytes = _kv_bytes_per_token(model)
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'builds': 0, 'evictions': 0, 'reused_tokens': 0}
+
+    def _drop(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry['nbytes']
+
+    def _drop_stale(self, key: str) -> None:
+        name = key.split(':', 1)[0]
+        for other in [k for k in self._entries if k != key and k.split(':', 1)[0] == name]:
+            self._drop(other)
+
+    def _build(self, prefix_ids: List[int]):
+        import torch
+        from transformers import DynamicCache
+        with torch.no_grad():
+            input_ids = torch.tensor([prefix_ids], device=self.model.device)
+            out = self.model(input_ids=input_ids, past_key_values=DynamicCache(), use_cache=True)
+        return out.past_key_values
+
+    def lookup(self, key: Optional[str], ids: List[int]) -> Tuple[int, Any]:
+        """Return (prefix_len, past_key_values) covering the start of ids, or (0, None)."""
+        if not key or self.max_bytes <= 0:
+            return 0, None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._drop_stale(key)
+                self._entries[key] = {'ids': list(ids), 'kv': None, 'nbytes': 0}
+                self._stats['misses'] += 1
+                return 0, None
+            self._entries.move_to_end(key)
+            prefix = entry['ids']
+            if entry['kv'] is not None and len(ids) > len(prefix) and ids[:len(prefix)] == prefix:
+                self._stats['hits'] += 1
+                self._stats['reused_tokens'] += len(prefix)
+                return len(prefix), entry['kv']
+            self._stats['misses'] += 1
+            # Always leave at least one prompt token for the model to process
+            common = min(_common_prefix_len(prefix, ids), len(ids) - 1)
+            if common < self.min_tokens or (entry['kv'] is not None and common >= len(prefix)):
+                return 0, None
+
+        kv = self._build(ids[:common])
+        nbytes = common * self._per_token_bytes
+        with self._lock:
+            self._drop(key)
+            if nbytes > self.max_bytes:
+                return common, kv
+            self._entries[key] = {'ids': list(ids[:common]), 'kv': kv, 'nbytes': nbytes}
+            self._bytes += nbytes
+            self._stats['builds'] += 1
+            while self._bytes > self.max_bytes and self._entries:
+                oldest = next(iter(self._entries))
+                self._drop(oldest)
+                self._stats['evictions'] += 1
+        return common, kv
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = sum(1 for e in self._entries.values() if e['kv'] is not None)
+            stats['bytes'] = self._bytes
+        stats['max_bytes'] = self.max_bytes
+        return stats
+
+
+class SpeculativeDecoder:
+    """Assisted generation with a small draft model proposing tokens for the main model.
+
+    transformers only supports assisted generation for one sequence at a time, so
+    the engine uses it for single-request batches. Forward hooks count model calls:
+    each main-model forward verifies one round of draft tokens and contributes one
+    token of its own, so accepted = generated - main forwards, and the acceptance
+    rate is accepted over the tokens the draft proposed (one per draft forward).
+    """
+
+    def __init__(self, main_model, draft_model, num_assistant_tokens: int = 5,
+                 tokenizer=None, draft_tokenizer=None):
+        self.draft_model = draft_model
+        self.draft_model.generation_config.num_assistant_tokens = num_assistant_tokens
+        # Draft models with a different vocabulary need both tokenizers (universal assisted decoding)
+        self.tokenizers = None
+        if draft_tokenizer is not None and tokenizer is not None and draft_tokenizer.get_vocab() != tokenizer.get_vocab():
+            self.tokenizers = {'tokenizer': tokenizer, 'assistant_tokenizer': draft_tokenizer}
+        self._counting = False
+        self._calls = {'main': 0, 'draft': 0}
+        main_model.register_forward_hook(self._hook('main'))
+        draft_model.register_forward_hook(self._hook('draft'))
+        self._stats = {
+            'requests': 0,
+            'generated_tokens': 0,
+            'generation_seconds': 0.0,
+            'main_forwards': 0,
+            'draft_forwards': 0,
+        }
+
+    def _hook(self, name: str):
+        def count(module, args, output):
+            if self._counting:
+                self._calls[name] += 1
+        return count
+
+    def generate_kwargs(self) -> Dict[str, Any]:
+        kwargs = {'assistant_model': self.draft_model}
+        if self.tokenizers:
+            kwargs.update(self.tokenizers)
+        return kwargs
+
+    def __enter__(self):
+        self._calls = {'main': 0, 'draft': 0}
+        self._counting = True
+        return self
+
+    def __exit__(self, *exc):
+        self._counting = False
+        return False
+
+    def record(self, generated_tokens: int, elapsed: float) -> None:
+        self._stats['requests'] += 1
+        self._stats['generated_tokens'] += generated_tokens
+        self._stats['generation_seconds'] += elapsed
+        self._stats['main_forwards'] += self._calls['main']
+        self._stats['draft_forwards'] += self._calls['draft']
+
+    def metrics(self) -> Dict[str, Any]:
+        stats = dict(self._stats)
+        accepted = max(0, stats['generated_tokens'] - stats['main_forwards'])
+        stats['acceptance_rate'] = accepted / stats['draft_forwards'] if stats['draft_forwards'] else 0.0
+        stats['tokens_per_main_forward'] = (
+            stats['generated_tokens'] / stats['main_forwards'] if stats['main_forwards'] else 0.0
+        )
+        stats['tokens_per_sec'] = (
+            stats['generated_tokens'] / stats['generation_seconds'] if stats['generation_seconds'] > 0 else 0.0
+        )
+        return stats
+
+
+def _is_soft(adapter) -> bool:
+    return adapter is not None and adapter.kind == 'soft_prompt'
+
+
+def _is_lora(adapter) -> bool:
+    return adapter is not None and adapter.kind == 'lora'
+
+
+@dataclass
+class GenerationRequest:
+    prompt: str
+    max_length: int
+    temperature: float
+    prefix_key: Optional[str] = None
+    adapter: Any = None
+    structured: bool = False
+    future: Future = field(default_factory=Future)
+    submitted_at: float = field(default_factory=time.perf_counter)
+
+    @property
+    def batch_key(self):
+        # Only requests with identical generation settings can share a generate() call
+        return (self.max_length, self.temperature, self.structured)
+
+
+class BatchedGenerationEngine:
+    """Runs pending local-model prompts together in padded batches.
+
+    Callers submit prompts and get a Future resolving to the same
+    {"generated_text": ...} / {"error": ...} dict that LLMService returns. A single
+    worker thread waits up to wait_ms for more requests once one arrives, then runs
+    up to max_batch_size compatible prompts through one generate() call.
+
+    Requests may carry an adapter (see adapters.py). Soft prompts are prepended to
+    their rows' input embeddings and LoRA adapters are picked per row through
+    adapter_names, so rows for different adapters and the base model share one
+    generate() call.
+    """
+
+    def __init__(self, tokenizer, model, max_batch_size: int = 8, wait_ms: float = 50,
+                 prefix_cache: Optional[PrefixCache] = None, speculative: Optional[SpeculativeDecoder] = None):
+        self.tokenizer = tokenizer
+        self.model = model
+        # Used for single-request batches; larger batches already amortize the weight reads
+        self.speculative = speculative
+        # The unwrapped model; self.model becomes a PeftModel once a LoRA adapter is attached
+        self.base_model = model
+        # Held while generating so adapters are never attached or removed mid-batch
+        self.model_lock = threading.Lock()
+        self.prefix_cache = prefix_cache
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.wait_s = max(0.0, float(wait_ms) / 1000.0)
+        self._pending: deque = deque()
+        self._cond = threading.Condition()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'requests': 0,
+            'batches': 0,
+            'batched_requests': 0,
+            'generated_tokens': 0,
+            'generation_seconds': 0.0,
+            'queue_wait_seconds': 0.0,
+            'last_batch_size': 0,
+            'adapter_requests': 0,
+        }
+        # Decoder-only models must be left-padded so generation continues from real tokens
+        self.tokenizer.padding_side = 'left'
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def submit(self, prompt: str, max_length: int, temperature: float, prefix_key: Optional[str] = None,
+               adapter=None, structured: bool = False) -> Future:
+        """Queue a prompt. structured=True constrains the output to the post format
+        (see post_format.PostFormatLogitsProcessor)."""
+        # Cached prefix KV is computed without adapters, so adapter requests skip it
+        request = GenerationRequest(prompt=prompt, max_length=max_length, temperature=temperature,
+                                    prefix_key=None if adapter is not None else prefix_key, adapter=adapter,
+                                    structured=structured)
+        with self._cond:
+            self._pending.append(request)
+            self._cond.notify()
+        with self._stats_lock:
+            self._stats['requests'] += 1
+        return request.future
+
+    def _take_batch(self) -> List[GenerationRequest]:
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+            # Give concurrent submitters a short window to join this batch
+            deadline = time.perf_counter() + self.wait_s
+            while len(self._pending) < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            head = self._pending.popleft()
+            batch = [head]
+            skipped = deque()
+            while self._pending and len(batch) < self.max_batch_size:
+                request = self._pending.popleft()
+                if request.batch_key == head.batch_key:
+                    batch.append(request)
+                else:
+                    skipped.append(request)
+            # Incompatible requests keep their place at the front of the queue
+            self._pending.extendleft(reversed(skipped))
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            try:
+                with self.model_lock:
+                    self._generate(batch)
+            except Exception as e:
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_result({"error": f"Text generation failed: {str(e)}"})
+
+    def _chat_texts(self, batch: List[GenerationRequest]) -> List[str]:
+        # Structured requests prefill the assistant turn with the first field label
+        return [
+            self.tokenizer.apply_chat_template(
+                [{"role": "user", "content": r.prompt}],
+                add_generation_prompt=True,
+                tokenize=False,
+            ) + (TITLE_PREFILL if r.structured else '')
+            for r in batch
+        ]
+
+    def _encode(self, batch: List[GenerationRequest]):
+        # The chat template already contains the BOS token
+        return self.tokenizer(
+            self._chat_texts(batch),
+            padding=True,
+            add_special_tokens=False,
+            return_tensors="pt",
+        ).to(self.model.device)
+
+    def _encode_with_prefix(self, batch: List[GenerationRequest]):
+        """Encode a batch sharing one prefix key against the prefix cache.
+
+        Rows are laid out as [cached prefix][padding][own suffix] so the cached KV
+        lines up with every row; position ids come from the attention mask, so the
+        suffix positions continue straight after the prefix. Returns None when the
+        cache cannot serve this batch.
+        """
+        import torch
+        head = batch[0]
+        if self.prefix_cache is None or not head.prefix_key:
+            return None
+        if any(r.prefix_key != head.prefix_key for r in batch):
+            return None
+        ids = self.tokenizer(self._chat_texts(batch), add_special_tokens=False)["input_ids"]
+        prefix_len, kv = self.prefix_cache.lookup(head.prefix_key, ids[0])
+        if kv is None or any(len(row) <= prefix_len or row[:prefix_len] != ids[0][:prefix_len] for row in ids):
+            return None
+
+        width = max(len(row) for row in ids)
+        pad_id = self.tokenizer.pad_token_id
+        input_ids, attention_mask = [], []
+        for row in ids:
+            gap = width - len(row)
+            input_ids.append(row[:prefix_len] + [pad_id] * gap + row[prefix_len:])
+            attention_mask.append([1] * prefix_len + [0] * gap + [1] * (len(row) - prefix_len))
+        past = copy.deepcopy(kv)
+        if len(batch) > 1:
+            past.batch_repeat_interleave(len(batch))
+        device = self.model.device
+        return {
+            'input_ids': torch.tensor(input_ids, device=device),
+            'attention_mask': torch.tensor(attention_mask, device=device),
+            'past_key_values': past,
+        }
+
+    def _encode_with_soft_prompts(self, batch: List[GenerationRequest]):
+        """Encode a batch as input embeddings, each row led by its soft prompt (if any).
+
+        Rows are laid out as [padding][virtual tokens][own prompt tokens].
+        """
+        import torch
+        encoded = self._encode(batch)
+        embed = self.base_model.get_input_embeddings()
+        token_embeds = embed(encoded["input_ids"])
+        mask = encoded["attention_mask"]
+        rows = []
+        for i, request in enumerate(batch):
+            real = token_embeds[i, mask[i].bool()]
+            soft = request.adapter.prompt_embeddings if _is_soft(request.adapter) else real[:0]
+            rows.append(torch.cat([soft, real], dim=0))
+        width = max(row.size(0) for row in rows)
+        hidden = token_embeds.size(-1)
+        inputs_embeds = token_embeds.new_zeros((len(batch), width, hidden))
+        attention_mask = mask.new_zeros((len(batch), width))
+        for i, row in enumerate(rows):
+            inputs_embeds[i, width - row.size(0):] = row
+            attention_mask[i, width - row.size(0):] = 1
+        return {'inputs_embeds': inputs_embeds, 'attention_mask': attention_mask}
+
+    def _adapter_kwargs(self, batch: List[GenerationRequest]):
+        """Return (generate kwargs, context manager) selecting each row's LoRA adapter."""
+        if self.model is self.base_model:
+            return {}, contextlib.nullcontext()
+        names = [r.adapter.name if _is_lora(r.adapter) else '__base__' for r in batch]
+        if all(name == '__base__' for name in names):
+            # Plain base-model batch: bypass the LoRA layers entirely
+            return {}, self.model.disable_adapter()
+        return {'adapter_names': names}, contextlib.nullcontext()
+
+    def _generate(self, batch: List[GenerationRequest]):
+        # Drop rows whose LoRA adapter was evicted after they were queued
+        if self.model is not self.base_model:
+            loaded = getattr(self.model, 'peft_config', {})
+            for request in [r for r in batch if _is_lora(r.adapter) and r.adapter.name not in loaded]:
+                request.future.set_result({"error": f"Adapter {request.adapter.name} was unloaded"})
+                batch.remove(request)
+            if not batch:
+                return
+        started = time.perf_counter()
+        adapter_kwargs, context = self._adapter_kwargs(batch)
+        # Assisted generation runs logits processors on draft tokens it may reject, which
+        # would desync PostFormatLogitsProcessor's per-row state, so structured requests skip it
+        speculative = (self.speculative is not None and len(batch) == 1
+                       and batch[0].adapter is None and not batch[0].structured)
+        with context, (self.speculative if speculative else contextlib.nullcontext()):
+            if speculative:
+                # Assisted generation manages its own caches, so skip the prefix cache
+                inputs = self._encode(batch)
+                adapter_kwargs.update(self.speculative.generate_kwargs())
+            elif any(_is_soft(r.adapter) for r in batch):
+                inputs = self._encode_with_soft_prompts(batch)
+            else:
+                inputs = self._encode_with_prefix(batch) or self._encode(batch)
+            head = batch[0]
+            if head.structured:
+                from transformers import LogitsProcessorList
+                prompt_width = inputs["input_ids"].size(-1) if "input_ids" in inputs else 0
+                # max_length counts the prompt, including a soft-prompt/inputs_embeds prefix
+                input_width = prompt_width or inputs["inputs_embeds"].size(1)
+                adapter_kwargs['logits_processor'] = LogitsProcessorList(
+                    [PostFormatLogitsProcessor(self.tokenizer, prompt_width, head.max_length - input_width)]
+                )
+            outputs = self.model.generate(
+                **inputs,
+                **adapter_kwargs,
+                max_length=head.max_length,
+                temperature=head.temperature,
+                pad_token_id=self.tokenizer.pad_token_id,
+            )
+        elapsed = time.perf_counter() - started
+
+        # Generation from inputs_embeds returns only the new tokens
+        prompt_length = inputs["input_ids"].size(-1) if "input_ids" in inputs else 0
+        generated_tokens = 0
+        for i, request in enumerate(batch):
+            generated_ids = outputs[i, prompt_length:]
+            generated_ids = generated_ids[generated_ids != self.tokenizer.pad_token_id].tolist()
+            generated_tokens += len(generated_ids)
+            content = self.tokenizer.decode(generated_ids, skip_special_tokens=True)
+            if request.structured:
+                content = TITLE_PREFILL + content
+            print(f"generated: {content}")
+            request.future.set_result({"generated_text": content})
+
+        with self._stats_lock:
+            self._stats['batches'] += 1
+            self._stats['batched_requests'] += len(batch)
+            self._stats['generated_tokens'] += generated_tokens
+            self._stats['generation_seconds'] += elapsed
+            self._stats['queue_wait_seconds'] += sum(started - r.submitted_at for r in batch)
+            self._stats['last_batch_size'] = len(batch)
+            self._stats['adapter_requests'] += sum(1 for r in batch if r.adapter is not None)
+            if speculative:
+                self.speculative.record(generated_tokens, elapsed)
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        with self._cond:
+            stats['queue_depth'] = len(self._pending)
+        batches = stats['batches']
+        stats['max_batch_size'] = self.max_batch_size
+        stats['avg_batch_size'] = (stats['batched_requests'] / batches) if batches else 0.0
+        stats['batch_occupancy'] = (stats['avg_batch_size'] / self.max_batch_size) if batches else 0.0
+        stats['tokens_per_sec'] = (
+            stats['generated_tokens'] / stats['generation_seconds'] if stats['generation_seconds'] > 0 else 0.0
+        )
+        stats['avg_queue_wait_ms'] = (
+            stats['queue_wait_seconds'] / stats['batched_requests'] * 1000 if stats['batched_requests'] else 0.0
+        )
+        if self.prefix_cache is not None:
+            stats['prefix_cache'] = self.prefix_cache.metrics()
+        if self.speculative is not None:
+            with self._stats_lock:
+                stats['speculative'] = self.speculative.metrics()
+        return stats
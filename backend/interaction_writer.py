@@ -0,0 +1,116 @@
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy.dialects.postgresql import insert
+
+from db import db_session
+from db.models import Interaction
+from post_identity import PostRef, parse_ref, resolve_refs
+
+ACTIONS = ('like', 'dislike', 'next', 'markedai')
+
+# Columns of uq_user_target_action, the ON CONFLICT arbiter
+CONFLICT_COLUMNS = ['user_id', 'post_id', 'humor_id', 'ai_id', 'action']
+
+
+@dataclass
+class InteractionOutcome:
+    """What happened to one item of a batch.
+
+    status is 'inserted', 'duplicate' (already recorded, or repeated within
+    the batch), 'unknown_target' or 'invalid'. is_ai is the actual type of the
+    target post, not what the client claimed.
+    """
+    index: int
+    action: Optional[str]
+    status: str
+    kind: Optional[str] = None  # 'ai', 'humor' or 'post'
+    target_id: Optional[int] = None
+    is_ai: bool = False
+    reason: Optional[str] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = {'index': self.index, 'action': self.action, 'status': self.status}
+        if self.kind is not None:
+            data['kind'] = self.kind
+            data['target_id'] = self.target_id
+        if self.reason:
+            data['reason'] = self.reason
+        return data
+
+
+def _classify(index: int, post: Any, action: Any):
+    """Parse an entry into (post, ref), or return an 'invalid' outcome."""
+    if action not in ACTIONS:
+        return InteractionOutcome(index, action if isinstance(action, str) else None, 'invalid', reason='unknown action')
+    if not isinstance(post, dict):
+        return InteractionOutcome(index, action, 'invalid', reason='post must be an object')
+    try:
+        return post, parse_ref(post)
+    except ValueError as e:
+        return InteractionOutcome(index, action, 'invalid', reason=str(e))
+
+
+def write_interactions(user_id: int, entries: Sequence[Tuple[Any, Any]]) -> List[InteractionOutcome]:
+    """Record (post, action) pairs for one user. See write_events."""
+    return write_events([(user_id, post, action) for post, action in entries])
+
+
+def write_events(events: Sequence[Tuple[int, Any, Any]]) -> List[InteractionOutcome]:
+    """Record (user_id, post, action) events with a fixed number of round trips.
+
+    Targets are resolved in bulk by post_identity and every interaction is
+    written by a single INSERT ... ON CONFLICT DO NOTHING RETURNING, so an item
+    that was already recorded comes back as 'duplicate' without disturbing the
+    rest of the batch. Returns one outcome per event, in order.
+    """
+    outcomes: List[Optional[InteractionOutcome]] = [None] * len(events)
+    pending: List[Tuple[int, int, str, Dict[str, Any], PostRef]] = []
+    for index, (user_id, post, action) in enumerate(events):
+        classified = _classify(index, post, action)
+        if isinstance(classified, InteractionOutcome):
+            outcomes[index] = classified
+        else:
+            pending.append((index, user_id, action, *classified))
+
+    if pending:
+        with db_session() as session:
+            resolved = resolve_refs(session, [p[4] for p in pending], [p[3] for p in pending])
+            rows: Dict[Tuple, Dict[str, Any]] = {}
+            keyed = []
+            for (index, user_id, action, _post, ref), target in zip(pending, resolved):
+                if target is None:
+                    outcomes[index] = InteractionOutcome(index, action, 'unknown_target', ref.kind, is_ai=ref.kind == 'ai')
+                    continue
+                target_id, is_ai = target
+                row = {
+                    'user_id': user_id,
+                    'post_id': target_id if ref.kind == 'post' else None,
+                    'humor_id': target_id if ref.kind == 'humor' else None,
+                    'ai_id': target_id if ref.kind == 'ai' else None,
+                    'action': action,
+                }
+                key = tuple(row[c] for c in CONFLICT_COLUMNS)
+                rows.setdefault(key, row)
+                keyed.append((index, action, ref.kind, target_id, is_ai, key))
+
+            inserted = set()
+            if rows:
+                stmt = (
+                    insert(Interaction)
+                    .values(list(rows.values()))
+                    .on_conflict_do_nothing(index_elements=CONFLICT_COLUMNS)
+                    .returning(*[getattr(Interaction, c) for c in CONFLICT_COLUMNS])
+                )
+                inserted = {tuple(r) for r in session.execute(stmt).all()}
+
+            for index, action, kind, target_id, is_ai, key in keyed:
+                if key in inserted:
+                    status = 'inserted'
+                    # Later copies of the same key in this batch are duplicates
+                    inserted.discard(key)
+                else:
+                    status = 'duplicate'
+                outcomes[index] = InteractionOutcome(index, action, status, kind, target_id, is_ai)
+
+    return outcomes
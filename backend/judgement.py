@@ -5,6 +5,8 @@ from typing import List, Dict, Any, Tuple
 
 from flask import Blueprint, jsonify, request, send_from_directory
 
+from fs_cache import response_cache, tree_dirs
+
 
 judgement = Blueprint('judgement', __name__)
 
@@ -214,9 +216,12 @@ def serve_ui():
 @judgement.route('/judgement/api/files')
 def api_list_files():
     source = _get_source_from_request()
-    resp = jsonify({'ok': True, 'files': _list_json_files(source)})
-    resp.headers['Cache-Control'] = 'no-store'
-    return resp
+    root = _generated_root_for(source)
+    return response_cache.response(
+        ('judgement_files', root),
+        lambda: tree_dirs(root),
+        lambda: {'ok': True, 'files': _list_json_files(source)},
+    )
 
 
 @judgement.route('/judgement/api/file')
@@ -258,9 +263,12 @@ def api_get_file():
 @judgement.route('/judgement/api/options')
 def api_options():
     source = _get_source_from_request()
-    resp = jsonify({'ok': True, 'options': _discover_options(source)})
-    resp.headers['Cache-Control'] = 'no-store'
-    return resp
+    root = _generated_root_for(source)
+    return response_cache.response(
+        ('judgement_options', root),
+        lambda: tree_dirs(root),
+        lambda: {'ok': True, 'options': _discover_options(source)},
+    )
 
 
 @judgement.route('/judgement/api/mixed')
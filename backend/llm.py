@@ -1,7 +1,6 @@
-from openai import OpenAI
 import os
+from concurrent.futures import Future
 from config import (
-    OPENAI_API_KEY,
     OPENAI_MODEL_NAME,
     LOCAL_MODEL_NAME,
     DEFAULT_MAX_LENGTH,
@@ -11,9 +10,18 @@ from config import (
     args,
     HUMOR_SUBREDDITS,
     WHITELIST_SUBREDDITS,
+    AI_BROKER_ROLE,
 )
+import hashlib
 import random
 from flask import g
+from model_registry import get_model_registry
+from adapters import ADAPTER_EXPERIMENTS
+from post_format import POST_TEXT_FORMAT, validate_result, validity_stats
+
+def _prefix_key(name: str, template: str) -> str:
+    return f"{name}:{hashlib.sha1(template.encode('utf-8')).hexdigest()[:12]}"
+
 
 class LLMService:
     def __init__(self, model, default_experiment: str = 'base'):
@@ -22,22 +30,25 @@ class LLMService:
         self.local_model = None
         self.api_client = None
         self.tokenizer = None
+        self.engine = None
+        self.api_engine = None
         self.local_model_name = LOCAL_MODEL_NAME
         # Default experiment if none provided by request
         self._default_experiment = default_experiment or 'base'
         # Tracks which experiment the underlying model/client is initialized for
         self._initialized_experiment: str | None = None
-        # Mutable prompt source used by background generation and requests without explicit source context
+        # Default prompt source for generations that do not pass one explicitly
         # Values: 'base' or 'base-humor'
         self.prompt_source: str = getattr(args, 'source', 'base') or 'base'
         # Defer heavy initialization until first use
 
-    def ensure_experiment_initialized(self):
-        """Ensure underlying clients/models are initialized for the active experiment.
+    def ensure_experiment_initialized(self, experiment: str | None = None):
+        """Ensure underlying clients/models are initialized for an experiment (default: the active one).
 
-        If the effective experiment differs from what we last initialized, reinitialize as needed.
+        Models come from the process-wide registry, so switching experiments only
+        swaps lightweight state and never reloads weights.
         """
-        active_exp = self.experiment
+        active_exp = experiment or self.experiment
         if self._initialized_experiment == active_exp:
             return
         # Initialize per model type
@@ -50,40 +61,25 @@ class LLMService:
         self._initialized_experiment = active_exp
        
     def initialize_local_lm(self, exp: str):
-        """Initialize or reinitialize the local LLM for a given experiment."""
-        # Lazy import heavy deps only if local model is requested
-        try:
-            from transformers import AutoTokenizer, AutoModelForCausalLM
-            import torch  # noqa: F401
-        except Exception as e:
-            print(f"Local LLM dependencies not available: {e}")
+        """Attach the shared local model for a given experiment (loaded once per process)."""
+        if exp not in ("base", "summarize", "user-defined", "like-history-text", "slop", "finetuned"):
+            # Unknown experiment bucket for local model; leave current model as-is
+            return
+        loaded = get_model_registry().local(self.local_model_name)
+        if loaded is None:
             self.local_model = None
             self.tokenizer = None
+            self.engine = None
             return
-        if exp in ("base", "summarize", "user-defined", "like-history-text", "slop", "finetuned"):
-            try:
-                # quantization_config = BitsAndBytesConfig(
-                #     load_in_4bit=True,
-                #     # llm_int8_enable_fp32_cpu_offload=True
-                # )
-                self.tokenizer = AutoTokenizer.from_pretrained(self.local_model_name)
-                self.local_model = AutoModelForCausalLM.from_pretrained(
-                    self.local_model_name,
-                    device_map="auto",
-                    # quantization_config=quantization_config,
-                    torch_dtype="auto"
-                )
-
-            except Exception as e:
-                print(f"Error initializing lm: {e}")
-        else:
-            # Unknown experiment bucket for local model; leave current model as-is
-            pass
-
+        self.tokenizer = loaded.tokenizer
+        self.local_model = loaded.model
+        self.engine = loaded.engine
 
     def initialize_openai(self):
-        """Initialize the OpenAI API."""
-        self.api_client = OpenAI(api_key=OPENAI_API_KEY)
+        """Attach the shared OpenAI client."""
+        loaded = get_model_registry().api(OPENAI_MODEL_NAME)
+        self.api_client = loaded.client
+        self.api_engine = loaded.engine
 
     @property
     def experiment(self) -> str:
@@ -97,34 +93,33 @@ class LLMService:
             pass
         return self._default_experiment or 'base'
 
-    def exp_generate_text(self, max_length=DEFAULT_MAX_LENGTH, num_return_sequences=DEFAULT_NUM_RETURN_SEQUENCES, temperature=DEFAULT_TEMPERATURE):
-        """Generate text using the pipeline.
-        
-        Args:
-            max_length (int): Maximum length of generated text
-            num_return_sequences (int): Number of sequences to return
-            temperature (float): Sampling temperature
+    def build_prompt(self, experiment: str | None = None, prompt_source: str | None = None):
+        """Build the generation prompt for an experiment and prompt source
+        (defaults: the active experiment and self.prompt_source).
+
+        Returns (prompt, prefix_key). The prefix key names the prompt template and
+        hashes its text, so cached prefixes stop matching when PROMPTS changes.
         """
-        self.ensure_experiment_initialized()
-        exp = self.experiment
+        exp = experiment or self.experiment
+        source = prompt_source or self.prompt_source
         print(f"Using experiment: {exp}")
         if exp == "base":
-            use_humor = (self.prompt_source == 'base-humor')
+            use_humor = (source == 'base-humor')
             prompt_key = "base-humor" if use_humor else "base"
-            return self.generate_text(PROMPTS[prompt_key], max_length, num_return_sequences, temperature)
+            return PROMPTS[prompt_key], _prefix_key(prompt_key, PROMPTS[prompt_key])
         elif exp == "summarize":
-            return self.generate_text(PROMPTS["base-summarize"] + PROMPTS["summary"]["generated_text"], max_length, num_return_sequences, temperature)
-        elif exp == "finetuned":  #TODO
-            return self.generate_text(PROMPTS["base"], max_length, num_return_sequences, temperature)
-        elif exp == "slop":  #TODO
-            return self.generate_text(PROMPTS["base"], max_length, num_return_sequences, temperature)
+            prompt = PROMPTS["base-summarize"] + PROMPTS["summary"]["generated_text"]
+            return prompt, _prefix_key("summarize", prompt)
+        elif exp in ADAPTER_EXPERIMENTS:
+            # Style comes from the experiment's trained adapter (see resolve_adapter)
+            return PROMPTS["base"], _prefix_key("base", PROMPTS["base"])
         elif exp == "user-defined":  #TODO
-            return self.generate_text(PROMPTS["user-defined"], max_length, num_return_sequences, temperature)
+            return PROMPTS["user-defined"], _prefix_key("user-defined", PROMPTS["user-defined"])
         elif exp == "like-history-text": #TODO
-            return self.generate_text(PROMPTS["base"], max_length, num_return_sequences, temperature)
+            return PROMPTS["base"], _prefix_key("base", PROMPTS["base"])
         elif exp == "subreddit":
             # Choose subreddit set by source
-            use_humor = (self.prompt_source == 'base-humor')
+            use_humor = (source == 'base-humor')
             if use_humor:
                 pool = HUMOR_SUBREDDITS
             else:
@@ -134,7 +129,118 @@ class LLMService:
             except Exception:
                 chosen = 'AskReddit'
             prompt = PROMPTS["subreddit"].replace("{subreddit}", chosen)
-            return self.generate_text(prompt, max_length, num_return_sequences, temperature)
+            return prompt, _prefix_key("subreddit", PROMPTS["subreddit"])
+        return None, None
+
+    def exp_generate_text(self, max_length=DEFAULT_MAX_LENGTH, num_return_sequences=DEFAULT_NUM_RETURN_SEQUENCES, temperature=DEFAULT_TEMPERATURE):
+        """Generate text using the pipeline.
+        
+        Args:
+            max_length (int): Maximum length of generated text
+            num_return_sequences (int): Number of sequences to return
+            temperature (float): Sampling temperature
+        """
+        return self.exp_submit_text(max_length, num_return_sequences, temperature).result()
+
+    def exp_submit_text(self, max_length=DEFAULT_MAX_LENGTH, num_return_sequences=DEFAULT_NUM_RETURN_SEQUENCES, temperature=DEFAULT_TEMPERATURE,
+                        experiment: str | None = None, prompt_source: str | None = None, user_id: int | None = None) -> Future:
+        """Submit a generation for an experiment (default: the active one); the Future resolves to the result dict.
+
+        Passing user_id lets adapter experiments use that user's own adapter when one exists.
+        """
+        self.ensure_experiment_initialized(experiment)
+        prompt, prefix_key = self.build_prompt(experiment, prompt_source)
+        if prompt is None:
+            future = Future()
+            future.set_result({"error": f"Unknown experiment: {experiment or self.experiment}"})
+            return future
+        adapter = self.resolve_adapter(experiment or self.experiment, user_id)
+        return self.submit_text(prompt, max_length, num_return_sequences, temperature, prefix_key=prefix_key,
+                                adapter=adapter)
+
+    def exp_submit_post(self, max_length=DEFAULT_MAX_LENGTH, temperature=DEFAULT_TEMPERATURE,
+                        experiment: str | None = None, prompt_source: str | None = None, user_id: int | None = None) -> Future:
+        """Like exp_submit_text, but decoding is constrained to the post format.
+
+        The Future resolves to {"post": {...}, "generated_text": ...} with a
+        validated post dict, or {"error": ..., "reason": ...}.
+        """
+        self.ensure_experiment_initialized(experiment)
+        prompt, prefix_key = self.build_prompt(experiment, prompt_source)
+        if prompt is None:
+            future = Future()
+            future.set_result({"error": f"Unknown experiment: {experiment or self.experiment}"})
+            return future
+        adapter = self.resolve_adapter(experiment or self.experiment, user_id)
+        if self.model_type == "local" and self.engine is not None:
+            raw = self.engine.submit(prompt, max_length, temperature, prefix_key=prefix_key, adapter=adapter,
+                                     structured=True)
+        elif self.model_type == "gpt-5" and self.api_engine is not None:
+            raw = self.api_engine.submit(prompt, text=POST_TEXT_FORMAT)
+        else:
+            raw = self.submit_text(prompt, max_length, DEFAULT_NUM_RETURN_SEQUENCES, temperature, prefix_key=prefix_key)
+
+        future = Future()
+        raw.add_done_callback(lambda f: future.set_result(validate_result(f.result())))
+        return future
+
+    def resolve_adapter(self, experiment: str, user_id: int | None = None):
+        """Adapter for a local generation under experiment/user, or None to use the base model."""
+        if self.model_type != "local" or experiment not in ADAPTER_EXPERIMENTS:
+            return None
+        try:
+            return get_model_registry().adapter(self.local_model_name, experiment, user_id)
+        except Exception as e:
+            print(f"Failed to load adapter for {experiment} (user {user_id}): {e}")
+            return None
+
+    def exp_generate_batch(self, count, max_length=DEFAULT_MAX_LENGTH, num_return_sequences=DEFAULT_NUM_RETURN_SEQUENCES, temperature=DEFAULT_TEMPERATURE):
+        """Generate count texts for the active experiment, letting the engine batch them."""
+        futures = [self.exp_submit_text(max_length, num_return_sequences, temperature) for _ in range(count)]
+        return [f.result() for f in futures]
+
+    def submit_text(self, prompt, max_length=DEFAULT_MAX_LENGTH, num_return_sequences=DEFAULT_NUM_RETURN_SEQUENCES, temperature=DEFAULT_TEMPERATURE,
+                    prefix_key=None, adapter=None) -> Future:
+        """Submit a prompt for generation. Local prompts are batched by the engine,
+        API prompts run concurrently under the account's rate limits.
+
+        Generations that pass the same prefix_key (see build_prompt) let the local
+        engine reuse the KV cache of their shared prompt prefix. adapter (local
+        only) runs the prompt through a loaded soft prompt or LoRA adapter.
+        """
+        if self.model_type == "local":
+            if self.engine is None:
+                future = Future()
+                future.set_result({"error": "Text generation model not initialized"})
+                return future
+            return self.engine.submit(prompt, max_length, temperature, prefix_key=prefix_key, adapter=adapter)
+        if self.model_type == "gpt-5":
+            if self.api_engine is None:
+                future = Future()
+                future.set_result({"error": "OpenAI client not initialized"})
+                return future
+            return self.api_engine.submit(prompt)
+        future = Future()
+        future.set_result(self.generate_text(prompt, max_length, num_return_sequences, temperature))
+        return future
+
+    @property
+    def max_concurrency(self) -> int:
+        """How many generations the active backend can usefully run at once."""
+        if self.engine is not None:
+            return self.engine.max_batch_size
+        if self.api_engine is not None:
+            return self.api_engine.max_in_flight
+        return 1
+
+    def generation_metrics(self) -> dict:
+        """Throughput metrics for the active generation backend."""
+        metrics = {'registry': get_model_registry().metrics(), 'post_validity': validity_stats.metrics()}
+        if self.engine is not None:
+            metrics['local'] = self.engine.metrics()
+        if self.api_engine is not None:
+            metrics['api'] = self.api_engine.metrics()
+        return metrics
 
     def generate_text(self, prompt, max_length=DEFAULT_MAX_LENGTH, num_return_sequences=DEFAULT_NUM_RETURN_SEQUENCES, temperature=DEFAULT_TEMPERATURE):
         """Generate text using the pipeline.
@@ -148,6 +254,8 @@ class LLMService:
         Returns:
             dict: Generated text or error message
         """
+        # Cheap after the first call: models are shared through the registry
+        self.ensure_experiment_initialized()
         if self.model_type == "local":
             return self.generate_text_local(prompt, max_length, num_return_sequences, temperature)
         elif self.model_type == "gpt-5":
@@ -158,65 +266,16 @@ class LLMService:
             raise ValueError(f"Invalid model type: {self.model_type}")
         
     def generate_text_local(self, prompt, max_length=DEFAULT_MAX_LENGTH, num_return_sequences=DEFAULT_NUM_RETURN_SEQUENCES, temperature=DEFAULT_TEMPERATURE):
-        """Generate text using the local model."""
-        if self.local_model is None:
+        """Generate text using the local model (via the batching engine)."""
+        if self.local_model is None or self.engine is None:
             return {"error": "Text generation model not initialized"}
-            
-        try:
-            messages = [{"role": "user", "content": prompt}]
-            text = self.tokenizer.apply_chat_template(
-                messages,
-                tokenize=True,
-                add_generation_prompt=True
-            )
-    
-            inputs = self.tokenizer.apply_chat_template(
-                messages,
-                add_generation_prompt=True,
-                tokenize=True,
-                return_dict=True,
-                return_tensors="pt",
-            ).to(self.local_model.device)
-            
-            outputs = self.local_model.generate(    
-                **inputs,
-                max_length=max_length,
-                temperature=temperature
-            )
-            
-            prompt_length = inputs["input_ids"].size(-1)
-            generated_ids = outputs[0, prompt_length:].tolist()
-            content = self.tokenizer.decode(generated_ids, skip_special_tokens=True)
-
-            print(f"generated: {content}")
-            return {"generated_text": content}
-        except Exception as e:
-            return {"error": f"Text generation failed: {str(e)}"}
+        return self.engine.submit(prompt, max_length, temperature).result()
     
     def generate_text_api(self, prompt, max_length=DEFAULT_MAX_LENGTH, num_return_sequences=DEFAULT_NUM_RETURN_SEQUENCES, temperature=DEFAULT_TEMPERATURE):
         """Generate text using the OpenAI API."""
-        try:
-            response = self.api_client.responses.create(
-                model=OPENAI_MODEL_NAME,
-                input=prompt,
-                # temperature=temperature,
-                # The Responses API uses max_output_tokens
-                # max_output_tokens=max_length,
-            )
-
-            # Prefer the helper property when available
-            text = getattr(response, "output_text", None)
-            if not text:
-                # Fallback to structured parsing
-                try:
-                    text = response.output[0].content[0].text
-                except Exception:
-                    text = str(response)
-
-            print(f"generated post: {text}") #TODO: remove
-            return {"generated_text": text}
-        except Exception as e:
-            return {"error": f"OpenAI generation failed: {str(e)}"}
+        if self.api_engine is None:
+            return {"error": "OpenAI client not initialized"}
+        return self.api_engine.submit(prompt).result()
         
     def generate_image_api(self, prompt, max_length=DEFAULT_MAX_LENGTH, num_return_sequences=DEFAULT_NUM_RETURN_SEQUENCES, temperature=DEFAULT_TEMPERATURE):
         """Generate image using the OpenAI API."""
@@ -228,5 +287,12 @@ class LLMService:
 
 
 def get_llm_service(model,experiment):
-    """Get an instance of the LLM service."""
+    """Get an instance of the LLM service.
+
+    In a serve.py web worker this is a proxy to the producer process, so models
+    are only ever loaded there.
+    """
+    if AI_BROKER_ROLE == 'worker':
+        from ai_broker import RemoteLLMService, get_broker_client
+        return RemoteLLMService(get_broker_client(), experiment)
     return LLMService(model,experiment) 
@@ -0,0 +1,277 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from config import (
+    OPENAI_API_KEY,
+    OPENAI_BASE_URL,
+    API_MAX_IN_FLIGHT,
+    API_REQUESTS_PER_MINUTE,
+    API_TOKENS_PER_MINUTE,
+    API_MAX_RETRIES,
+    LOCAL_BATCH_MAX_SIZE,
+    LOCAL_BATCH_WAIT_MS,
+    PREFIX_CACHE_MAX_MB,
+    PREFIX_CACHE_MIN_TOKENS,
+    ADAPTER_CACHE_MAX_MB,
+    ADAPTER_CACHE_MAX_COUNT,
+    DRAFT_MODEL_NAME,
+    DRAFT_NUM_TOKENS,
+)
+
+
+@dataclass
+class LocalModel:
+    """A loaded base model with its tokenizer and the engine that batches its generations."""
+    name: str
+    tokenizer: Any
+    model: Any
+    engine: Any
+
+
+@dataclass
+class ApiModel:
+    """A shared OpenAI client and its concurrent generator."""
+    name: str
+    client: Any
+    engine: Any
+
+
+class AdapterCache:
+    """LRU of loaded adapters bounded by total bytes and count.
+
+    Loaders return (adapter, nbytes) and run outside the lock, so hits on other
+    adapters never wait behind a disk load; concurrent misses on the same key
+    share one load through an in-flight future. on_evict(key, adapter) is called
+    outside the lock when an adapter is dropped, so the owner can detach it
+    from the base model.
+    """
+
+    def __init__(self, max_bytes: int, max_count: int, on_evict: Optional[Callable[[Any, Any], None]] = None):
+        self.max_bytes = max_bytes
+        self.max_count = max(1, max_count)
+        self.on_evict = on_evict
+        self._entries: 'OrderedDict[Any, Tuple[Any, int]]' = OrderedDict()
+        self._bytes = 0
+        self._loading: Dict[Any, Future] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.loads = 0
+        self.evictions = 0
+
+    def get(self, key, loader: Callable[[], Tuple[Any, int]]):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            pending = self._loading.get(key)
+            if pending is None:
+                pending = self._loading[key] = Future()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            # Another thread is loading this adapter; raises if its load failed
+            return pending.result()
+        try:
+            adapter, nbytes = loader()
+        except BaseException as e:
+            with self._lock:
+                self._loading.pop(key, None)
+            pending.set_exception(e)
+            raise
+        with self._lock:
+            self._loading.pop(key, None)
+            self.loads += 1
+            self._entries[key] = (adapter, nbytes)
+            self._bytes += nbytes
+            evicted = self._evict(keep=key)
+        pending.set_result(adapter)
+        for old_key, old_adapter in evicted:
+            if self.on_evict is not None:
+                try:
+                    self.on_evict(old_key, old_adapter)
+                except Exception as e:
+                    print(f"[registry] Failed to release adapter {old_key}: {e}")
+        return adapter
+
+    def _evict(self, keep):
+        evicted = []
+        while self._entries and (self._bytes > self.max_bytes or len(self._entries) > self.max_count):
+            old_key = next(iter(self._entries))
+            if old_key == keep:
+                break
+            old_adapter, nbytes = self._entries.pop(old_key)
+            self._bytes -= nbytes
+            self.evictions += 1
+            evicted.append((old_key, old_adapter))
+            print(f"[registry] Evicted adapter {old_key} ({nbytes / 1e6:.1f} MB)")
+        return evicted
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'adapters': [str(k) for k in self._entries],
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'loads': self.loads,
+                'evictions': self.evictions,
+            }
+
+
+class ModelRegistry:
+    """Process-wide home of loaded models, shared by every LLMService.
+
+    Each base model is loaded once no matter how many services or experiments
+    use it; experiments only swap prompts and adapters on top of it.
+    """
+
+    def __init__(self):
+        self._local: Dict[str, LocalModel] = {}
+        self._api: Dict[str, ApiModel] = {}
+        self._lock = threading.Lock()
+        self.adapters = AdapterCache(
+            max_bytes=int(ADAPTER_CACHE_MAX_MB * 1024 * 1024),
+            max_count=ADAPTER_CACHE_MAX_COUNT,
+            on_evict=self._release_adapter,
+        )
+
+    def local(self, model_name: str) -> Optional[LocalModel]:
+        """Load (once) and return a local causal LM, or None if it cannot be loaded."""
+        loaded = self._local.get(model_name)
+        if loaded is not None:
+            return loaded
+        with self._lock:
+            loaded = self._local.get(model_name)
+            if loaded is None:
+                loaded = self._load_local(model_name)
+                if loaded is not None:
+                    self._local[model_name] = loaded
+        return loaded
+
+    def _load_local(self, model_name: str) -> Optional[LocalModel]:
+        # Lazy import heavy deps only if local model is requested
+        try:
+            from transformers import AutoTokenizer, AutoModelForCausalLM
+            import torch  # noqa: F401
+        except Exception as e:
+            print(f"Local LLM dependencies not available: {e}")
+            return None
+        from generation_engine import BatchedGenerationEngine, PrefixCache, SpeculativeDecoder
+        try:
+            print(f"[registry] Loading local model {model_name}")
+            # quantization_config = BitsAndBytesConfig(
+            #     load_in_4bit=True,
+            #     # llm_int8_enable_fp32_cpu_offload=True
+            # )
+            tokenizer = AutoTokenizer.from_pretrained(model_name)
+            model = AutoModelForCausalLM.from_pretrained(
+                model_name,
+                device_map="auto",
+                # quantization_config=quantization_config,
+                torch_dtype="auto"
+            )
+            speculative = None
+            if DRAFT_MODEL_NAME:
+                print(f"[registry] Loading draft model {DRAFT_MODEL_NAME}")
+                draft_tokenizer = AutoTokenizer.from_pretrained(DRAFT_MODEL_NAME)
+                draft_model = AutoModelForCausalLM.from_pretrained(
+                    DRAFT_MODEL_NAME,
+                    device_map="auto",
+                    torch_dtype="auto"
+                )
+                speculative = SpeculativeDecoder(model, draft_model, DRAFT_NUM_TOKENS, tokenizer, draft_tokenizer)
+            engine = BatchedGenerationEngine(
+                tokenizer,
+                model,
+                max_batch_size=LOCAL_BATCH_MAX_SIZE,
+                wait_ms=LOCAL_BATCH_WAIT_MS,
+                prefix_cache=PrefixCache(
+                    model,
+                    max_bytes=int(PREFIX_CACHE_MAX_MB * 1024 * 1024),
+                    min_tokens=PREFIX_CACHE_MIN_TOKENS,
+                ),
+                speculative=speculative,
+            )
+            return LocalModel(model_name, tokenizer, model, engine)
+        except Exception as e:
+            print(f"Error initializing lm: {e}")
+            return None
+
+    def adapter(self, model_name: str, experiment: str, user_id: Optional[int] = None):
+        """Adapter serving experiment (and user) on a local model, loading it on first use.
+
+        Returns None when the experiment has no trained adapter on disk.
+        """
+        from adapters import adapter_path, adapter_name, load_adapter
+        path = adapter_path(experiment, user_id)
+        if path is None:
+            return None
+        loaded = self.local(model_name)
+        if loaded is None:
+            return None
+        name = adapter_name(path)
+
+        def loader():
+            adapter = load_adapter(loaded.engine, name, path)
+            return adapter, adapter.nbytes
+
+        return self.adapters.get((model_name, name), loader)
+
+    def _release_adapter(self, key, adapter) -> None:
+        from adapters import release_adapter
+        loaded = self._local.get(key[0])
+        if loaded is not None:
+            release_adapter(loaded.engine, adapter)
+
+    def api(self, model_name: str) -> ApiModel:
+        """Return the shared OpenAI client and generator for model_name."""
+        loaded = self._api.get(model_name)
+        if loaded is not None:
+            return loaded
+        with self._lock:
+            loaded = self._api.get(model_name)
+            if loaded is None:
+                from openai import OpenAI
+                from api_engine import ConcurrentApiGenerator
+                # ConcurrentApiGenerator retries and paces requests itself; SDK retries would multiply its attempts
+                client = OpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL, max_retries=0)
+                engine = ConcurrentApiGenerator(
+                    client,
+                    model_name,
+                    max_in_flight=API_MAX_IN_FLIGHT,
+                    requests_per_minute=API_REQUESTS_PER_MINUTE,
+                    tokens_per_minute=API_TOKENS_PER_MINUTE,
+                    max_retries=API_MAX_RETRIES,
+                )
+                loaded = self._api[model_name] = ApiModel(model_name, client, engine)
+        return loaded
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            'local_models': list(self._local),
+            'api_models': list(self._api),
+            'adapters': self.adapters.metrics(),
+        }
+
+
+_registry: Optional[ModelRegistry] = None
+_registry_lock = threading.Lock()
+
+
+def get_model_registry() -> ModelRegistry:
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = ModelRegistry()
+    return _registry
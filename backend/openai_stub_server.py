@@ -0,0 +1,83 @@
+"""Minimal local stand-in for the OpenAI Responses API.
+
+Point the server at it to exercise concurrent API generation without an API key:
+
+    python openai_stub_server.py --port 8089 --latency 1.5 --rate-limit 0.1
+    OPENAI_BASE_URL=http://127.0.0.1:8089/v1 OPENAI_API_KEY=stub python server.py --model gpt-5 --background
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SAMPLE_POST = "title: My Example Post Title\nself_text: This is a stub generation.\nsubreddit: NoStupidQuestions"
+
+
+def make_handler(latency: float, rate_limit: float, error_rate: float):
+    counter = {'n': 0}
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, status: int, body: dict, headers=None):
+            payload = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            request = json.loads(self.rfile.read(length) or b'{}')
+            if not self.path.endswith('/responses'):
+                self._send(404, {'error': {'message': 'not found'}})
+                return
+            roll = random.random()
+            if roll < rate_limit:
+                self._send(429, {'error': {'message': 'rate limited', 'type': 'rate_limit'}}, {'retry-after': '1'})
+                return
+            if roll < rate_limit + error_rate:
+                self._send(500, {'error': {'message': 'stub failure'}})
+                return
+            time.sleep(latency)
+            with lock:
+                counter['n'] += 1
+                n = counter['n']
+            text = SAMPLE_POST.replace('My Example Post Title', f'Stub post #{n}')
+            self._send(200, {
+                'id': f'resp_{n}',
+                'object': 'response',
+                'created_at': int(time.time()),
+                'model': request.get('model', 'stub'),
+                'status': 'completed',
+                'output': [{
+                    'id': f'msg_{n}',
+                    'type': 'message',
+                    'role': 'assistant',
+                    'status': 'completed',
+                    'content': [{'type': 'output_text', 'text': text, 'annotations': []}],
+                }],
+                'usage': {'input_tokens': 100, 'output_tokens': 30, 'total_tokens': 130},
+            })
+
+        def log_message(self, fmt, *args):
+            pass
+
+    return Handler
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stub of the OpenAI Responses API')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency', type=float, default=1.0, help='Seconds per successful response')
+    parser.add_argument('--rate-limit', type=float, default=0.0, help='Fraction of requests answered with 429')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests answered with 500')
+    cli_args = parser.parse_args()
+    server = ThreadingHTTPServer(('127.0.0.1', cli_args.port),
+                                 make_handler(cli_args.latency, cli_args.rate_limit, cli_args.error_rate))
+    print(f"OpenAI stub listening on http://127.0.0.1:{cli_args.port}/v1")
+    server.serve_forever()
@@ -0,0 +1,295 @@
+import json
+import re
+import threading
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+# Every generated post has exactly these fields, in this order
+POST_FIELDS = ('title', 'self_text', 'subreddit')
+
+# Text the assistant turn is prefilled with in structured mode
+TITLE_PREFILL = 'title: '
+
+# Chat/end-of-sequence markers models leak into their output (e.g. "copypasta<eos>")
+SPECIAL_TOKEN_RE = re.compile(
+    r'<\s*/?\s*(?:eos|bos|s|pad|unk|end_of_turn|start_of_turn|\|[a-z_]+\|)\s*>',
+    re.IGNORECASE,
+)
+FIELD_RE = re.compile(r'^[\s*#>_`-]*(title|self_text|subreddit)[\s*_`]*:[\s*`]*', re.IGNORECASE | re.MULTILINE)
+# Structured output: a JSON object, optionally inside a ```json fence
+JSON_START_RE = re.compile(r'^\s*(?:```(?:json)?\s*)?\{', re.IGNORECASE)
+SUBREDDIT_RE = re.compile(r'^[A-Za-z0-9][A-Za-z0-9_]{1,20}$')
+
+MAX_TITLE_LENGTH = 300
+
+# Schema for OpenAI structured outputs (Responses API `text.format`). Strict mode
+# rejects string length keywords, so parse_post checks the title length instead
+POST_JSON_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'title': {'type': 'string'},
+        'self_text': {'type': 'string'},
+        'subreddit': {'type': 'string', 'pattern': '^[A-Za-z0-9][A-Za-z0-9_]{1,20}$'},
+    },
+    'required': list(POST_FIELDS),
+    'additionalProperties': False,
+}
+POST_TEXT_FORMAT = {
+    'format': {
+        'type': 'json_schema',
+        'name': 'reddit_post',
+        'schema': POST_JSON_SCHEMA,
+        'strict': True,
+    }
+}
+
+
+class PostValidationError(ValueError):
+    """Raised when generated text does not hold a valid post; reason names the failed check."""
+
+    def __init__(self, reason: str, message: str = ''):
+        super().__init__(message or reason)
+        self.reason = reason
+
+
+def strip_special_tokens(text: str) -> str:
+    return SPECIAL_TOKEN_RE.sub('', text or '')
+
+
+def _clean(value: Any) -> str:
+    return strip_special_tokens(str(value or '')).strip().strip('*').strip()
+
+
+def _fields_from_json(text: str) -> Optional[Dict[str, str]]:
+    start, end = text.find('{'), text.rfind('}')
+    if start < 0 or end <= start:
+        return None
+    try:
+        data = json.loads(text[start:end + 1])
+    except ValueError:
+        return None
+    if not isinstance(data, dict):
+        return None
+    return {name: data.get(name) for name in POST_FIELDS}
+
+
+def _fields_from_lines(text: str) -> Dict[str, str]:
+    fields: Dict[str, str] = {}
+    matches = list(FIELD_RE.finditer(text))
+    for i, match in enumerate(matches):
+        name = match.group(1).lower()
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(text)
+        # Keep the first occurrence; models sometimes repeat the template afterwards
+        fields.setdefault(name, text[match.end():end])
+    return fields
+
+
+def parse_post(text: str) -> Dict[str, Any]:
+    """Parse generated text (line format or JSON) into a validated post dict.
+
+    Raises PostValidationError when a field is missing or invalid.
+    """
+    text = strip_special_tokens(text)
+    # Only structured output is a JSON object (possibly fenced); braces inside a line-format self_text are not
+    fields = _fields_from_json(text) if JSON_START_RE.match(text) else None
+    if fields is None or (fields['title'] is None and fields['subreddit'] is None):
+        fields = _fields_from_lines(text)
+    missing = [name for name in POST_FIELDS if fields.get(name) is None]
+    if missing:
+        raise PostValidationError('missing_field', f"missing {', '.join(missing)}")
+
+    title = _clean(fields['title'])
+    self_text = _clean(fields['self_text'])
+    subreddit = _clean(fields['subreddit']).split()[0] if _clean(fields['subreddit']) else ''
+    # Remove 'r/' prefix if present
+    if subreddit.lower().startswith('r/'):
+        subreddit = subreddit[2:]
+    subreddit = subreddit.rstrip('.,;:!')
+
+    if not title:
+        raise PostValidationError('empty_title')
+    if len(title) > MAX_TITLE_LENGTH or '\n' in title:
+        raise PostValidationError('bad_title')
+    if not SUBREDDIT_RE.match(subreddit):
+        raise PostValidationError('bad_subreddit', f"bad subreddit {subreddit!r}")
+    return {
+        'title': title,
+        'self_text': self_text,
+        'subreddit': subreddit,
+        # post_id will be assigned from archive id (ai-<id>) when enqueuing
+        'over_18': 'false',
+        'link_flair_text': 'AI',
+        'is_ai': True,
+    }
+
+
+class PostValidityStats:
+    """Counts how many generations produced a valid post, and why the rest failed."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts: Counter = Counter()
+
+    def record(self, reason: Optional[str]) -> None:
+        with self._lock:
+            self._counts['attempts'] += 1
+            self._counts['valid' if reason is None else f'invalid_{reason}'] += 1
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._counts)
+        attempts = stats.get('attempts', 0)
+        stats['validity_rate'] = stats.get('valid', 0) / attempts if attempts else 0.0
+        return stats
+
+
+validity_stats = PostValidityStats()
+
+
+def validate_result(result: Dict[str, Any]) -> Dict[str, Any]:
+    """Turn a {"generated_text"} result into {"post", "generated_text"} or {"error", "reason"}."""
+    if "error" in result:
+        validity_stats.record('generation_error')
+        return result
+    text = result.get("generated_text", "")
+    try:
+        post = parse_post(text)
+    except PostValidationError as e:
+        validity_stats.record(e.reason)
+        return {"error": f"Invalid post: {e}", "reason": e.reason, "generated_text": text}
+    validity_stats.record(None)
+    return {"post": post, "generated_text": text}
+
+
+# Token ids whose text contains a newline, per tokenizer (expensive to compute, so shared)
+_newline_ids: Dict[int, List[int]] = {}
+_newline_lock = threading.Lock()
+
+
+def _newline_token_ids(tokenizer) -> List[int]:
+    key = id(tokenizer)
+    with _newline_lock:
+        ids = _newline_ids.get(key)
+        if ids is None:
+            ids = [i for i in range(len(tokenizer)) if '\n' in tokenizer.decode([i])]
+            _newline_ids[key] = ids
+    return ids
+
+
+class PostFormatLogitsProcessor:
+    """Keeps local generations inside the title / self_text / subreddit grammar.
+
+    Generation starts after a "title: " prefill. Per row it tracks which field is
+    being written and masks the logits so that:
+    - the title is non-empty and single-line, and its newline is followed by a
+      forced "self_text: " label
+    - EOS is banned until a non-empty subreddit value has been written
+    - a "subreddit: " label is forced once the self_text has used up the token
+      budget (max_new_tokens, minus room for the label and a subreddit) or the
+      model puts most of its probability on EOS
+    - the subreddit is a single token-ish word, after which EOS is forced
+    Instances are callable like transformers LogitsProcessors.
+    """
+
+    # Tokens kept back from the self_text for a subreddit value and EOS
+    SUBREDDIT_RESERVE = 8
+
+    def __init__(self, tokenizer, prompt_length: int, max_new_tokens: Optional[int] = None):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.max_new_tokens = max_new_tokens
+        self.eos_ids = self._eos_ids(tokenizer)
+        self.newline_ids = _newline_token_ids(tokenizer)
+        self.self_text_ids = tokenizer('\nself_text: ', add_special_tokens=False)['input_ids']
+        self.subreddit_ids = tokenizer('\nsubreddit: ', add_special_tokens=False)['input_ids']
+        self._rows: Dict[int, Dict[str, Any]] = {}
+
+    @staticmethod
+    def _eos_ids(tokenizer) -> List[int]:
+        ids = tokenizer.eos_token_id
+        ids = list(ids) if isinstance(ids, (list, tuple)) else [ids]
+        for token in ('<end_of_turn>', '<|eot_id|>', '<|im_end|>'):
+            token_id = tokenizer.convert_tokens_to_ids(token)
+            if isinstance(token_id, int) and token_id != tokenizer.unk_token_id and token_id not in ids:
+                ids.append(token_id)
+        return [i for i in ids if i is not None]
+
+    def _row(self, i: int) -> Dict[str, Any]:
+        row = self._rows.get(i)
+        if row is None:
+            row = self._rows[i] = {'field': 'title', 'value': '', 'seen': 0, 'forced': []}
+        return row
+
+    def _advance(self, row: Dict[str, Any], new_ids: List[int]) -> None:
+        for token_id in new_ids:
+            if row['forced']:
+                row['forced'].pop(0)
+                continue
+            piece = self.tokenizer.decode([token_id])
+            if row['field'] == 'title':
+                if '\n' in piece and row['value'].strip():
+                    # Skip the newline itself; the label follows as forced tokens
+                    row['field'], row['value'] = 'self_text', ''
+                    row['forced'] = list(self.self_text_ids[1:]) if self._starts_with_newline() else list(self.self_text_ids)
+                    continue
+                row['value'] += piece
+            elif row['field'] == 'self_text':
+                row['value'] += piece
+                tail = row['value'][-40:].lower()
+                if 'subreddit:' in tail:
+                    row['field'] = 'subreddit'
+                    row['value'] = row['value'][row['value'].lower().rfind('subreddit:') + len('subreddit:'):]
+            elif row['field'] == 'subreddit':
+                row['value'] += piece
+            else:
+                break
+
+    def _starts_with_newline(self) -> bool:
+        return bool(self.self_text_ids) and '\n' in self.tokenizer.decode([self.self_text_ids[0]])
+
+    def _only(self, scores, i: int, token_ids: List[int]) -> None:
+        import torch
+        keep = scores[i, token_ids].clone()
+        scores[i, :] = -float('inf')
+        scores[i, token_ids] = keep if torch.isfinite(keep).any() else 0.0
+
+    def _should_close_self_text(self, row: Dict[str, Any], scores, i: int, generated: int) -> bool:
+        """True once the self_text must end: the budget is nearly spent or the model wants EOS."""
+        if self.max_new_tokens is not None:
+            if self.max_new_tokens - generated <= len(self.subreddit_ids) + self.SUBREDDIT_RESERVE:
+                return True
+        if not row['value'].strip():
+            return False
+        import torch
+        return torch.softmax(scores[i].float(), dim=-1)[self.eos_ids].sum().item() >= 0.5
+
+    def __call__(self, input_ids, scores):
+        generated = input_ids[:, self.prompt_length:]
+        for i in range(scores.size(0)):
+            row = self._row(i)
+            ids = generated[i].tolist()
+            self._advance(row, ids[row['seen']:])
+            row['seen'] = len(ids)
+            if row['field'] == 'done':
+                continue
+            if row['field'] == 'self_text' and not row['forced'] and self._should_close_self_text(row, scores, i, len(ids)):
+                # Write the label for the model; its tokens are skipped by _advance
+                row['field'], row['value'] = 'subreddit', ''
+                row['forced'] = list(self.subreddit_ids)
+            if row['forced']:
+                self._only(scores, i, [row['forced'][0]])
+                continue
+            value = row['value'].strip()
+            if row['field'] == 'subreddit':
+                if value and (row['value'][-1:].isspace() or len(value) > 21):
+                    row['field'] = 'done'
+                    self._only(scores, i, self.eos_ids)
+                    continue
+                scores[i, self.eos_ids] = -float('inf')
+                if not value:
+                    scores[i, self.newline_ids] = -float('inf')
+                continue
+            scores[i, self.eos_ids] = -float('inf')
+            if row['field'] == 'title' and not value:
+                scores[i, self.newline_ids] = -float('inf')
+        return scores
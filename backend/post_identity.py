@@ -0,0 +1,160 @@
+"""Mapping between the post ids the feed hands out and database rows.
+
+Every post served by /feed carries a post_id of the form "post-<id>",
+"humor-<id>" or "ai-<id>", naming the primary key of posts, humorposts or
+ai_generated_posts. Interaction handlers resolve those by primary key. Payloads
+without one (older clients) fall back to the legacy fields: the numeric id of
+a real post, then its title via the indexed posts.title_hash.
+"""
+import hashlib
+import random
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import or_, select, tuple_
+from sqlalchemy.dialects.postgresql import insert
+
+from db.models import AiGeneratedPost, HumorPost, Post
+
+POST_PREFIX = 'post-'
+HUMOR_PREFIX = 'humor-'
+AI_PREFIX = 'ai-'
+KIND_PREFIXES = {'post': POST_PREFIX, 'humor': HUMOR_PREFIX, 'ai': AI_PREFIX}
+
+
+def title_hash(title: Optional[str]) -> int:
+    """Signed 64-bit prefix of md5(title), matching the SQL backfill in db.seed."""
+    digest = hashlib.md5((title or '').encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big', signed=True)
+
+
+def post_ref(kind: str, pk: int) -> str:
+    return f"{KIND_PREFIXES[kind]}{pk}"
+
+
+@dataclass
+class PostRef:
+    """A parsed reference to a post: by primary key, or by title when pk is None."""
+    kind: str  # 'post', 'humor' or 'ai'
+    pk: Optional[int] = None
+    title: Optional[str] = None
+    subreddit: Optional[str] = None
+
+
+def parse_ref(post: Dict[str, Any]) -> PostRef:
+    """Work out which row a client post payload refers to. Raises ValueError if malformed."""
+    external = post.get('post_id')
+    if isinstance(external, str):
+        for kind, prefix in KIND_PREFIXES.items():
+            if external.startswith(prefix):
+                pk = external[len(prefix):]
+                if pk.isdigit():
+                    return PostRef(kind, int(pk))
+                if kind == 'humor':
+                    # Legacy humor ids were not numeric; fall back to title and subreddit
+                    return PostRef('humor', title=post.get('title') or '', subreddit=post.get('subreddit') or '')
+                raise ValueError(f"bad post_id {external!r}")
+    humor_id = post.get('humor_id')
+    if humor_id is not None:
+        try:
+            return PostRef('humor', int(humor_id))
+        except (TypeError, ValueError):
+            raise ValueError(f"bad humor_id {humor_id!r}")
+    if isinstance(post.get('id'), int) and not post.get('is_ai'):
+        return PostRef('post', post['id'])
+    return PostRef('post', title=post.get('title') or '')
+
+
+def _clip(value: Any, column) -> Any:
+    """Cut a client-supplied string to the length of its VARCHAR column."""
+    length = column.type.length
+    if isinstance(value, str) and length and len(value) > length:
+        return value[:length]
+    return value
+
+
+def _new_post_row(post: Dict[str, Any]) -> Dict[str, Any]:
+    title = post.get('title', '') or ''
+    return {
+        'title': title,
+        'self_text': post.get('self_text', '') or '',
+        'subreddit': _clip(post.get('subreddit'), Post.__table__.c.subreddit),
+        'over_18': str(post.get('over_18', 'false')).lower() == 'true',
+        'link_flair_text': _clip(post.get('link_flair_text'), Post.__table__.c.link_flair_text),
+        'is_ai': bool(post.get('is_ai', False)),
+        'random_key': random.getrandbits(63),
+        'title_hash': title_hash(title),
+    }
+
+
+def resolve_refs(session, refs: List[PostRef], posts: List[Dict[str, Any]]) -> List[Optional[Tuple[int, bool]]]:
+    """Resolve refs to (primary key, is_ai) with at most one query per table.
+
+    posts are the payloads the refs came from. A real post referenced only by a
+    title that is not in the table yet is created from its payload with one
+    multi-row INSERT. Unknown primary keys resolve to None.
+    """
+    ids = {kind: {r.pk for r in refs if r.kind == kind and r.pk is not None} for kind in KIND_PREFIXES}
+    humor_keys = {(r.title, r.subreddit) for r in refs if r.kind == 'humor' and r.pk is None}
+    titles = {r.title for r in refs if r.kind == 'post' and r.pk is None}
+
+    found_ai = set()
+    if ids['ai']:
+        found_ai = set(session.execute(
+            select(AiGeneratedPost.id).where(AiGeneratedPost.id.in_(ids['ai']))
+        ).scalars())
+
+    found_humor = set()
+    humor_by_key: Dict[Tuple[str, str], int] = {}
+    if ids['humor'] or humor_keys:
+        conditions = []
+        if ids['humor']:
+            conditions.append(HumorPost.id.in_(ids['humor']))
+        if humor_keys:
+            conditions.append(tuple_(HumorPost.title, HumorPost.subreddit).in_(list(humor_keys)))
+        rows = session.execute(
+            select(HumorPost.id, HumorPost.title, HumorPost.subreddit).where(or_(*conditions)).order_by(HumorPost.id)
+        ).all()
+        for hid, title, subreddit in rows:
+            found_humor.add(hid)
+            humor_by_key.setdefault((title, subreddit), hid)
+
+    posts_by_id: Dict[int, bool] = {}
+    posts_by_title: Dict[str, Tuple[int, bool]] = {}
+    if ids['post'] or titles:
+        conditions = []
+        if ids['post']:
+            conditions.append(Post.id.in_(ids['post']))
+        if titles:
+            conditions.append(Post.title_hash.in_({title_hash(t) for t in titles}))
+        rows = session.execute(
+            select(Post.id, Post.title, Post.is_ai).where(or_(*conditions)).order_by(Post.id)
+        ).all()
+        for pid, title, is_ai in rows:
+            posts_by_id[pid] = bool(is_ai)
+            # The hash only narrows the lookup; the title itself must match
+            if title in titles:
+                posts_by_title.setdefault(title, (pid, bool(is_ai)))
+        missing = {}
+        for ref, post in zip(refs, posts):
+            if ref.kind == 'post' and ref.pk is None and ref.title not in posts_by_title and ref.title not in missing:
+                missing[ref.title] = _new_post_row(post)
+        if missing:
+            created = session.execute(
+                insert(Post).values(list(missing.values())).returning(Post.id, Post.title, Post.is_ai)
+            ).all()
+            for pid, title, is_ai in created:
+                posts_by_title.setdefault(title, (pid, bool(is_ai)))
+
+    resolved: List[Optional[Tuple[int, bool]]] = []
+    for ref in refs:
+        if ref.kind == 'ai':
+            resolved.append((ref.pk, True) if ref.pk in found_ai else None)
+        elif ref.kind == 'humor':
+            pk = ref.pk if ref.pk is not None else humor_by_key.get((ref.title, ref.subreddit))
+            resolved.append((pk, False) if pk in found_humor else None)
+        elif ref.pk is not None:
+            resolved.append((ref.pk, posts_by_id[ref.pk]) if ref.pk in posts_by_id else None)
+        else:
+            resolved.append(posts_by_title.get(ref.title))
+    return resolved
@@ -1,21 +1,16 @@
 import os
 import json
 from flask import Blueprint, jsonify, request, g
-from config import args, PROMPTS, PROMPTS_FILE
+from config import args, PROMPTS, PROMPTS_FILE, INTERACTION_WRITE_BEHIND
 from llm import get_llm_service
 from stats import (
     increment_ai_post_count,
     increment_real_post_count,
-    increment_liked_ai_post_count,
-    increment_liked_real_post_count,
-    increment_marked_as_ai,
-    increment_dislike,
+    count_interactions,
 )
 from auth import require_auth
-from db import db_session
-from db.models import Post, Interaction, HumorPost, AiGeneratedPost
-import random
-from sqlalchemy.exc import IntegrityError
+from interaction_writer import write_interactions
+from event_log import get_event_log
 
 # Create a Blueprint for post interactions
 post_interactions = Blueprint('post_interactions', __name__)
@@ -77,6 +72,34 @@ def summarize_preferences(post):
         json.dump(PROMPTS, f, indent=2)
     
 
+def _record(entries):
+    """Record (post, action) entries for the current user.
+
+    With INTERACTION_WRITE_BEHIND the entries are appended to the event log and
+    written by its background flusher, and None is returned. Otherwise (or if
+    the log is full or unavailable) they are written now and the per-item
+    outcomes are returned.
+    """
+    if INTERACTION_WRITE_BEHIND:
+        event_log = get_event_log()
+        if event_log is not None and event_log.append(
+            g.current_user_id,
+            getattr(g, 'current_experiment', None),
+            getattr(g, 'current_user_aware', None),
+            entries,
+        ):
+            return None
+    outcomes = write_interactions(g.current_user_id, entries)
+    count_interactions(outcomes)
+    return outcomes
+
+
+def _outcome_fields(outcomes):
+    if outcomes is None:
+        return {'queued': True}
+    return {'outcome': outcomes[0].to_dict()}
+
+
 @post_interactions.route('/like', methods=['POST'])
 @require_auth
 def like_post():
@@ -86,69 +109,15 @@ def like_post():
             return jsonify({'error': 'No post data provided'}), 400
 
         # summarize preferences if experiment is "summarize"
-        from flask import g
         current_exp = getattr(g, 'current_experiment', None) or 'base'
         if current_exp == "summarize":
             summarize_preferences(post)
 
-        # Persist interaction
-        with db_session() as session:
-            lookup_post_id = post.get('post_id')
-            humor_id = post.get('humor_id')
-            # Determine source and external id
-            if isinstance(lookup_post_id, str) and lookup_post_id.startswith('ai-'):
-                # Extract numeric id after ai-
-                try:
-                    ai_numeric_id = int(lookup_post_id.split('ai-')[-1])
-                except Exception:
-                    ai_numeric_id = None
-                interaction = Interaction(
-                    user_id=g.current_user_id,
-                    ai_id=ai_numeric_id,
-                    action='like'
-                )
-                session.add(interaction)
-            elif humor_id is not None:
-                hp = session.query(HumorPost).filter(HumorPost.id == humor_id).first()
-                interaction = Interaction(
-                    user_id=g.current_user_id,
-                    humor_id=hp.id if hp else None,
-                    action='like'
-                )
-                session.add(interaction)
-            else:
-                # Normal post flow; ensure Post exists and log by internal id
-                db_post = session.query(Post).filter(
-                    (Post.title == post.get('title'))
-                ).first()
-                if db_post is None:
-                    db_post = Post(
-                        title=post.get('title', ''),
-                        self_text=post.get('self_text', ''),
-                        subreddit=post.get('subreddit'),
-                        over_18=str(post.get('over_18', 'false')).lower() == 'true',
-                        link_flair_text=post.get('link_flair_text'),
-                        is_ai=bool(post.get('is_ai', False)),
-                        random_key=random.getrandbits(63),
-                    )
-                    session.add(db_post)
-                    session.flush()
-                interaction = Interaction(
-                    user_id=g.current_user_id,
-                    post_id=db_post.id,
-                    action='like'
-                )
-                session.add(interaction)
-        if post.get('is_ai', False):
-            increment_liked_ai_post_count()
-        else:
-            increment_liked_real_post_count()
-
+        outcomes = _record([(post, 'like')])
         return jsonify({
-            'message': 'Post liked successfully'
+            'message': 'Post liked successfully',
+            **_outcome_fields(outcomes),
         })
-    
-            
     except Exception as e:
         return jsonify({'error': 'Internal server error', 'message': str(e)}), 500
 
@@ -159,54 +128,8 @@ def dislike_post():
         post = request.get_json()
         if not post:
             return jsonify({'error': 'No post data provided'}), 400
-        with db_session() as session:
-            lookup_post_id = post.get('post_id')
-            humor_id = post.get('humor_id')
-            if isinstance(lookup_post_id, str) and lookup_post_id.startswith('ai-'):
-                try:
-                    ai_numeric_id = int(lookup_post_id.split('ai-')[-1])
-                except Exception:
-                    ai_numeric_id = None
-                interaction = Interaction(
-                    user_id=g.current_user_id,
-                    ai_id=ai_numeric_id,
-                    action='dislike'
-                )
-                session.add(interaction)
-            elif humor_id is not None:
-                hp = session.query(HumorPost).filter(HumorPost.id == humor_id).first()
-                interaction = Interaction(
-                    user_id=g.current_user_id,
-                    humor_id=hp.id if hp else None,
-                    action='dislike'
-                )
-                session.add(interaction)
-            else:
-                db_post = session.query(Post).filter(
-                    (Post.title == post.get('title'))
-                ).first()
-                if db_post is None:
-                    db_post = Post(
-                        title=post.get('title', ''),
-                        self_text=post.get('self_text', ''),
-                        subreddit=post.get('subreddit'),
-                        over_18=str(post.get('over_18', 'false')).lower() == 'true',
-                        link_flair_text=post.get('link_flair_text'),
-                        is_ai=bool(post.get('is_ai', False)),
-                        random_key=random.getrandbits(63),
-                    )
-                    session.add(db_post)
-                    session.flush()
-                interaction = Interaction(
-                    user_id=g.current_user_id,
-                    post_id=db_post.id,
-                    action='dislike'
-                )
-                session.add(interaction)
-        # Update dislike counters by true post type
-        increment_dislike(is_ai_post=bool(post.get('is_ai', False)))
-        return jsonify({'message': 'Post disliked successfully'})
-            
+        outcomes = _record([(post, 'dislike')])
+        return jsonify({'message': 'Post disliked successfully', **_outcome_fields(outcomes)})
     except Exception as e:
         return jsonify({'error': 'Internal server error', 'message': str(e)}), 500
 
@@ -223,50 +146,7 @@ def next_post():
         else:
             increment_real_post_count()
 
-        with db_session() as session:
-            lookup_post_id = post.get('post_id')
-            humor_id = post.get('humor_id')
-            if isinstance(lookup_post_id, str) and lookup_post_id.startswith('ai-'):
-                try:
-                    ai_numeric_id = int(lookup_post_id.split('ai-')[-1])
-                except Exception:
-                    ai_numeric_id = None
-                interaction = Interaction(
-                    user_id=g.current_user_id,
-                    ai_id=ai_numeric_id,
-                    action='next'
-                )
-                session.add(interaction)
-            elif humor_id is not None:
-                hp = session.query(HumorPost).filter(HumorPost.id == humor_id).first()
-                interaction = Interaction(
-                    user_id=g.current_user_id,
-                    humor_id=hp.id if hp else None,
-                    action='next'
-                )
-                session.add(interaction)
-            else:
-                db_post = session.query(Post).filter(
-                    (Post.title == post.get('title'))
-                ).first()
-                if db_post is None:
-                    db_post = Post(
-                        title=post.get('title', ''),
-                        self_text=post.get('self_text', ''),
-                        subreddit=post.get('subreddit'),
-                        over_18=str(post.get('over_18', 'false')).lower() == 'true',
-                        link_flair_text=post.get('link_flair_text'),
-                        is_ai=bool(post.get('is_ai', False)),
-                        random_key=random.getrandbits(63),
-                    )
-                    session.add(db_post)
-                    session.flush()
-                interaction = Interaction(
-                    user_id=g.current_user_id,
-                    post_id=db_post.id,
-                    action='next'
-                )
-                session.add(interaction)
+        _record([(post, 'next')])
         return jsonify({'message': 'Post processed successfully', 'post': post})
     
     except Exception as e:
@@ -283,77 +163,45 @@ def next_batch():
         if not isinstance(posts, list):
             return jsonify({'error': 'Invalid data provided. Expected {"posts": [...]}'}), 400
 
-        ai_count = 0
-        real_count = 0
-        with db_session() as session:
-            for post in posts:
-                if not isinstance(post, dict):
-                    continue
-                is_ai = bool(post.get('is_ai', False))
-                ai_count += 1 if is_ai else 0
-                real_count += 0 if is_ai else 1
-                lookup_post_id = post.get('post_id')
-                db_post = session.query(Post).filter(
-                    (Post.title == post.get('title'))
-                ).first()
-                if isinstance(lookup_post_id, str) and lookup_post_id.startswith('ai-'):
-                    try:
-                        ai_numeric_id = int(lookup_post_id.split('ai-')[-1])
-                    except Exception:
-                        ai_numeric_id = None
-                    try:
-                        session.add(Interaction(
-                            user_id=g.current_user_id,
-                            ai_id=ai_numeric_id,
-                            action='next'
-                        ))
-                        session.flush()
-                    except IntegrityError:
-                        session.rollback()
-                        continue
-                    continue
-                if isinstance(lookup_post_id, str) and lookup_post_id.startswith('humor-'):
-                    hp = session.query(HumorPost).filter(
-                        (HumorPost.title == post.get('title')) & (HumorPost.subreddit == post.get('subreddit'))
-                    ).first()
-                    try:
-                        session.add(Interaction(
-                            user_id=g.current_user_id,
-                            humor_id=hp.id if hp else None,
-                            action='next'
-                        ))
-                        session.flush()
-                    except IntegrityError:
-                        session.rollback()
-                        continue
-                    continue
-                if db_post is None:
-                    db_post = Post(
-                        title=post.get('title', ''),
-                        self_text=post.get('self_text', ''),
-                        subreddit=post.get('subreddit'),
-                        over_18=str(post.get('over_18', 'false')).lower() == 'true',
-                        link_flair_text=post.get('link_flair_text'),
-                        is_ai=is_ai,
-                        random_key=random.getrandbits(63),
-                    )
-                    session.add(db_post)
-                    session.flush()
-                try:
-                    session.add(Interaction(
-                        user_id=g.current_user_id,
-                        post_id=db_post.id,
-                        action='next'
-                    ))
-                    session.flush()
-                except IntegrityError:
-                    session.rollback()
-                    # Ignore duplicate next for same user/post
-                    continue
-
+        outcomes = _record([(post, 'next') for post in posts])
         # Stats are updated when the feed is served; do not double count here
 
-        return jsonify({'message': 'Batch processed successfully', 'count': len(posts)})
+        if outcomes is None:
+            return jsonify({'message': 'Batch queued', 'count': len(posts), 'queued': True})
+        return jsonify({
+            'message': 'Batch processed successfully',
+            'count': len(posts),
+            'outcomes': [o.to_dict() for o in outcomes],
+        })
+    except Exception as e:
+        return jsonify({'error': 'Internal server error', 'message': str(e)}), 500
+
+@post_interactions.route('/batch', methods=['POST'])
+@require_auth
+def interaction_batch():
+    """Record many interactions at once.
+
+    Body: {"items": [{"action": "like|dislike|next|markedai", "post": {...}}, ...]}.
+    Returns one outcome per item, in order.
+    """
+    try:
+        data = request.get_json() or {}
+        items = data.get('items', [])
+        if not isinstance(items, list):
+            return jsonify({'error': 'Invalid data provided. Expected {"items": [...]}'}), 400
+        entries = [
+            (item.get('post'), item.get('action')) if isinstance(item, dict) else (None, None)
+            for item in items
+        ]
+        outcomes = _record(entries)
+        if outcomes is None:
+            return jsonify({'message': 'Batch queued', 'count': len(items), 'queued': True})
+        return jsonify({
+            'message': 'Batch processed successfully',
+            'count': len(items),
+            'inserted': sum(1 for o in outcomes if o.status == 'inserted'),
+            'outcomes': [o.to_dict() for o in outcomes],
+        })
     except Exception as e:
         return jsonify({'error': 'Internal server error', 'message': str(e)}), 500
 
@@ -365,76 +213,22 @@ def judge_ai_post():
         if not data or 'post' not in data or 'isAI' not in data:
             return jsonify({'error': 'Invalid data provided. Need post and isAI fields'}), 400
 
-        post = data['post']
-        is_ai_judgment = data.get('isAI', False)
-
-        # Persist a 'markedai' interaction
-        with db_session() as session:
-            lookup_post_id = post.get('post_id')
-            humor_id = post.get('humor_id')
-            is_ai_actual = False
-
-            if isinstance(lookup_post_id, str) and lookup_post_id.startswith('ai-'):
-                try:
-                    ai_numeric_id = int(lookup_post_id.split('ai-')[-1])
-                except Exception:
-                    ai_numeric_id = None
-                try:
-                    session.add(Interaction(
-                        user_id=g.current_user_id,
-                        ai_id=ai_numeric_id,
-                        action='markedai'
-                    ))
-                    session.flush()
-                except IntegrityError:
-                    session.rollback()
-                is_ai_actual = True
-            elif humor_id is not None:
-                hp = session.query(HumorPost).filter(HumorPost.id == humor_id).first()
-                try:
-                    session.add(Interaction(
-                        user_id=g.current_user_id,
-                        humor_id=hp.id if hp else None,
-                        action='markedai'
-                    ))
-                    session.flush()
-                except IntegrityError:
-                    session.rollback()
-                is_ai_actual = False
-            else:
-                db_post = session.query(Post).filter(
-                    (Post.title == post.get('title'))
-                ).first()
-                if db_post is None:
-                    db_post = Post(
-                        title=post.get('title', ''),
-                        self_text=post.get('self_text', ''),
-                        subreddit=post.get('subreddit'),
-                        over_18=str(post.get('over_18', 'false')).lower() == 'true',
-                        link_flair_text=post.get('link_flair_text'),
-                        is_ai=bool(post.get('is_ai', False)),
-                        random_key=random.getrandbits(63),
-                    )
-                    session.add(db_post)
-                    session.flush()
-                try:
-                    session.add(Interaction(
-                        user_id=g.current_user_id,
-                        post_id=db_post.id,
-                        action='markedai'
-                    ))
-                    session.flush()
-                except IntegrityError:
-                    session.rollback()
-                is_ai_actual = bool(db_post.is_ai)
-
-        # Update experiment counters for marked-as-AI based on the actual post type, not the user's judgment
-        increment_marked_as_ai(is_ai_post=is_ai_actual, amount=1)
-        return jsonify({'message': 'AI judgment recorded successfully'})
+        # Persist a 'markedai' interaction; counters use the actual post type, not the user's judgment
+        outcomes = _record([(data['post'], 'markedai')])
+        return jsonify({'message': 'AI judgment recorded successfully', **_outcome_fields(outcomes)})
             
     except Exception as e:
         return jsonify({'error': 'Internal server error', 'message': str(e)}), 500
 
+@post_interactions.route('/metrics')
+@require_auth
+def interaction_metrics():
+    event_log = get_event_log() if INTERACTION_WRITE_BEHIND else None
+    return jsonify({
+        'write_behind': event_log is not None,
+        'event_log': event_log.metrics() if event_log is not None else None,
+    })
+
 @post_interactions.route('/reset', methods=['POST'])
 def reset_all():
     try:
@@ -0,0 +1,171 @@
+"""Columnar on-disk post store.
+
+Filtered posts are written as Parquet, hive-partitioned by subreddit, with the
+flair column dictionary-encoded. Readers open the store as a memory-mapped
+dataset, so a subreddit filter prunes whole partitions and other predicates are
+pushed down to the row groups. No CSV has to be parsed.
+
+pyarrow is an optional dependency and is imported only when the store is used.
+"""
+import csv
+import os
+import random
+import shutil
+import sys
+import uuid
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+DEFAULT_STORE_DIR = os.getenv(
+    "POST_STORE_DIR",
+    os.path.join(os.path.dirname(__file__), 'data', 'posts_store'),
+)
+
+STORE_COLUMNS = ['title', 'self_text', 'subreddit', 'over_18', 'link_flair_text']
+
+
+def _require_pyarrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+        import pyarrow.fs as pafs
+        import pyarrow.parquet as pq
+    except Exception as e:
+        raise RuntimeError(f"pyarrow is required for the columnar post store: {e}")
+    return pa, ds, pafs, pq
+
+
+def _schema(pa):
+    return pa.schema([
+        ('title', pa.string()),
+        ('self_text', pa.string()),
+        ('subreddit', pa.string()),
+        ('over_18', pa.bool_()),
+        ('link_flair_text', pa.dictionary(pa.int32(), pa.string())),
+    ])
+
+
+def _partitioning(pa, ds):
+    return ds.partitioning(
+        pa.schema([('subreddit', pa.dictionary(pa.int32(), pa.string()))]),
+        flavor='hive',
+    )
+
+
+def store_exists(root: str = DEFAULT_STORE_DIR) -> bool:
+    return os.path.isdir(root) and any(os.scandir(root))
+
+
+def write_posts(rows: Iterable[Dict[str, Any]], root: str = DEFAULT_STORE_DIR, chunk_size: int = 100000) -> int:
+    """Append post dicts to the store, one set of Parquet files per chunk."""
+    pa, ds, _pafs, pq = _require_pyarrow()
+    schema = _schema(pa)
+    os.makedirs(root, exist_ok=True)
+    written = 0
+    columns: Dict[str, List[Any]] = {c: [] for c in STORE_COLUMNS}
+
+    def flush():
+        nonlocal written
+        if not columns['title']:
+            return
+        table = pa.Table.from_pydict(columns, schema=schema)
+        pq.write_to_dataset(
+            table,
+            root,
+            partitioning=_partitioning(pa, ds),
+            basename_template=f"part-{uuid.uuid4().hex}-{{i}}.parquet",
+            existing_data_behavior='overwrite_or_ignore',
+        )
+        written += table.num_rows
+        for values in columns.values():
+            values.clear()
+        print(f"Wrote {written} posts to {root}")
+
+    for row in rows:
+        columns['title'].append(row.get('title') or '')
+        columns['self_text'].append(row.get('self_text') or '')
+        columns['subreddit'].append(row.get('subreddit') or None)
+        columns['over_18'].append(str(row.get('over_18', 'false')).lower() == 'true')
+        columns['link_flair_text'].append(row.get('link_flair_text') or None)
+        if len(columns['title']) >= chunk_size:
+            flush()
+    flush()
+    return written
+
+
+def _swap_in(staging: str, root: str) -> None:
+    """Replace root with the staging directory, then delete the old store."""
+    old = None
+    if os.path.exists(root):
+        old = f"{root}.old-{uuid.uuid4().hex}"
+        os.rename(root, old)
+    os.rename(staging, root)
+    if old is not None:
+        shutil.rmtree(old, ignore_errors=True)
+
+
+def csv_to_store(csv_path: str, root: str = DEFAULT_STORE_DIR, chunk_size: int = 100000,
+                 append: bool = False) -> int:
+    """Convert a posts CSV (e.g. the output of combine_csvs) into the store.
+
+    The store is replaced: the posts are written to a staging directory next to
+    root and swapped in once complete, so a failed run leaves the old store as it
+    was. With append=True the posts are added to the existing store instead.
+    """
+    try:
+        csv.field_size_limit(sys.maxsize)
+    except Exception:
+        csv.field_size_limit(2147483647)
+    with open(csv_path, 'r', encoding='utf-8', newline='') as f:
+        rows = csv.DictReader(f)
+        if append:
+            return write_posts(rows, root, chunk_size)
+        root = root.rstrip(os.sep)
+        staging = f"{root}.tmp-{uuid.uuid4().hex}"
+        try:
+            written = write_posts(rows, staging, chunk_size)
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+    _swap_in(staging, root)
+    return written
+
+
+def open_dataset(root: str = DEFAULT_STORE_DIR):
+    pa, ds, pafs, _pq = _require_pyarrow()
+    return ds.dataset(
+        root,
+        format='parquet',
+        partitioning=_partitioning(pa, ds),
+        filesystem=pafs.LocalFileSystem(use_mmap=True),
+    )
+
+
+def _filter(subreddits: Optional[List[str]]):
+    if not subreddits:
+        return None
+    _pa, ds, _pafs, _pq = _require_pyarrow()
+    return ds.field('subreddit').isin(list(subreddits))
+
+
+def read_posts(root: str = DEFAULT_STORE_DIR, subreddits: Optional[List[str]] = None,
+               columns: Optional[List[str]] = None):
+    """Load a (subreddit-filtered) slice of the store as an Arrow table."""
+    return open_dataset(root).to_table(columns=columns, filter=_filter(subreddits))
+
+
+def iter_posts(root: str = DEFAULT_STORE_DIR, subreddits: Optional[List[str]] = None,
+               columns: Optional[List[str]] = None, batch_size: int = 10000) -> Iterator[Dict[str, Any]]:
+    """Stream posts from the store as dicts with bounded memory."""
+    scanner = open_dataset(root).scanner(columns=columns, filter=_filter(subreddits), batch_size=batch_size)
+    for batch in scanner.to_batches():
+        yield from batch.to_pylist()
+
+
+def sample_posts(limit: int, root: str = DEFAULT_STORE_DIR, subreddits: Optional[List[str]] = None,
+                 columns: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+    """Uniform random sample of up to limit posts from a subreddit slice."""
+    table = read_posts(root, subreddits, columns)
+    if table.num_rows == 0:
+        return []
+    indices = random.sample(range(table.num_rows), min(limit, table.num_rows))
+    return table.take(indices).to_pylist()
@@ -0,0 +1,476 @@
+import random
+import threading
+import time
+from array import array
+from collections import OrderedDict, deque
+from typing import Dict, Iterable, List, Optional, Tuple
+from sqlalchemy import and_, func, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from config import FEED_SAMPLER, FEED_SAMPLER_REFRESH_SECONDS, HUMOR_RECENT_WINDOW, ARCHIVE_PREFETCH_SIZE, ARCHIVE_MAX_USERS, ARCHIVE_EMPTY_TTL
+from db import db_session
+from db.models import Post, ServedPost, HumorPost, AiGeneratedPost
+
+
+def _mark_served(session, user_id: int, post_ids: Iterable[int]) -> None:
+    rows = [{'user_id': user_id, 'post_id': pid} for pid in post_ids]
+    if not rows:
+        return
+    # Another worker may have served the same post; the unique constraint makes that a no-op
+    session.execute(pg_insert(ServedPost.__table__).values(rows).on_conflict_do_nothing())
+
+
+class SqlSampler:
+    """Samples unseen posts with random_key windows and an anti-join on served_posts."""
+
+    name = 'sql'
+
+    def sample(self, user_id: int, limit: int, mark_served: bool = True) -> List[Post]:
+        # Two-phase sampling using random_key windows to avoid ORDER BY RANDOM() cost
+        # 1) try to pick a random window and fetch LIMIT rows not served
+        # 2) if insufficient, fall back to a few retries; finally fallback to ORDER BY random_key for small remainder
+        results: List[Post] = []
+        attempts = 5
+        with db_session() as session:
+            for _ in range(attempts):
+                # Pick a random center and clamp window within signed BIGINT range
+                center = random.getrandbits(63)  # [0, 2^63-1]
+                half_span = 1 << 59  # keep total span at 2^60
+                min_bigint = 0
+                max_bigint = (1 << 63) - 1
+                a = center - half_span if center >= half_span else min_bigint
+                b = center + half_span if center <= (max_bigint - half_span) else max_bigint
+                q = (
+                    session.query(Post)
+                    .outerjoin(ServedPost, and_(ServedPost.user_id == user_id, ServedPost.post_id == Post.id))
+                    .filter(
+                        Post.random_key.between(a, b),
+                        ServedPost.id.is_(None),
+                    )
+                    .limit(limit - len(results))
+                )
+                chunk = q.all()
+                results.extend(chunk)
+                if len(results) >= limit:
+                    break
+
+            if len(results) < limit:
+                # Fallback: random_key order for the remainder
+                remainder = limit - len(results)
+                q = (
+                    session.query(Post)
+                    .outerjoin(ServedPost, and_(ServedPost.user_id == user_id, ServedPost.post_id == Post.id))
+                    .filter(ServedPost.id.is_(None))
+                    .order_by(Post.random_key)
+                    .limit(remainder * 10)
+                )
+                pool = q.all()
+                random.shuffle(pool)
+                results.extend(pool[:remainder])
+
+            if mark_served:
+                _mark_served(session, user_id, [p.id for p in results])
+
+        return results
+
+
+class ServedBitmap:
+    """Growable bitmap of the post ids already served to one user."""
+
+    __slots__ = ('bits', 'count')
+
+    def __init__(self):
+        self.bits = bytearray()
+        self.count = 0
+
+    def __contains__(self, post_id: int) -> bool:
+        byte = post_id >> 3
+        return byte < len(self.bits) and bool(self.bits[byte] & (1 << (post_id & 7)))
+
+    def add(self, post_id: int) -> bool:
+        """Set the bit for post_id. Returns False if it was already set."""
+        byte = post_id >> 3
+        if byte >= len(self.bits):
+            # Grow geometrically so repeated adds of increasing ids stay amortized O(1)
+            self.bits.extend(bytes(max(byte + 1 - len(self.bits), len(self.bits))))
+        mask = 1 << (post_id & 7)
+        if self.bits[byte] & mask:
+            return False
+        self.bits[byte] |= mask
+        self.count += 1
+        return True
+
+
+class BitmapSampler:
+    """Samples unseen posts from a shuffled id permutation and per-user served bitmaps.
+
+    Each user walks the shared permutation from their own random offset, skipping ids
+    set in their bitmap, so picking candidates never touches the database. Only the
+    chosen rows are fetched, by primary key, and only rows that came back and were
+    written to served_posts are set in the bitmap. The permutation is rebuilt when
+    max(posts.id) has moved, checked at most every FEED_SAMPLER_REFRESH_SECONDS.
+    """
+
+    name = 'bitmap'
+
+    def __init__(self, refresh_seconds: float = FEED_SAMPLER_REFRESH_SECONDS):
+        self._lock = threading.Lock()
+        self._rebuild_lock = threading.Lock()
+        self._permutation = array('q')
+        self._served: Dict[int, ServedBitmap] = {}
+        self._cursors: Dict[int, int] = {}
+        self._max_id: Optional[int] = None
+        self._refresh_seconds = refresh_seconds
+        self._next_check = 0.0
+        self._ready = False
+
+    def load(self, post_ids: Iterable[int], served: Iterable[Tuple[int, int]]) -> None:
+        """Replace the permutation and bitmaps from (post ids, (user_id, post_id) pairs)."""
+        ids = list(post_ids)
+        random.shuffle(ids)
+        bitmaps: Dict[int, ServedBitmap] = {}
+        for user_id, post_id in served:
+            bitmaps.setdefault(user_id, ServedBitmap()).add(post_id)
+        with self._lock:
+            self._permutation = array('q', ids)
+            self._served = bitmaps
+            self._cursors = {}
+            self._max_id = max(ids) if ids else None
+            self._next_check = time.monotonic() + self._refresh_seconds
+            self._ready = True
+
+    def rebuild(self) -> None:
+        """Rebuild the permutation from posts and the bitmaps from served_posts."""
+        with db_session() as session:
+            post_ids = session.execute(select(Post.id)).scalars().all()
+            served = session.execute(select(ServedPost.user_id, ServedPost.post_id)).all()
+        self.load(post_ids, served)
+        print(f"[sampler] Built permutation of {len(post_ids)} posts and {len(self._served)} served bitmaps")
+
+    def invalidate(self) -> None:
+        """Mark the permutation stale so the next sample rebuilds it (e.g. after seeding)."""
+        with self._lock:
+            self._ready = False
+
+    def _ensure_fresh(self) -> None:
+        if self._ready and time.monotonic() < self._next_check:
+            return
+        with self._rebuild_lock:
+            if self._ready:
+                if time.monotonic() < self._next_check:
+                    return
+                with db_session() as session:
+                    max_id = session.execute(select(func.max(Post.id))).scalar()
+                if max_id == self._max_id:
+                    self._next_check = time.monotonic() + self._refresh_seconds
+                    return
+                print(f"[sampler] posts max id moved from {self._max_id} to {max_id}; rebuilding")
+            self.rebuild()
+
+    def _bitmap_for(self, user_id: int) -> ServedBitmap:
+        bitmap = self._served.get(user_id)
+        if bitmap is None:
+            # First request for this user in this process: pick up marks written elsewhere
+            bitmap = ServedBitmap()
+            with db_session() as session:
+                for post_id in session.execute(
+                    select(ServedPost.post_id).where(ServedPost.user_id == user_id)
+                ).scalars():
+                    bitmap.add(post_id)
+            with self._lock:
+                bitmap = self._served.setdefault(user_id, bitmap)
+        return bitmap
+
+    def draw_ids(self, user_id: int, limit: int) -> List[int]:
+        """Pick up to limit unseen post ids for the user without marking them served.
+
+        The user's cursor moves past the picked ids, so concurrent draws for the
+        same user get different ids; call mark() for the ones actually served.
+        """
+        bitmap = self._bitmap_for(user_id)
+        chosen: List[int] = []
+        with self._lock:
+            total = len(self._permutation)
+            if total == 0 or bitmap.count >= total:
+                return chosen
+            pos = self._cursors.get(user_id)
+            if pos is None:
+                pos = random.randrange(total)
+            for _ in range(total):
+                post_id = self._permutation[pos]
+                pos = pos + 1 if pos + 1 < total else 0
+                if post_id not in bitmap:
+                    chosen.append(post_id)
+                    if len(chosen) >= limit:
+                        break
+            self._cursors[user_id] = pos
+        return chosen
+
+    def mark(self, user_id: int, post_ids: Iterable[int]) -> None:
+        """Set post_ids in the user's bitmap once they are recorded in served_posts."""
+        bitmap = self._bitmap_for(user_id)
+        with self._lock:
+            for post_id in post_ids:
+                bitmap.add(post_id)
+
+    def sample(self, user_id: int, limit: int, mark_served: bool = True) -> List[Post]:
+        self._ensure_fresh()
+        ids = self.draw_ids(user_id, limit)
+        if not ids:
+            return []
+        with db_session() as session:
+            rows = session.query(Post).filter(Post.id.in_(ids)).all()
+            # Preserve the permutation order; ids missing from posts are not served
+            by_id = {p.id: p for p in rows}
+            posts = [by_id[i] for i in ids if i in by_id]
+            if mark_served:
+                _mark_served(session, user_id, [p.id for p in posts])
+        if mark_served:
+            self.mark(user_id, [p.id for p in posts])
+        return posts
+
+
+class HumorCandidatePool:
+    """Ids of humor posts eligible for the feed, held in a compact array.
+
+    Eligibility (has an image that is not an external preview) is evaluated once when
+    the pool is built, so each request is a few O(1) random draws plus one primary-key
+    IN query. Humor posts are not written to served_posts; instead each user's most
+    recent HUMOR_RECENT_WINDOW draws are excluded in memory.
+    """
+
+    def __init__(self, recent_window: int = HUMOR_RECENT_WINDOW):
+        self._lock = threading.Lock()
+        self._ids = array('q')
+        self._recent: Dict[int, Tuple[deque, set]] = {}
+        self._recent_window = recent_window
+        self._ready = False
+
+    def rebuild(self) -> None:
+        with db_session() as session:
+            ids = session.execute(
+                select(HumorPost.id)
+                .where(HumorPost.image_url.isnot(None))
+                .where(~HumorPost.image_url.like('%external-preview.redd.it%'))
+            ).scalars().all()
+        with self._lock:
+            self._ids = array('q', ids)
+            self._ready = True
+        print(f"[sampler] Built humor candidate pool of {len(ids)} posts")
+
+    def invalidate(self) -> None:
+        """Mark the pool stale so the next draw rebuilds it (e.g. after seeding)."""
+        with self._lock:
+            self._ready = False
+
+    def _remember(self, user_id: int, post_id: int) -> None:
+        order, members = self._recent.setdefault(user_id, (deque(), set()))
+        order.append(post_id)
+        members.add(post_id)
+        while len(order) > self._recent_window:
+            members.discard(order.popleft())
+
+    def draw_ids(self, user_id: int, limit: int) -> List[int]:
+        if not self._ready:
+            self.rebuild()
+        chosen: List[int] = []
+        with self._lock:
+            total = len(self._ids)
+            if total == 0:
+                return chosen
+            limit = min(limit, total)
+            recent = self._recent.get(user_id, (None, set()))[1]
+            picked = set()
+            # Rejection sampling; give up on the recency filter if the pool is too small
+            for attempt in range(limit * 8):
+                post_id = self._ids[random.randrange(total)]
+                if post_id in picked or (post_id in recent and attempt < limit * 4):
+                    continue
+                picked.add(post_id)
+                chosen.append(post_id)
+                if len(chosen) >= limit:
+                    break
+            for post_id in chosen:
+                self._remember(user_id, post_id)
+        return chosen
+
+    def sample(self, user_id: int, limit: int) -> List[HumorPost]:
+        ids = self.draw_ids(user_id, limit)
+        if not ids:
+            return []
+        with db_session() as session:
+            rows = session.query(HumorPost).filter(HumorPost.id.in_(ids)).all()
+        by_id = {p.id: p for p in rows}
+        return [by_id[i] for i in ids if i in by_id]
+
+
+class ArchiveSampler:
+    """Streams archived AI posts (ai_generated_posts) to each user without repeats.
+
+    Every user gets a keyset cursor over the primary key that starts at a random id
+    and wraps around at the end of the table, so each read is an index range scan
+    with no sort. Ids behind the cursor in the current lap have been served; posts
+    archived mid-lap get higher ids and are reached before the wrap. Rows are
+    prefetched prefetch_size at a time into a per-user buffer. Once a lap
+    completes, the next one starts from a fresh random id.
+
+    Each user's state has its own lock, so users never wait on each other's
+    reads; the shared lock only covers the LRU of states, capped at max_users.
+    An evicted user starts a new lap on their next read.
+
+    Passing a queue_key restricts the stream to posts generated for that pool
+    (a separate cursor per user and pool); older rows without one are skipped.
+    A scope found empty returns no posts without querying for empty_ttl seconds.
+    """
+
+    def __init__(self, prefetch_size: int = ARCHIVE_PREFETCH_SIZE, max_users: int = ARCHIVE_MAX_USERS,
+                 empty_ttl: float = ARCHIVE_EMPTY_TTL):
+        self.prefetch_size = max(1, prefetch_size)
+        self.max_users = max(1, max_users)
+        self.empty_ttl = empty_ttl
+        self._users: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'served': 0, 'fetches': 0, 'laps': 0, 'evicted': 0, 'empty_skips': 0}
+
+    def _count(self, stat: str, amount: int = 1) -> None:
+        with self._lock:
+            self._stats[stat] += amount
+
+    @staticmethod
+    def _scope(query, state: dict):
+        if state['queue_key'] is not None:
+            query = query.where(AiGeneratedPost.queue_key == state['queue_key'])
+        return query
+
+    def _new_lap(self, state: dict) -> None:
+        """Start a lap at a random id of the scope, or mark the scope empty for empty_ttl."""
+        with db_session() as session:
+            low, high = session.execute(
+                self._scope(select(func.min(AiGeneratedPost.id), func.max(AiGeneratedPost.id)), state)
+            ).one()
+        if low is None:
+            state.update(start=0, cursor=-1, wrapped=False, empty_until=time.monotonic() + self.empty_ttl)
+            return
+        start = random.randint(low, high)
+        state.update(start=start, cursor=start - 1, wrapped=False, empty_until=None)
+
+    def _state(self, user_id: int, queue_key: Optional[str]) -> dict:
+        key = (user_id, queue_key)
+        with self._lock:
+            state = self._users.get(key)
+            if state is None:
+                state = self._users[key] = {'buffer': deque(), 'lock': threading.Lock(), 'queue_key': queue_key}
+                while len(self._users) > self.max_users:
+                    self._users.popitem(last=False)
+                    self._stats['evicted'] += 1
+            else:
+                self._users.move_to_end(key)
+        return state
+
+    def _fetch(self, state: dict) -> bool:
+        """Refill the user's buffer from the cursor. Returns False when the lap is complete."""
+        query = self._scope(select(AiGeneratedPost).where(AiGeneratedPost.id > state['cursor']), state)
+        if state['wrapped']:
+            query = query.where(AiGeneratedPost.id < state['start'])
+        with db_session() as session:
+            rows = session.execute(query.order_by(AiGeneratedPost.id).limit(self.prefetch_size)).scalars().all()
+        self._count('fetches')
+        if rows:
+            state['cursor'] = rows[-1].id
+            state['buffer'].extend(archived_post_dict(r) for r in rows)
+            return True
+        if not state['wrapped']:
+            state.update(cursor=0, wrapped=True)
+            return True
+        return False
+
+    def sample(self, user_id: int, limit: int, queue_key: Optional[str] = None) -> List[dict]:
+        posts: List[dict] = []
+        state = self._state(user_id, queue_key)
+        with state['lock']:
+            if state.get('empty_until') is not None:
+                if time.monotonic() < state['empty_until']:
+                    self._count('empty_skips')
+                    return posts
+                # Look again: posts may have been archived for this scope since
+                self._new_lap(state)
+            elif 'start' not in state:
+                self._new_lap(state)
+            new_laps = 0
+            while len(posts) < limit and state['empty_until'] is None:
+                if state['buffer']:
+                    posts.append(state['buffer'].popleft())
+                    continue
+                if self._fetch(state):
+                    continue
+                # Lap complete: the next one starts from a new random id. Return what this
+                # lap produced first, so a small archive never repeats within one response
+                self._count('laps')
+                self._new_lap(state)
+                if posts or new_laps:
+                    break
+                new_laps += 1
+        self._count('served', len(posts))
+        return posts
+
+    def metrics(self) -> Dict[str, int]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['users'] = len(self._users)
+            stats['buffered'] = sum(len(s['buffer']) for s in self._users.values())
+        return stats
+
+
+def archived_post_dict(r: AiGeneratedPost) -> dict:
+    return {
+        "title": r.title,
+        "self_text": r.self_text,
+        "subreddit": r.subreddit,
+        "post_id": f"ai-{r.id}",
+        "over_18": "false",
+        "link_flair_text": "AI",
+        "is_ai": True,
+    }
+
+
+_SAMPLERS = {
+    'sql': SqlSampler,
+    'bitmap': BitmapSampler,
+}
+
+_post_sampler = None
+_post_sampler_lock = threading.Lock()
+
+
+def get_post_sampler(name: Optional[str] = None):
+    """Return the process-wide sampler for the posts feed (FEED_SAMPLER by default)."""
+    global _post_sampler
+    if _post_sampler is None:
+        with _post_sampler_lock:
+            if _post_sampler is None:
+                key = name or FEED_SAMPLER
+                if key not in _SAMPLERS:
+                    raise ValueError(f"Invalid feed sampler: {key}")
+                _post_sampler = _SAMPLERS[key]()
+    return _post_sampler
+
+
+_humor_pool = HumorCandidatePool()
+
+
+def get_humor_pool() -> HumorCandidatePool:
+    return _humor_pool
+
+
+_archive_sampler = ArchiveSampler()
+
+
+def get_archive_sampler() -> ArchiveSampler:
+    return _archive_sampler
+
+
+def init_samplers() -> None:
+    """Build in-memory sampler state at startup."""
+    sampler = get_post_sampler()
+    if hasattr(sampler, 'rebuild'):
+        sampler.rebuild()
+    _humor_pool.rebuild()
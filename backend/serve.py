@@ -0,0 +1,108 @@
+"""Production entry point: gunicorn web workers plus one AI post producer process.
+
+    python3 serve.py --workers 4 --background
+
+The producer is the only process that loads models and runs background
+generation. It serves its AI post pools and LLM calls to the web workers over
+a Unix socket (ai_broker.py), so adding workers scales request handling across
+cores without another copy of the model. Takes the same flags as server.py
+plus --workers, --threads and --bind.
+"""
+import multiprocessing
+import os
+import sys
+import time
+
+
+def run_producer():
+    """Producer process: own the pools and models, serve them, and generate."""
+    # Spawned with the workers' environment; this process keeps everything local
+    os.environ['AI_BROKER_ROLE'] = 'producer'
+    from ai_broker import BrokerServer
+    from config import args, AI_BROKER_SOCKET
+    from db.seed import init_db
+    from generate import producer_handlers, start_background_generation
+
+    try:
+        init_db()
+    except Exception as e:
+        print(f"[producer] Database init failed: {e}")
+
+    server = BrokerServer(AI_BROKER_SOCKET, producer_handlers())
+    print(f"[producer] Serving AI post pools on {AI_BROKER_SOCKET}")
+    if args.background:
+        start_background_generation()
+        print("[producer] Background LLM generation enabled")
+    else:
+        print("[producer] Background LLM generation disabled")
+    server.serve_forever()
+
+
+def _start_producer(socket_path: str, timeout: float = 60.0) -> multiprocessing.Process:
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    producer = multiprocessing.get_context('spawn').Process(target=run_producer, name='ai-producer', daemon=True)
+    producer.start()
+    deadline = time.monotonic() + timeout
+    while not os.path.exists(socket_path):
+        if not producer.is_alive():
+            raise RuntimeError(f"AI post producer exited with code {producer.exitcode}")
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"AI post producer did not open {socket_path} within {timeout:.0f}s")
+        time.sleep(0.1)
+    return producer
+
+
+def main():
+    # This process and the gunicorn workers forked from it are web workers
+    os.environ['AI_BROKER_ROLE'] = 'worker'
+    import config
+    from config import args, AI_BROKER_SOCKET
+    try:
+        from gunicorn.app.base import BaseApplication
+    except Exception as e:
+        print(f"gunicorn is required for serve.py ({e}); use server.py for development")
+        sys.exit(1)
+
+    if args.workers > 1 and config.FEED_SAMPLER == 'bitmap':
+        # The bitmap sampler keeps served posts per process, so workers would repeat each other's posts
+        if os.environ.get('FEED_SAMPLER') == 'bitmap':
+            print("FEED_SAMPLER=bitmap cannot be used with more than one worker; "
+                  "use FEED_SAMPLER=sql or --workers 1")
+            sys.exit(1)
+        # Only the default was left; sampling reads it when the app is loaded, after this
+        os.environ['FEED_SAMPLER'] = config.FEED_SAMPLER = 'sql'
+        print(f"Using FEED_SAMPLER=sql for {args.workers} workers")
+
+    producer = _start_producer(AI_BROKER_SOCKET)
+
+    class SlopApplication(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', args.bind)
+            self.cfg.set('workers', max(1, args.workers))
+            self.cfg.set('worker_class', 'gthread')
+            self.cfg.set('threads', max(1, args.threads))
+            self.cfg.set('timeout', 300)
+            # Seed the DB and build sampler state once, in the master
+            self.cfg.set('preload_app', True)
+            self.cfg.set('post_fork', _post_fork)
+
+        def load(self):
+            from server import app
+            return app
+
+    def _post_fork(server, worker):
+        # Connections opened in the master must not be shared with the workers
+        from db import engine
+        engine.dispose(close=False)
+
+    try:
+        SlopApplication().run()
+    finally:
+        # gunicorn handles the signals; take the producer down with it
+        if producer.is_alive():
+            producer.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -2,12 +2,14 @@ from flask import Flask, jsonify
 from flask_cors import CORS
 from post_interactions import post_interactions
 from generate import generate, start_background_generation
-from config import args
+from config import args, INTERACTION_WRITE_BEHIND
+from event_log import get_event_log
 from auth import auth
 from feed import feed
 from experiments import experiments
 from judgement import judgement
 from db.seed import seed_if_empty, clear_served_posts
+from sampling import init_samplers
 from datasets import datasets
 
 app = Flask(__name__)
@@ -17,6 +19,7 @@ CORS(app)
 try:
     seed_if_empty()
     clear_served_posts()
+    init_samplers()
 except Exception as e:
     print(f"Database init failed: {e}")
 
@@ -41,6 +44,9 @@ def _start_background_if_needed():
         print("Background LLM generation enabled")
     else:
         print("Background LLM generation disabled")
+    if INTERACTION_WRITE_BEHIND:
+        # Replays interaction events left over from a previous run
+        get_event_log()
     _bg_started = True
 
 
@@ -1,5 +1,11 @@
-from config import args
+import atexit
+import threading
+import time
+from typing import Dict, Optional, Tuple
+from config import args, STATS_FLUSH_INTERVAL
 from flask import g
+from sqlalchemy import Float, case, cast, insert, update
+from sqlalchemy.exc import IntegrityError
 from db import db_session
 from db.models import Experiment
 
@@ -13,102 +19,262 @@ REAL_MARKED_AS_AI_COUNT = 0
 AI_DISLIKE_COUNT = 0
 REAL_DISLIKE_COUNT = 0
 
-def _update_experiment_counts(ai_delta: int = 0, liked_ai_delta: int = 0, real_delta: int = 0, liked_real_delta: int = 0,
-                              ai_marked_delta: int = 0, real_marked_delta: int = 0,
-                              ai_dislike_delta: int = 0, real_dislike_delta: int = 0) -> None:
-    """Cumulatively update experiment counters for the current user/experiment.
+# Counter columns on Experiment that accept deltas
+COUNTER_COLUMNS = (
+    'ai_post_count',
+    'liked_ai_post_count',
+    'real_post_count',
+    'liked_real_post_count',
+    'ai_marked_as_ai_count',
+    'real_marked_as_ai_count',
+    'ai_dislike_count',
+    'real_dislike_count',
+)
 
-    Creates the row if missing and recomputes like rates.
+# Rate column -> (numerator counter, denominator counter)
+RATE_COLUMNS = {
+    'ai_like_rate': ('liked_ai_post_count', 'ai_post_count'),
+    'real_like_rate': ('liked_real_post_count', 'real_post_count'),
+    'ai_marked_as_ai_rate': ('ai_marked_as_ai_count', 'ai_post_count'),
+    'real_marked_as_ai_rate': ('real_marked_as_ai_count', 'real_post_count'),
+    'ai_dislike_rate': ('ai_dislike_count', 'ai_post_count'),
+    'real_dislike_rate': ('real_dislike_count', 'real_post_count'),
+}
+
+# Deltas waiting for the background flusher, keyed by (user_id, experiment)
+_pending: Dict[Tuple[int, str], Dict[str, int]] = {}
+_pending_aware: Dict[Tuple[int, str], bool] = {}
+_pending_lock = threading.Lock()
+_flusher_thread: Optional[threading.Thread] = None
+
+
+def _clean_deltas(deltas: Dict[str, int]) -> Dict[str, int]:
+    cleaned = {}
+    for col, d in (deltas or {}).items():
+        if col not in COUNTER_COLUMNS:
+            raise ValueError(f"Unknown experiment counter: {col}")
+        if d:
+            cleaned[col] = int(d)
+    return cleaned
+
+
+def apply_experiment_deltas(user_id: int, experiment_name: str, deltas: Dict[str, int],
+                            aware: Optional[bool] = None) -> None:
+    """Apply counter deltas to one (experiment, user) row in a single transaction.
+
+    Counters are incremented in SQL (``SET x = x + :d``) and the affected rates are
+    derived from the new values in the same UPDATE, so concurrent requests never
+    read-modify-write the row. The row is inserted on first use.
     """
-    try:
-        with db_session() as session:
-            current_user_id = getattr(g, 'current_user_id', None)
-            current_experiment = getattr(g, 'current_experiment', None)
-            current_aware = getattr(g, 'current_user_aware', None)
-            if current_user_id is None:
-                return
-            experiment_name = current_experiment or 'base'
-            exp = session.query(Experiment).filter_by(experiment=experiment_name, user_id=current_user_id).one_or_none()
-            if exp is None:
-                exp = Experiment(
+    deltas = _clean_deltas(deltas)
+    if not deltas and aware is None:
+        return
+    table = Experiment.__table__
+
+    values = {}
+    for col, d in deltas.items():
+        values[col] = table.c[col] + d
+    for rate, (num, den) in RATE_COLUMNS.items():
+        if num not in deltas and den not in deltas:
+            continue
+        new_num = table.c[num] + deltas.get(num, 0)
+        new_den = table.c[den] + deltas.get(den, 0)
+        values[rate] = case((new_den > 0, cast(new_num, Float) / new_den), else_=0.0)
+    if aware is not None:
+        values['aware_of_experiment'] = bool(aware)
+
+    stmt = (
+        update(Experiment)
+        .where(Experiment.experiment == experiment_name, Experiment.user_id == user_id)
+        .values(values)
+    )
+
+    with db_session() as session:
+        result = session.execute(stmt)
+        if result.rowcount:
+            return
+        # First write for this (experiment, user): insert with deltas as initial counts
+        initial = {col: deltas.get(col, 0) for col in COUNTER_COLUMNS}
+        for rate, (num, den) in RATE_COLUMNS.items():
+            initial[rate] = (initial[num] / initial[den]) if initial[den] > 0 else 0.0
+        if aware is not None:
+            initial['aware_of_experiment'] = bool(aware)
+        try:
+            with session.begin_nested():
+                session.execute(insert(Experiment).values(
                     experiment=experiment_name,
-                    user_id=current_user_id,
-                )
-                session.add(exp)
-                session.flush()
-
-            # Apply deltas
-            if ai_delta:
-                exp.ai_post_count = (exp.ai_post_count or 0) + int(ai_delta)
-            if liked_ai_delta:
-                exp.liked_ai_post_count = (exp.liked_ai_post_count or 0) + int(liked_ai_delta)
-            if real_delta:
-                exp.real_post_count = (exp.real_post_count or 0) + int(real_delta)
-            if liked_real_delta:
-                exp.liked_real_post_count = (exp.liked_real_post_count or 0) + int(liked_real_delta)
-            if ai_marked_delta:
-                exp.ai_marked_as_ai_count = (exp.ai_marked_as_ai_count or 0) + int(ai_marked_delta)
-            if real_marked_delta:
-                exp.real_marked_as_ai_count = (exp.real_marked_as_ai_count or 0) + int(real_marked_delta)
-            if ai_dislike_delta:
-                exp.ai_dislike_count = (exp.ai_dislike_count or 0) + int(ai_dislike_delta)
-            if real_dislike_delta:
-                exp.real_dislike_count = (exp.real_dislike_count or 0) + int(real_dislike_delta)
-
-            # Recompute like rates
-            exp.ai_like_rate = (exp.liked_ai_post_count / exp.ai_post_count) if exp.ai_post_count > 0 else 0
-            exp.real_like_rate = (exp.liked_real_post_count / exp.real_post_count) if exp.real_post_count > 0 else 0
-            exp.ai_marked_as_ai_rate = (exp.ai_marked_as_ai_count / exp.ai_post_count) if exp.ai_post_count > 0 else 0
-            exp.real_marked_as_ai_rate = (exp.real_marked_as_ai_count / exp.real_post_count) if exp.real_post_count > 0 else 0
-            exp.ai_dislike_rate = (exp.ai_dislike_count / exp.ai_post_count) if exp.ai_post_count > 0 else 0
-            exp.real_dislike_rate = (exp.real_dislike_count / exp.real_post_count) if exp.real_post_count > 0 else 0
-
-            if current_aware is not None:
-                exp.aware_of_experiment = bool(current_aware)
+                    user_id=user_id,
+                    **initial,
+                ))
+        except IntegrityError:
+            # Another request inserted the row concurrently; increment it instead
+            session.execute(stmt)
+
+
+def _merge_pending(key: Tuple[int, str], deltas: Dict[str, int], aware: Optional[bool]) -> None:
+    bucket = _pending.setdefault(key, {})
+    for col, d in deltas.items():
+        bucket[col] = bucket.get(col, 0) + d
+    if aware is not None:
+        _pending_aware[key] = bool(aware)
+
+
+def flush_experiment_counts() -> int:
+    """Write all coalesced deltas to the database. Returns the number of rows touched."""
+    with _pending_lock:
+        pending = dict(_pending)
+        pending_aware = dict(_pending_aware)
+        _pending.clear()
+        _pending_aware.clear()
+
+    flushed = 0
+    for key, deltas in pending.items():
+        user_id, experiment_name = key
+        aware = pending_aware.get(key)
+        try:
+            apply_experiment_deltas(user_id, experiment_name, deltas, aware)
+            flushed += 1
+        except Exception as e:
+            print(f"Failed to flush experiment stats for {key}: {e}")
+            # Keep the deltas so the next flush retries them
+            with _pending_lock:
+                _merge_pending(key, deltas, aware)
+    return flushed
+
+
+def _flush_loop():
+    while True:
+        time.sleep(STATS_FLUSH_INTERVAL)
+        try:
+            flush_experiment_counts()
+        except Exception as e:
+            print(f"Error in stats flusher: {e}")
+
+
+def _ensure_flusher():
+    global _flusher_thread
+    if _flusher_thread is not None:
+        return
+    _flusher_thread = threading.Thread(target=_flush_loop, daemon=True)
+    _flusher_thread.start()
+    atexit.register(flush_experiment_counts)
+
+
+def record_experiment_deltas(deltas: Dict[str, int], user_id: Optional[int] = None,
+                             experiment: Optional[str] = None, aware: Optional[bool] = None) -> None:
+    """Record counter deltas for a user's experiment row.
+
+    User, experiment and awareness default to the current request context. With
+    STATS_FLUSH_INTERVAL > 0 the deltas are coalesced in memory and written by a
+    background flusher; otherwise they are applied immediately.
+    """
+    try:
+        if user_id is None:
+            user_id = getattr(g, 'current_user_id', None)
+            experiment = experiment or getattr(g, 'current_experiment', None)
+            if aware is None:
+                aware = getattr(g, 'current_user_aware', None)
+        if user_id is None:
+            return
+        experiment_name = experiment or 'base'
+        deltas = _clean_deltas(deltas)
+        if not deltas:
+            return
+
+        if STATS_FLUSH_INTERVAL > 0:
+            with _pending_lock:
+                _merge_pending((user_id, experiment_name), deltas, aware)
+            _ensure_flusher()
+        else:
+            apply_experiment_deltas(user_id, experiment_name, deltas, aware)
     except Exception as e:
         print(f"Failed to persist experiment stats to DB: {e}")
 
 
+def increment_served_counts(real_amount: int = 0, ai_amount: int = 0):
+    """Count a whole feed response's real and AI posts with one delta."""
+    global REAL_POST_COUNT, AI_POST_COUNT
+    REAL_POST_COUNT += real_amount
+    AI_POST_COUNT += ai_amount
+    record_experiment_deltas({'real_post_count': real_amount, 'ai_post_count': ai_amount})
+
+
 def increment_ai_post_count(amount: int = 1):
     global AI_POST_COUNT
     AI_POST_COUNT += amount
-    _update_experiment_counts(ai_delta=amount)
+    record_experiment_deltas({'ai_post_count': amount})
 
 
 def increment_liked_ai_post_count(amount: int = 1):
     global LIKED_AI_POST_COUNT
     LIKED_AI_POST_COUNT += amount
-    _update_experiment_counts(liked_ai_delta=amount)
+    record_experiment_deltas({'liked_ai_post_count': amount})
 
 
 def increment_real_post_count(amount: int = 1):
     global REAL_POST_COUNT
     REAL_POST_COUNT += amount
-    _update_experiment_counts(real_delta=amount)
+    record_experiment_deltas({'real_post_count': amount})
 
 
 def increment_liked_real_post_count(amount: int = 1):
     global LIKED_REAL_POST_COUNT
     LIKED_REAL_POST_COUNT += amount
-    _update_experiment_counts(liked_real_delta=amount)
+    record_experiment_deltas({'liked_real_post_count': amount})
 
 
 def increment_marked_as_ai(is_ai_post: bool, amount: int = 1):
     global AI_MARKED_AS_AI_COUNT, REAL_MARKED_AS_AI_COUNT
     if is_ai_post:
         AI_MARKED_AS_AI_COUNT += amount
-        _update_experiment_counts(ai_marked_delta=amount)
+        record_experiment_deltas({'ai_marked_as_ai_count': amount})
     else:
         REAL_MARKED_AS_AI_COUNT += amount
-        _update_experiment_counts(real_marked_delta=amount)
+        record_experiment_deltas({'real_marked_as_ai_count': amount})
 
 
 def increment_dislike(is_ai_post: bool, amount: int = 1):
     global AI_DISLIKE_COUNT, REAL_DISLIKE_COUNT
     if is_ai_post:
         AI_DISLIKE_COUNT += amount
-        _update_experiment_counts(ai_dislike_delta=amount)
+        record_experiment_deltas({'ai_dislike_count': amount})
     else:
         REAL_DISLIKE_COUNT += amount
-        _update_experiment_counts(real_dislike_delta=amount)
+        record_experiment_deltas({'real_dislike_count': amount})
+
+
+
+# Interaction action -> (counter for AI posts, counter for real posts)
+INTERACTION_COUNTERS = {
+    'like': ('liked_ai_post_count', 'liked_real_post_count'),
+    'dislike': ('ai_dislike_count', 'real_dislike_count'),
+    'markedai': ('ai_marked_as_ai_count', 'real_marked_as_ai_count'),
+}
 
+
+def count_interactions(outcomes, user_id: Optional[int] = None, experiment: Optional[str] = None,
+                       aware: Optional[bool] = None) -> None:
+    """Count newly recorded likes, dislikes and AI judgments with one delta.
+
+    outcomes are interaction_writer.InteractionOutcome; duplicates are not
+    counted again and 'next' is counted when the feed is served. Counters use
+    the actual type of each post, not the client's claim.
+    """
+    global LIKED_AI_POST_COUNT, LIKED_REAL_POST_COUNT, AI_MARKED_AS_AI_COUNT, REAL_MARKED_AS_AI_COUNT
+    global AI_DISLIKE_COUNT, REAL_DISLIKE_COUNT
+    deltas: Dict[str, int] = {}
+    for outcome in outcomes:
+        counters = INTERACTION_COUNTERS.get(outcome.action)
+        if outcome.status != 'inserted' or counters is None:
+            continue
+        col = counters[0] if outcome.is_ai else counters[1]
+        deltas[col] = deltas.get(col, 0) + 1
+    if not deltas:
+        return
+    LIKED_AI_POST_COUNT += deltas.get('liked_ai_post_count', 0)
+    LIKED_REAL_POST_COUNT += deltas.get('liked_real_post_count', 0)
+    AI_MARKED_AS_AI_COUNT += deltas.get('ai_marked_as_ai_count', 0)
+    REAL_MARKED_AS_AI_COUNT += deltas.get('real_marked_as_ai_count', 0)
+    AI_DISLIKE_COUNT += deltas.get('ai_dislike_count', 0)
+    REAL_DISLIKE_COUNT += deltas.get('real_dislike_count', 0)
+    record_experiment_deltas(deltas, user_id=user_id, experiment=experiment, aware=aware)